@@ -0,0 +1,112 @@
+#!/usr/bin/env python
+
+# Accuracy harness for the float32 mode of the Objective (Objective(...,
+# dtype=np.float32) / SpatialGraph.fit(..., dtype=np.float32)). Reports the
+# deviation of the loss and gradient from the float64 path at random edge
+# weights, and of the fitted weights, on the wolves data and on graphs
+# simulated with msprime.
+#
+# usage: python benchmarks/accuracy_float32.py
+
+import contextlib
+import io
+import time
+
+import numpy as np
+import pkg_resources
+from pandas_plink import read_plink
+
+from feems import Objective, SpatialGraph
+from feems.objective import loss_wrapper
+from feems.sim import setup_graph, simulate_genotypes
+from feems.utils import prepare_graph_inputs
+
+
+def wolves_graph():
+    data_path = pkg_resources.resource_filename("feems", "data/")
+    (bim, fam, G) = read_plink("{}/wolvesadmix".format(data_path))
+    coord = np.loadtxt("{}/wolvesadmix.coord".format(data_path))
+    outer = np.loadtxt("{}/wolvesadmix.outer".format(data_path))
+    grid_path = "{}/grid_250.shp".format(data_path)
+    outer, edges, grid, _ = prepare_graph_inputs(
+        coord=coord, ggrid=grid_path, translated=True, buffer=0, outer=outer
+    )
+    return SpatialGraph(np.array(G).T, coord, grid, edges)
+
+
+def simulated_graph(n_rows, n_columns, sample_prob, seed):
+    np.random.seed(seed)
+    graph, coord, grid, edges = setup_graph(
+        n_rows=n_rows,
+        n_columns=n_columns,
+        n_samples_per_node=4,
+        sample_prob=sample_prob,
+    )
+    genotypes = simulate_genotypes(graph, target_n_snps=2000)
+    return SpatialGraph(genotypes, coord, grid, edges)
+
+
+def eval_deviation(sp_graph, n_points=5, seed=0):
+    """Max relative deviation of the loss and gradient at random weights"""
+    rng = np.random.default_rng(seed)
+    objs = {}
+    for dtype in (np.float64, np.float32):
+        obj = Objective(sp_graph, dtype=dtype)
+        obj.lamb, obj.alpha = 2.0, 1.0
+        obj.lamb_q, obj.alpha_q = 1.0, 1.0
+        objs[dtype] = obj
+    sp_graph.optimize_q = "n-dim"
+    sp_graph.comp_precision(s2=np.ones(len(sp_graph)))
+
+    loss_dev, grad_dev = 0.0, 0.0
+    for _ in range(n_points):
+        z = np.r_[rng.normal(0, 0.5, sp_graph.size()),
+                  rng.normal(0, 0.2, len(sp_graph))]
+        loss64, grad64 = loss_wrapper(z, objs[np.float64])
+        loss32, grad32 = loss_wrapper(z, objs[np.float32])
+        loss_dev = max(loss_dev, abs(loss32 - loss64) / abs(loss64))
+        grad_dev = max(
+            grad_dev,
+            np.linalg.norm(grad32 - grad64) / np.linalg.norm(grad64),
+        )
+    return loss_dev, grad_dev
+
+
+def fit_deviation(sp_graph, lamb=2.0, lamb_q=1.0):
+    """Deviation of the fitted weights and train loss, and the fit times"""
+    res = {}
+    for dtype in (np.float64, np.float32):
+        sp_graph.factor = None
+        start = time.time()
+        sp_graph.fit(lamb=lamb, lamb_q=lamb_q, dtype=dtype)
+        res[dtype] = (np.log(sp_graph.w), sp_graph.train_loss, time.time() - start)
+    w_dev = np.max(np.abs(res[np.float32][0] - res[np.float64][0]))
+    loss_dev = abs(res[np.float32][1] - res[np.float64][1]) / abs(res[np.float64][1])
+    return w_dev, loss_dev, res[np.float64][2], res[np.float32][2]
+
+
+if __name__ == "__main__":
+    graphs = [("wolves", wolves_graph)]
+    for n_rows, n_columns, sample_prob in [(8, 12, 1.0), (12, 20, 0.5)]:
+        name = "sim {}x{} p={}".format(n_rows, n_columns, sample_prob)
+        graphs.append(
+            (name, lambda n=n_rows, m=n_columns, p=sample_prob: simulated_graph(n, m, p, 1))
+        )
+
+    for name, make_graph in graphs:
+        with contextlib.redirect_stdout(io.StringIO()):
+            sp_graph = make_graph()
+        loss_dev, grad_dev = eval_deviation(sp_graph)
+        with contextlib.redirect_stdout(io.StringIO()):
+            w_dev, fit_loss_dev, t64, t32 = fit_deviation(sp_graph)
+        print(
+            (
+                "{}: nodes={}, observed={}, "
+                "loss rel. dev={:.2e}, grad rel. dev={:.2e}, "
+                "fit max |dlog w|={:.2e}, train loss rel. dev={:.2e}, "
+                "fit time float64={:.1f}s float32={:.1f}s"
+            ).format(
+                name, len(sp_graph), sp_graph.n_observed_nodes, loss_dev,
+                grad_dev, w_dev, fit_loss_dev, t64, t32,
+            )
+        )
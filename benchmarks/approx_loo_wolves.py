@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# Validation of the approximate leave-one-deme-out CV of run_cv_joint
+# (approx_loo=True) against the exact leave-one-out CV on the wolves data.
+# Reports the CV error surfaces, their correlation, the chosen (lamb, lamb_q)
+# and the run times of the exact CV and of the approximation with only the
+# influence step (the default loo_maxiter=0) and with an L-BFGS polish.
+#
+# usage: python benchmarks/approx_loo_wolves.py
+
+import contextlib
+import io
+import time
+
+import numpy as np
+import pkg_resources
+from pandas_plink import read_plink
+
+from feems import SpatialGraph
+from feems.cross_validation import run_cv_joint
+from feems.utils import prepare_graph_inputs
+
+
+def wolves_graph():
+    data_path = pkg_resources.resource_filename("feems", "data/")
+    (bim, fam, G) = read_plink("{}/wolvesadmix".format(data_path))
+    coord = np.loadtxt("{}/wolvesadmix.coord".format(data_path))
+    outer = np.loadtxt("{}/wolvesadmix.outer".format(data_path))
+    grid_path = "{}/grid_250.shp".format(data_path)
+    outer, edges, grid, _ = prepare_graph_inputs(
+        coord=coord, ggrid=grid_path, translated=True, buffer=0, outer=outer
+    )
+    return SpatialGraph(np.array(G).T, coord, grid, edges, scale_snps=True)
+
+
+def timed_cv(sp_graph, lamb_grid, lamb_q_grid, **kwargs):
+    start = time.time()
+    with contextlib.redirect_stdout(io.StringIO()):
+        cv_err = run_cv_joint(sp_graph, lamb_grid, lamb_q_grid, factr=1e10,
+                              **kwargs)
+    return np.nanmean(cv_err, axis=0), time.time() - start
+
+
+def best(mean_err, lamb_grid, lamb_q_grid):
+    iq, i = np.unravel_index(np.nanargmin(mean_err), mean_err.shape)
+    return lamb_grid[i], lamb_q_grid[iq]
+
+
+if __name__ == "__main__":
+    with contextlib.redirect_stdout(io.StringIO()):
+        sp_graph = wolves_graph()
+    print("nodes={}, edges={}, observed={} (folds)".format(
+        len(sp_graph), sp_graph.size(), sp_graph.n_observed_nodes))
+
+    lamb_grid = np.geomspace(0.01, 100.0, 5)[::-1]
+    lamb_q_grid = np.geomspace(0.01, 100.0, 3)[::-1]
+    np.set_printoptions(precision=6, linewidth=120)
+
+    exact, t_exact = timed_cv(sp_graph, lamb_grid, lamb_q_grid)
+    print("\nexact loo: {:.1f}s, best lamb={:.3g} lamb_q={:.3g}".format(
+        t_exact, *best(exact, lamb_grid, lamb_q_grid)))
+    print(exact)
+
+    for loo_maxiter in (0, 10):
+        approx, t_approx = timed_cv(sp_graph, lamb_grid, lamb_q_grid,
+                                    approx_loo=True, loo_maxiter=loo_maxiter)
+        ok = ~np.isnan(exact) & ~np.isnan(approx)
+        print(
+            (
+                "\napprox loo (loo_maxiter={}): {:.1f}s, best lamb={:.3g} "
+                "lamb_q={:.3g}, corr with exact={:.3f}, max rel. dev={:.2e}"
+            ).format(
+                loo_maxiter, t_approx, *best(approx, lamb_grid, lamb_q_grid),
+                np.corrcoef(exact[ok], approx[ok])[0, 1],
+                np.max(np.abs(approx[ok] - exact[ok]) / exact[ok]),
+            )
+        )
+        print(approx)
@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+
+# Benchmark for the construction of the signed incidence matrix on the edges
+# (SpatialGraph.Delta) which is used by the smoothness penalty. Checks the
+# sparse builder against the original double loop on a small lattice and
+# times it on triangular lattices with up to ~10^5 edges.
+#
+# usage: python benchmarks/bench_incidence.py
+
+import time
+
+import networkx as nx
+import numpy as np
+import scipy.sparse as sp
+
+from feems.spatial_graph import edge_incidence_matrix
+
+
+def loop_incidence_matrix(nnz_idx):
+    """Original O(E^2) construction, kept here as the reference"""
+    n_edges = nnz_idx[0].shape[0]
+    data, row_idx, col_idx = [], [], []
+    n_count = 0
+    for i in range(n_edges):
+        edge1 = np.array([nnz_idx[0][i], nnz_idx[1][i]])
+        for j in range(i + 1, n_edges):
+            edge2 = np.array([nnz_idx[0][j], nnz_idx[1][j]])
+            if len(np.intersect1d(edge1, edge2)) > 0:
+                data += [1, -1]
+                row_idx += [n_count, n_count]
+                col_idx += [i, j]
+                n_count += 1
+    return sp.csc_matrix((data, (row_idx, col_idx)), shape=(n_count, n_edges))
+
+
+def lattice_nnz_idx(m, n):
+    graph = nx.convert_node_labels_to_integers(nx.triangular_lattice_graph(m, n))
+    adj_base = sp.triu(nx.adjacency_matrix(graph), k=1)
+    return adj_base.nonzero(), len(graph)
+
+
+if __name__ == "__main__":
+    # correctness against the reference loop
+    nnz_idx, n_nodes = lattice_nnz_idx(6, 8)
+    Delta = edge_incidence_matrix(nnz_idx, n_nodes)
+    Delta_ref = loop_incidence_matrix(nnz_idx)
+    assert Delta.shape == Delta_ref.shape
+    assert abs(Delta - Delta_ref).sum() == 0
+    print("matches reference loop on {} edges".format(nnz_idx[0].shape[0]))
+
+    for m in [16, 64, 128, 256, 320]:
+        nnz_idx, n_nodes = lattice_nnz_idx(m, m)
+        start = time.time()
+        Delta = edge_incidence_matrix(nnz_idx, n_nodes)
+        elapsed = time.time() - start
+        print(
+            "nodes={:d}, edges={:d}, pairs={:d}, time={:.3f}s".format(
+                n_nodes, nnz_idx[0].shape[0], Delta.shape[0], elapsed
+            )
+        )
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, division, print_function
 
 from .cross_validation import run_cv
+from .multilevel import fit_multilevel
+from .path import fit_path
 #from .feems_mix import FeemsMix
 from .objective import Objective, loss_wrapper, neg_log_lik_w0_s2
 from .spatial_graph import SpatialGraph, query_node_attributes
@@ -1,11 +1,16 @@
 import math
-from copy import deepcopy
+import os
+from concurrent.futures import ProcessPoolExecutor
+from copy import copy, deepcopy
 
 import numpy as np
 from sklearn.model_selection import KFold, GroupKFold
+from threadpoolctl import threadpool_limits
 
-from .objective import Objective, comp_mats
-from .spatial_graph import query_node_attributes
+from scipy.optimize import fmin_l_bfgs_b
+
+from .objective import Objective, comp_mats, loss_wrapper, loss_hvp
+from .spatial_graph import GenotypeRows, query_node_attributes, sample_indicator_matrix
 from .utils import cov_to_dist
 
 def run_cv(
@@ -20,8 +25,11 @@ def run_cv(
     outer_verbose=True,
     inner_verbose=False,
     alpha_fact=1.0, 
+    n_jobs=None,
+    blas_threads=None,
 ):
-    """Run cross-validation."""
+    """Run cross-validation. The folds are fit on n_jobs processes (-1 for
+    all cores) with blas_threads BLAS threads each, see map_folds."""
     # s2 initialization
     sp_graph.fit_null_model(verbose=inner_verbose)
     w0 = sp_graph.w0
@@ -36,64 +44,475 @@ def run_cv(
     # setup cv indicies
     is_train = setup_k_fold_cv(sp_graph, n_folds, random_state=random_state)
 
-    # CV error
+    # CV error (n_folds, n_lamb, n_alpha)
+    cv_err = map_folds(
+        cv_fold,
+        sp_graph,
+        is_train,
+        n_jobs=n_jobs,
+        blas_threads=blas_threads,
+        lamb_grid=lamb_grid,
+        alpha_grid=alpha_grid,
+        w0=w0,
+        s2=s2,
+        lb=lb,
+        ub=ub,
+        factr=factr,
+        outer_verbose=outer_verbose,
+        inner_verbose=inner_verbose,
+    )
+
+    return cv_err
+
+def cv_fold(
+    sp_graph,
+    is_train,
+    fold,
+    lamb_grid,
+    alpha_grid,
+    w0,
+    s2,
+    lb,
+    ub,
+    factr,
+    outer_verbose,
+    inner_verbose,
+):
+    """CV errors of one fold of run_cv, shape (n_lamb, n_alpha)"""
+    if outer_verbose:
+        print("\n fold: ", fold)
+
     n_lamb = lamb_grid.shape[0]
     n_alpha = alpha_grid.shape[0]
-    cv_err = np.empty((n_folds, n_lamb, n_alpha))
+    cv_err = np.empty((n_lamb, n_alpha))
 
-    # loop
-    for fold in range(n_folds):
-        if outer_verbose:
-            print("\n fold: ", fold)
-
-        # partition into train and test sets
-        if sp_graph.factor is not None:
-            sp_graph.factor = None
-        sp_graph_train, sp_graph_test = train_test_split(
-            sp_graph, 
-            is_train[:, fold]
+    # partition into train and test sets
+    sp_graph_train, sp_graph_test = train_test_split(
+        sp_graph, 
+        is_train
+    )
+
+    # set of initialization for warmstart
+    init_list = [w0]
+    for a, alpha in enumerate(alpha_grid):
+        w_init = init_list[-1]
+        s2_init = s2
+        for i, lamb in enumerate(lamb_grid):
+            if outer_verbose:
+                print(
+                    "\riteration lambda={}/{} alpha={}/{}".format(
+                        i + 1, n_lamb, a + 1, n_alpha
+                    ),
+                    end="",
+                )
+            # fit on train set
+            lamb = float(lamb)
+            alpha = float(alpha)
+            sp_graph_train.fit(
+                lamb=lamb,
+                optimize_q=None,
+                w_init=w_init,
+                s2_init=s2_init,  
+                alpha=alpha,
+                factr=factr,
+                lb=math.log(lb),
+                ub=math.log(ub),
+                verbose=inner_verbose,
+            )
+
+            # evaluate on the validation set
+            _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
+
+            cv_err[i, a] = err
+
+            w_init = deepcopy(sp_graph_train.w)
+            if i == 0:
+                init_list.append(w_init)
+
+    return cv_err
+
+def run_cv_joint(
+    sp_graph,
+    lamb_grid,
+    lamb_q_grid,
+    alpha_cv=None,
+    alpha_q=None,
+    n_folds=None,
+    lb=1e-6,
+    ub=1e6,
+    factr=1e10,
+    random_state=500,
+    outer_verbose=True,
+    inner_verbose=False,
+    alpha_fact=1.0,
+    n_jobs=None,
+    blas_threads=None,
+    approx_loo=False,
+    loo_maxiter=0,
+    loo_rank=20,
+): 
+    """Run cross validation on lamb & lamb_q, but holding alpha & alpha_q fixed at constant values (best-fit from constant model).
+    The folds are fit on n_jobs processes (-1 for all cores) with blas_threads BLAS threads each, see map_folds.
+    With approx_loo=True the folds are not refit, the fit of each fold is approximated from the fit on all demes
+    by an influence step with a rank loo_rank inverse hessian computed once per grid point (optionally polished by
+    at most loo_maxiter L-BFGS iterations, the folds still run on n_jobs processes), see approx_cv_joint."""
+    # s2 initialization
+    sp_graph.fit_null_model(verbose=inner_verbose)
+    w0 = sp_graph.w0
+    s2 = sp_graph.s2
+    if alpha_cv is None:
+        alpha_cv = alpha_fact / w0.mean()
+
+    # set alpha_q to inverse of mean heterozygosity (similar to weight penalty scheme)
+    if alpha_q is None:
+        alpha_q = alpha_fact / sp_graph.s2.mean()
+
+    # default is None i.e., leave-one-out CV
+    if n_folds is None:
+        n_folds = sp_graph.n_observed_nodes
+
+    # setup cv indicies
+    is_train = setup_k_fold_cv(sp_graph, n_folds, random_state=random_state)
+
+    if approx_loo:
+        return approx_cv_joint(
+            sp_graph,
+            is_train,
+            lamb_grid=lamb_grid,
+            lamb_q_grid=lamb_q_grid,
+            alpha_cv=alpha_cv,
+            alpha_q=alpha_q,
+            w0=w0,
+            s2=s2,
+            lb=lb,
+            ub=ub,
+            factr=factr,
+            outer_verbose=outer_verbose,
+            inner_verbose=inner_verbose,
+            loo_maxiter=loo_maxiter,
+            loo_rank=loo_rank,
+            random_state=random_state,
+            n_jobs=n_jobs,
+            blas_threads=blas_threads,
         )
 
-        # set of initialization for warmstart
-        init_list = [w0]
-        for a, alpha in enumerate(alpha_grid):
-            w_init = init_list[-1]
-            s2_init = s2
-            for i, lamb in enumerate(lamb_grid):
-                if outer_verbose:
-                    print(
-                        "\riteration lambda={}/{} alpha={}/{}".format(
-                            i + 1, n_lamb, a + 1, n_alpha
-                        ),
-                        end="",
-                    )
-                # fit on train set
-                lamb = float(lamb)
-                alpha = float(alpha)
+    # CV error (n_folds, n_lamb_q, n_lamb)
+    cv_err = map_folds(
+        cv_joint_fold,
+        sp_graph,
+        is_train,
+        n_jobs=n_jobs,
+        blas_threads=blas_threads,
+        lamb_grid=lamb_grid,
+        lamb_q_grid=lamb_q_grid,
+        alpha_cv=alpha_cv,
+        alpha_q=alpha_q,
+        w0=w0,
+        s2=s2,
+        lb=lb,
+        ub=ub,
+        factr=factr,
+        outer_verbose=outer_verbose,
+        inner_verbose=inner_verbose,
+    )
+
+    return cv_err
+
+def cv_joint_fold(
+    sp_graph,
+    is_train,
+    fold,
+    lamb_grid,
+    lamb_q_grid,
+    alpha_cv,
+    alpha_q,
+    w0,
+    s2,
+    lb,
+    ub,
+    factr,
+    outer_verbose,
+    inner_verbose,
+):
+    """CV errors of one fold of run_cv_joint, shape (n_lamb_q, n_lamb)"""
+    if outer_verbose:
+        print("\n fold: ", fold)
+
+    n_lamb = lamb_grid.shape[0]
+    n_lamb_q = lamb_q_grid.shape[0]
+    cv_err = np.empty((n_lamb_q, n_lamb))
+
+    # partition into train and test sets
+    sp_graph_train, sp_graph_test = train_test_split(
+        sp_graph, 
+        is_train
+    )
+
+    # set of initialization for warmstart
+    init_w_list = [w0] 
+    init_s2_list = [s2]
+    
+    for i, lw in enumerate(lamb_grid):
+    # for iq, lq in enumerate(lamb_q_grid):
+        w_init = init_w_list[-1]
+        # for i, lw in enumerate(lamb_grid):
+        for iq, lq in enumerate(lamb_q_grid):
+            s2_init = init_s2_list[-1]
+            if outer_verbose:
+                print(
+                    "\riteration lambda={}/{} lambda_q={}/{}".format(
+                        i + 1, n_lamb, iq + 1, n_lamb_q
+                    ),
+                    end="",
+                )
+            # fit on train set
+            try: 
                 sp_graph_train.fit(
-                    lamb=lamb,
-                    optimize_q=None,
+                    lamb=float(lw),
+                    lamb_q=float(lq), 
+                    optimize_q='n-dim', 
                     w_init=w_init,
-                    s2_init=s2_init,  
-                    alpha=alpha,
+                    s2_init=s2_init, 
+                    alpha_q=float(alpha_q), 
+                    alpha=float(alpha_cv),
                     factr=factr,
                     lb=math.log(lb),
                     ub=math.log(ub),
                     verbose=inner_verbose,
                 )
-
-                # evaluate on the validation set
                 _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
-    
-                cv_err[fold, i, a] = err
+                cv_err[iq, i] = err
+            except: 
+                cv_err[iq, i] = np.nan 
 
-                w_init = deepcopy(sp_graph_train.w)
-                if i == 0:
-                    init_list.append(w_init)
+            w_init = deepcopy(sp_graph_train.w)
+            s2_init = deepcopy(sp_graph_train.s2)
+            if i == 0:
+                init_w_list.append(w_init)
+                init_s2_list.append(s2_init)
 
     return cv_err
 
-def run_cv_joint(
+def approx_cv_joint(
+    sp_graph,
+    is_train,
+    lamb_grid,
+    lamb_q_grid,
+    alpha_cv,
+    alpha_q,
+    w0,
+    s2,
+    lb,
+    ub,
+    factr,
+    outer_verbose,
+    inner_verbose,
+    loo_maxiter=0,
+    loo_rank=20,
+    random_state=500,
+    n_jobs=None,
+    blas_threads=None,
+):
+    """Approximate (leave-one-deme-out) CV errors of run_cv_joint, shape
+    (n_folds, n_lamb_q, n_lamb). At each grid point the model is fit once on
+    all demes (on a copy, the graph is not modified) and the fit of each fold
+    is approximated from it by the influence function (newton) step
+
+        z_train = z_full - t * H_full^{-1} grad_train(z_full)
+
+    where H_full^{-1} is a rank loo_rank (nystrom) approximation of the
+    inverse hessian of the full objective, computed once per grid point from
+    loo_rank hessian-vector products (see nystrom_inverse_hessian) and
+    shared by the folds, so each fold costs one gradient. t is halved until
+    the train loss decreases (the held out deme contributes O(n_snps) to the
+    gradient so the full step can overshoot for small penalties). With
+    loo_maxiter > 0 the step is polished by at most loo_maxiter L-BFGS
+    iterations on the train objective. The error of the fold is then the
+    same predict_snps error as in the exact CV (with the residual variances
+    of the null model). The folds are run on n_jobs processes as in
+    map_folds. The approximation is meant for leave-one-out (the default
+    n_folds) where each fold removes a single deme
+    """
+    n_lamb = lamb_grid.shape[0]
+    n_lamb_q = lamb_q_grid.shape[0]
+    n_params = sp_graph.size() + len(sp_graph)
+    rank = min(loo_rank, n_params)
+
+    # fits on all demes with the same warm starts as cv_joint_fold, a failed
+    # fit is nan for all folds as in the exact CV
+    sp_graph_full = copy(sp_graph)
+    sp_graph_full.factor = None
+    z_grid = np.full((n_lamb_q, n_lamb, n_params), np.nan)
+    U_grid = np.zeros((n_lamb_q, n_lamb, n_params, rank))
+    evals_grid = np.ones((n_lamb_q, n_lamb, rank))
+    init_w_list = [w0]
+    init_s2_list = [s2]
+    for i, lw in enumerate(lamb_grid):
+        w_init = init_w_list[-1]
+        for iq, lq in enumerate(lamb_q_grid):
+            s2_init = init_s2_list[-1]
+            if outer_verbose:
+                print(
+                    "\rfull fit lambda={}/{} lambda_q={}/{}".format(
+                        i + 1, n_lamb, iq + 1, n_lamb_q
+                    ),
+                    end="",
+                )
+            try:
+                sp_graph_full.fit(
+                    lamb=float(lw),
+                    lamb_q=float(lq),
+                    optimize_q='n-dim',
+                    w_init=w_init,
+                    s2_init=s2_init,
+                    alpha_q=float(alpha_q),
+                    alpha=float(alpha_cv),
+                    factr=factr,
+                    lb=math.log(lb),
+                    ub=math.log(ub),
+                    verbose=inner_verbose,
+                )
+                w_init = deepcopy(sp_graph_full.w)
+                s2_init = deepcopy(sp_graph_full.s2)
+                z = np.r_[np.log(w_init), np.log(s2_init)]
+
+                obj = Objective(sp_graph_full)
+                obj.lamb, obj.alpha = float(lw), float(alpha_cv)
+                obj.lamb_q, obj.alpha_q = float(lq), float(alpha_q)
+                U_grid[iq, i], evals_grid[iq, i] = nystrom_inverse_hessian(
+                    z, obj, rank, random_state=random_state
+                )
+                z_grid[iq, i] = z
+            except:
+                pass
+
+            if i == 0:
+                init_w_list.append(w_init)
+                init_s2_list.append(s2_init)
+
+    # the folds are scored on a copy which keeps the null model fit (predict_snps
+    # updates the laplacian of the graph it is given)
+    sp_graph_cv = copy(sp_graph)
+    sp_graph_cv.factor = None
+    return map_folds(
+        approx_cv_joint_fold,
+        sp_graph_cv,
+        is_train,
+        n_jobs=n_jobs,
+        blas_threads=blas_threads,
+        z_grid=z_grid,
+        U_grid=U_grid,
+        evals_grid=evals_grid,
+        lamb_grid=lamb_grid,
+        lamb_q_grid=lamb_q_grid,
+        alpha_cv=alpha_cv,
+        alpha_q=alpha_q,
+        lb=lb,
+        ub=ub,
+        factr=factr,
+        outer_verbose=outer_verbose,
+        loo_maxiter=loo_maxiter,
+    )
+
+def approx_cv_joint_fold(
+    sp_graph,
+    is_train,
+    fold,
+    z_grid,
+    U_grid,
+    evals_grid,
+    lamb_grid,
+    lamb_q_grid,
+    alpha_cv,
+    alpha_q,
+    lb,
+    ub,
+    factr,
+    outer_verbose,
+    loo_maxiter,
+):
+    """Approximate CV errors of one fold of approx_cv_joint from the fits on
+    all demes z_grid and their inverse hessians (U_grid, evals_grid), shape
+    (n_lamb_q, n_lamb)"""
+    if outer_verbose:
+        print("\n fold: ", fold)
+
+    n_edges = sp_graph.size()
+    cv_err = np.full(z_grid.shape[:2], np.nan)
+    sp_graph_train, sp_graph_test = train_test_split(sp_graph, is_train)
+    sp_graph_train.optimize_q = 'n-dim'
+    obj_train = Objective(sp_graph_train)
+    obj_train.alpha, obj_train.alpha_q = float(alpha_cv), float(alpha_q)
+
+    for i, lw in enumerate(lamb_grid):
+        for iq, lq in enumerate(lamb_q_grid):
+            z = z_grid[iq, i]
+            if np.isnan(z).any():
+                continue
+            # a failed fold is nan as in the exact CV
+            try:
+                obj_train.lamb, obj_train.lamb_q = float(lw), float(lq)
+
+                # influence step with backtracking
+                loss, grad = loss_wrapper(z, obj_train)
+                step = -inverse_hessian_dot(U_grid[iq, i], evals_grid[iq, i], grad)
+                t = 1.0
+                while t > 1e-3 and (
+                    loss_wrapper(z + t * step, obj_train)[0]
+                    > loss + 1e-4 * t * (grad @ step)
+                ):
+                    t /= 2
+                z_train = z + t * step
+
+                if loo_maxiter > 0:
+                    z_train = fmin_l_bfgs_b(
+                        func=loss_wrapper,
+                        x0=z_train,
+                        args=[obj_train],
+                        factr=factr,
+                        maxiter=loo_maxiter,
+                    )[0]
+                z_train[:n_edges] = np.clip(
+                    z_train[:n_edges], math.log(lb), math.log(ub)
+                )
+                sp_graph_train.w = np.exp(z_train[:n_edges])
+                sp_graph_train.comp_precision(s2=np.exp(z_train[n_edges:]))
+                _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
+                cv_err[iq, i] = err
+            except:
+                cv_err[iq, i] = np.nan
+
+    return cv_err
+
+def nystrom_inverse_hessian(z, obj, rank, random_state=500):
+    """Low rank (nystrom) approximation of the hessian of loss_wrapper at z,
+    H ~ U diag(evals) U^T, from rank hessian-vector products along random
+    orthonormal directions (finite differences of the gradient, no p x p
+    matrix). The fits are stopped early by factr so the hessian isn't always
+    positive definite, the eigenvalues of the sketch are floored
+
+    Returns:
+        U (:obj:`numpy.ndarray`): p x rank orthonormal eigenvectors
+        evals (:obj:`numpy.ndarray`): eigenvalues in decreasing order
+    """
+    rng = np.random.RandomState(random_state)
+    omega, _ = np.linalg.qr(rng.normal(size=(z.shape[0], rank)))
+    Y = np.column_stack([loss_hvp(z, omega[:, j], obj) for j in range(rank)])
+    core = omega.T @ Y
+    core_evals, core_evecs = np.linalg.eigh(0.5 * (core + core.T))
+    core_evals = np.maximum(core_evals, 1e-8 * np.abs(core_evals).max())
+    U, sv, _ = np.linalg.svd(Y @ (core_evecs / np.sqrt(core_evals)),
+                             full_matrices=False)
+    return U, np.maximum(sv ** 2, 1e-8 * sv[0] ** 2)
+
+def inverse_hessian_dot(U, evals, g):
+    """Applies the inverse of the nystrom approximation of the hessian
+    (U, evals) to g, the complement of U is scaled by the smallest retained
+    eigenvalue"""
+    c = U.T @ g
+    return U @ (c / evals) + (g - U @ c) / evals[-1]
+
+def search_cv_joint(
     sp_graph,
     lamb_grid,
     lamb_q_grid,
@@ -103,20 +522,51 @@ def run_cv_joint(
     lb=1e-6,
     ub=1e6,
     factr=1e10,
+    factr_low=1e12,
+    min_folds=2,
+    eta=3,
     random_state=500,
     outer_verbose=True,
     inner_verbose=False,
-    alpha_fact=1.0
-): 
-    """Run cross validation on lamb & lamb_q, but holding alpha & alpha_q fixed at constant values (best-fit from constant model)"""
+    alpha_fact=1.0,
+    n_jobs=None,
+    blas_threads=None,
+):
+    """Adaptive (successive halving) search over the grid of run_cv_joint.
+    All (lamb, lamb_q) pairs are first evaluated on min_folds folds with a
+    loose factr_low, then only the best 1 / eta are kept and evaluated on
+    eta times more folds with a tighter factr, until the last round which
+    uses all the folds and factr. Before the last round the grid neighbours
+    of the best pair are added back so the choice is refined around the
+    optimum, and it is the argmin of the mean CV error over all folds among
+    the pairs of the last round. If the rounds could take as many fits as
+    the full grid (small grids or few folds, counting the refinement at its
+    largest) the full grid is run instead as in run_cv_joint
+
+    Args:
+        sp_graph, lamb_grid, lamb_q_grid, alpha_cv, alpha_q, n_folds, lb,
+            ub, factr, random_state, alpha_fact, n_jobs, blas_threads: see
+            run_cv_joint (the folds are the same)
+        factr_low (:obj:`float`): tolerance of the fits of the first round
+        min_folds (:obj:`int`): number of folds of the first round
+        eta (:obj:`int`): fraction of the pairs kept after each round and
+            factor of increase of the number of folds
+
+    Returns:
+        search (:obj:`dict`): lamb_cv and lamb_q_cv, mean CV errors of the
+            last round (n_lamb_q, n_lamb) with nan for the pairs dropped
+            before, the number of fits n_fits (and n_fits_grid of
+            run_cv_joint) and the pairs, folds and factr of each round
+    """
+    assert eta >= 2, "eta must be at least 2"
+    assert factr_low >= factr, "factr_low must be at least factr"
+
     # s2 initialization
     sp_graph.fit_null_model(verbose=inner_verbose)
     w0 = sp_graph.w0
     s2 = sp_graph.s2
     if alpha_cv is None:
         alpha_cv = alpha_fact / w0.mean()
-
-    # set alpha_q to inverse of mean heterozygosity (similar to weight penalty scheme)
     if alpha_q is None:
         alpha_q = alpha_fact / sp_graph.s2.mean()
 
@@ -124,68 +574,216 @@ def run_cv_joint(
     if n_folds is None:
         n_folds = sp_graph.n_observed_nodes
 
-    # setup cv indicies
+    # setup cv indicies, the folds of each round are the first ones of a
+    # fixed permutation
     is_train = setup_k_fold_cv(sp_graph, n_folds, random_state=random_state)
+    fold_order = np.random.RandomState(random_state).permutation(n_folds)
+
+    # number of folds and tolerance of each round, the last round takes all
+    # the folds when another increase by eta would overshoot
+    folds_per_round = [min(min_folds, n_folds)]
+    while folds_per_round[-1] < n_folds:
+        if folds_per_round[-1] * eta ** 2 > n_folds:
+            folds_per_round.append(n_folds)
+        else:
+            folds_per_round.append(folds_per_round[-1] * eta)
+    n_rounds = len(folds_per_round)
+    factr_per_round = np.geomspace(factr_low, factr, n_rounds) if n_rounds > 1 else [factr]
 
     n_lamb = lamb_grid.shape[0]
     n_lamb_q = lamb_q_grid.shape[0]
-    cv_err = np.empty((n_folds, n_lamb_q, n_lamb))
-
-    # loop
-    for fold in range(n_folds):
+    pairs = [(i, iq) for i in range(n_lamb) for iq in range(n_lamb_q)]
+    n_fits_grid = n_folds * n_lamb * n_lamb_q
+
+    # largest number of fits of the rounds, the refinement adds at most the
+    # neighbours of the best pair
+    n_pairs, n_fits_max = len(pairs), 0
+    for r in range(n_rounds):
+        if r == n_rounds - 1 and r > 0:
+            n_pairs = min(
+                len(pairs),
+                n_pairs + min(n_lamb, 3) * min(n_lamb_q, 3) - 1
+            )
+        n_fits_max += n_pairs * folds_per_round[r]
+        n_pairs = max(1, int(math.ceil(n_pairs / eta)))
+
+    if n_fits_max >= n_fits_grid:
         if outer_verbose:
-            print("\n fold: ", fold)
-
-        # partition into train and test sets
-        if sp_graph.factor is not None:
-            sp_graph.factor = None
-        sp_graph_train, sp_graph_test = train_test_split(
-            sp_graph, 
-            is_train[:, fold]
+            print("\n the search would not save fits, running the full grid")
+        cv_err = map_folds(
+            cv_joint_fold,
+            sp_graph,
+            is_train,
+            n_jobs=n_jobs,
+            blas_threads=blas_threads,
+            lamb_grid=lamb_grid,
+            lamb_q_grid=lamb_q_grid,
+            alpha_cv=alpha_cv,
+            alpha_q=alpha_q,
+            w0=w0,
+            s2=s2,
+            lb=lb,
+            ub=ub,
+            factr=factr,
+            outer_verbose=outer_verbose,
+            inner_verbose=inner_verbose,
         )
+        mean_cv_err_grid = np.nanmean(cv_err, axis=0)
+        iq_best, i_best = np.unravel_index(
+            np.argmin(np.where(np.isnan(mean_cv_err_grid), np.inf, mean_cv_err_grid)),
+            mean_cv_err_grid.shape,
+        )
+        return {
+            "lamb_cv": lamb_grid[i_best],
+            "lamb_q_cv": lamb_q_grid[iq_best],
+            "mean_cv_err": mean_cv_err_grid,
+            "n_fits": n_fits_grid,
+            "n_fits_grid": n_fits_grid,
+            "rounds": [{
+                "pairs": pairs,
+                "n_folds": n_folds,
+                "factr": factr,
+                "mean_cv_err": np.array([mean_cv_err_grid[iq, i] for i, iq in pairs]),
+            }],
+        }
+
+    rounds = []
+    n_fits = 0
+    for r in range(n_rounds):
+        if r == n_rounds - 1 and r > 0:
+            # refine, add the grid neighbours of the best pair
+            i_best, iq_best = pairs[0]
+            pairs = sorted(set(pairs) | {
+                (i, iq)
+                for i in range(max(i_best - 1, 0), min(i_best + 2, n_lamb))
+                for iq in range(max(iq_best - 1, 0), min(iq_best + 2, n_lamb_q))
+            })
+
+        folds = fold_order[: folds_per_round[r]]
+        if outer_verbose:
+            print(
+                "\n round {}/{}: {} pairs, {} folds, factr={:.1e}".format(
+                    r + 1, n_rounds, len(pairs), len(folds), factr_per_round[r]
+                )
+            )
+        cv_err = map_folds(
+            cv_pairs_fold,
+            sp_graph,
+            is_train[:, folds],
+            n_jobs=n_jobs,
+            blas_threads=blas_threads,
+            lamb_grid=lamb_grid,
+            lamb_q_grid=lamb_q_grid,
+            pairs=pairs,
+            alpha_cv=alpha_cv,
+            alpha_q=alpha_q,
+            w0=w0,
+            s2=s2,
+            lb=lb,
+            ub=ub,
+            factr=factr_per_round[r],
+            outer_verbose=outer_verbose,
+            inner_verbose=inner_verbose,
+        )
+        n_fits += cv_err.size
+        mean_cv_err = np.nanmean(cv_err, axis=0)
+        rounds.append({
+            "pairs": pairs,
+            "n_folds": len(folds),
+            "factr": factr_per_round[r],
+            "mean_cv_err": mean_cv_err,
+        })
+
+        # keep the best pairs (nan i.e., failed fits last)
+        order = np.argsort(np.where(np.isnan(mean_cv_err), np.inf, mean_cv_err), kind="stable")
+        n_keep = max(1, int(math.ceil(len(pairs) / eta)))
+        if r < n_rounds - 1:
+            pairs = [pairs[k] for k in order[:n_keep]]
+
+    i_best, iq_best = pairs[order[0]]
+    mean_cv_err_grid = np.full((n_lamb_q, n_lamb), np.nan)
+    for (i, iq), err in zip(pairs, rounds[-1]["mean_cv_err"]):
+        mean_cv_err_grid[iq, i] = err
+
+    return {
+        "lamb_cv": lamb_grid[i_best],
+        "lamb_q_cv": lamb_q_grid[iq_best],
+        "mean_cv_err": mean_cv_err_grid,
+        "n_fits": n_fits,
+        "n_fits_grid": n_fits_grid,
+        "rounds": rounds,
+    }
+
+def cv_pairs_fold(
+    sp_graph,
+    is_train,
+    fold,
+    lamb_grid,
+    lamb_q_grid,
+    pairs,
+    alpha_cv,
+    alpha_q,
+    w0,
+    s2,
+    lb,
+    ub,
+    factr,
+    outer_verbose,
+    inner_verbose,
+):
+    """CV errors of one fold of search_cv_joint at the (lamb, lamb_q) grid
+    indicies in pairs, visited and warm started as in cv_joint_fold (the
+    same fits on the full grid): the fits of the first lamb are chained and
+    every later lamb restarts from the last fit of the first lamb (only the
+    weights are then chained along lamb_q)"""
+    if outer_verbose:
+        print("\n fold: ", fold)
+
+    cv_err = np.empty(len(pairs))
+
+    # partition into train and test sets
+    sp_graph_train, sp_graph_test = train_test_split(
+        sp_graph,
+        is_train
+    )
+
+    # set of initialization for warmstart
+    init_w_list = [w0]
+    init_s2_list = [s2]
 
-        # set of initialization for warmstart
-        init_w_list = [w0] 
-        init_s2_list = [s2]
-        
-        for i, lw in enumerate(lamb_grid):
-        # for iq, lq in enumerate(lamb_q_grid):
+    order = sorted(range(len(pairs)), key=lambda k: pairs[k])
+    i_first = pairs[order[0]][0] if len(order) > 0 else None
+    i_prev = None
+    for k in order:
+        i, iq = pairs[k]
+        if i != i_prev:
             w_init = init_w_list[-1]
-            # for i, lw in enumerate(lamb_grid):
-            for iq, lq in enumerate(lamb_q_grid):
-                s2_init = init_s2_list[-1]
-                if outer_verbose:
-                    print(
-                        "\riteration lambda={}/{} lambda_q={}/{}".format(
-                            i + 1, n_lamb, iq + 1, n_lamb_q
-                        ),
-                        end="",
-                    )
-                # fit on train set
-                try: 
-                    sp_graph_train.fit(
-                        lamb=float(lw),
-                        lamb_q=float(lq), 
-                        optimize_q='n-dim', 
-                        w_init=w_init,
-                        s2_init=s2_init, 
-                        alpha_q=float(alpha_q), 
-                        alpha=float(alpha_cv),
-                        factr=factr,
-                        lb=math.log(lb),
-                        ub=math.log(ub),
-                        verbose=inner_verbose,
-                    )
-                    _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
-                    cv_err[fold, iq, i] = err
-                except: 
-                    cv_err[fold, iq, i] = np.nan 
-
-                w_init = deepcopy(sp_graph_train.w)
-                s2_init = deepcopy(sp_graph_train.s2)
-                if i == 0:
-                    init_w_list.append(w_init)
-                    init_s2_list.append(s2_init)
+            i_prev = i
+        s2_init = init_s2_list[-1]
+        try:
+            sp_graph_train.fit(
+                lamb=float(lamb_grid[i]),
+                lamb_q=float(lamb_q_grid[iq]),
+                optimize_q='n-dim',
+                w_init=w_init,
+                s2_init=s2_init,
+                alpha_q=float(alpha_q),
+                alpha=float(alpha_cv),
+                factr=factr,
+                lb=math.log(lb),
+                ub=math.log(ub),
+                verbose=inner_verbose,
+            )
+            _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
+            cv_err[k] = err
+        except:
+            cv_err[k] = np.nan
+
+        w_init = deepcopy(sp_graph_train.w)
+        s2_init = deepcopy(sp_graph_train.s2)
+        if i == i_first:
+            init_w_list.append(w_init)
+            init_s2_list.append(s2_init)
 
     return cv_err
 
@@ -202,9 +800,12 @@ def run_cvq(
     random_state=500,
     outer_verbose=True,
     inner_verbose=False,
-    alpha_fact=1.0
+    alpha_fact=1.0,
+    n_jobs=None,
+    blas_threads=None,
 ): 
-    """Run cross validation on lamb_q & alpha_q, but holding lamb & alpha constant at previously found values."""
+    """Run cross validation on lamb_q & alpha_q, but holding lamb & alpha constant at previously found values.
+    The folds are fit on n_jobs processes (-1 for all cores) with blas_threads BLAS threads each, see map_folds."""
     
     assert lamb_cv is not None, "provide CV lambda value as float"
     assert lamb_cv >= 0.0, "lambda must be non-negative"
@@ -227,58 +828,153 @@ def run_cvq(
     if alpha_q_grid is None:
         alpha_q_grid = alpha_fact / sp_graph.s2.mean()
 
+    # CV error (n_folds, n_lamb_q, n_alpha_q)
+    cv_err = map_folds(
+        cvq_fold,
+        sp_graph,
+        is_train,
+        n_jobs=n_jobs,
+        blas_threads=blas_threads,
+        lamb_q_grid=lamb_q_grid,
+        alpha_q_grid=alpha_q_grid,
+        lamb_cv=lamb_cv,
+        alpha_cv=alpha_cv,
+        w0=w0,
+        s2=s2,
+        lb=lb,
+        ub=ub,
+        factr=factr,
+        outer_verbose=outer_verbose,
+        inner_verbose=inner_verbose,
+    )
+
+    return cv_err
+
+def cvq_fold(
+    sp_graph,
+    is_train,
+    fold,
+    lamb_q_grid,
+    alpha_q_grid,
+    lamb_cv,
+    alpha_cv,
+    w0,
+    s2,
+    lb,
+    ub,
+    factr,
+    outer_verbose,
+    inner_verbose,
+):
+    """CV errors of one fold of run_cvq, shape (n_lamb_q, n_alpha_q)"""
+    if outer_verbose:
+        print("\n fold=", fold)
+
     n_lamb = lamb_q_grid.shape[0]
     n_alpha = alpha_q_grid.shape[0]
-    cv_err = np.empty((n_folds, n_lamb, n_alpha))
+    cv_err = np.empty((n_lamb, n_alpha))
 
-    # loop
-    for fold in range(n_folds):
-        if outer_verbose:
-            print("\n fold=", fold)
-
-        # partition into train and test sets
-        if sp_graph.factor is not None:
-            sp_graph.factor = None
-        sp_graph_train, sp_graph_test = train_test_split(
-            sp_graph, 
-            is_train[:, fold]
-        )
+    # partition into train and test sets
+    sp_graph_train, sp_graph_test = train_test_split(
+        sp_graph, 
+        is_train
+    )
 
-        # set of initialization for warmstart
-        init_list = [w0]
-        for a, alpha in enumerate(alpha_q_grid):
-            w_init = init_list[-1]
-            s2_init = s2
-            for i, lamb in enumerate(lamb_q_grid):
-                if outer_verbose:
-                    print(
-                        "\riteration lambda={}/{} alpha={}/{}".format(
-                            i + 1, n_lamb, a + 1, n_alpha
-                        ),
-                        end="",
-                    )
-                # fit on train set
-                sp_graph_train.fit(
-                    lamb=float(lamb_cv),
-                    w_init=w_init,
-                    s2_init=s2_init, 
-                    optimize_q='n-dim', lamb_q=lamb, alpha_q=float(alpha), 
-                    alpha=float(alpha_cv),
-                    factr=factr,
-                    lb=math.log(lb),
-                    ub=math.log(ub),
-                    verbose=inner_verbose,
+    # set of initialization for warmstart
+    init_list = [w0]
+    for a, alpha in enumerate(alpha_q_grid):
+        w_init = init_list[-1]
+        s2_init = s2
+        for i, lamb in enumerate(lamb_q_grid):
+            if outer_verbose:
+                print(
+                    "\riteration lambda={}/{} alpha={}/{}".format(
+                        i + 1, n_lamb, a + 1, n_alpha
+                    ),
+                    end="",
                 )
+            # fit on train set
+            sp_graph_train.fit(
+                lamb=float(lamb_cv),
+                w_init=w_init,
+                s2_init=s2_init, 
+                optimize_q='n-dim', lamb_q=lamb, alpha_q=float(alpha), 
+                alpha=float(alpha_cv),
+                factr=factr,
+                lb=math.log(lb),
+                ub=math.log(ub),
+                verbose=inner_verbose,
+            )
+
+            # evaluate on the validation set
+            _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
+            cv_err[i, a] = err
+
+            w_init = deepcopy(sp_graph_train.w)
+            if i == 0:
+                init_list.append(w_init)
 
-                # evaluate on the validation set
-                _, err = predict_snps(sp_graph, sp_graph_train, sp_graph_test)
-                cv_err[fold, i, a] = err
+    return cv_err
 
-                w_init = deepcopy(sp_graph_train.w)
-                if i == 0:
-                    init_list.append(w_init)
+# graph of the worker processes of map_folds, sent once per worker instead of
+# once per fold
+_fold_graph = None
+_fold_limits = None
 
-    return cv_err
+def _init_fold_worker(sp_graph, blas_threads):
+    global _fold_graph, _fold_limits
+    _fold_graph = sp_graph
+    _fold_limits = threadpool_limits(limits=blas_threads, user_api="blas")
+
+def _run_fold_worker(fit_fold, is_train, fold, kwargs):
+    return fit_fold(_fold_graph, is_train, fold, **kwargs)
+
+def map_folds(fit_fold, sp_graph, is_train, n_jobs=None, blas_threads=None, **kwargs):
+    """Fits the folds of a cross-validation serially or on a process pool.
+    Each fold only depends on the full graph (after the null model fit) and
+    its train indicies, so the errors are the same as the serial run, they
+    are stacked in the order of the folds
+
+    Args:
+        fit_fold (:obj:`function`): module level function (picklable) taking
+            the graph, train indicies, fold index and kwargs, e.g. cv_fold
+        sp_graph (:obj:`SpatialGraph`): SpatialGraph class, pickled once per
+            worker (the cholmod factor is dropped and recomputed)
+        is_train (:obj:`numpy.ndarray`): n x k train indicies of the folds
+        n_jobs (:obj:`int`): number of processes, None or 1 to run in this
+            process and -1 for all cores
+        blas_threads (:obj:`int`): BLAS threads per worker (or of this
+            process for a serial run), by default the cores are split
+            between the workers and a serial run is not limited
+
+    Returns:
+        cv_err (:obj:`numpy.ndarray`): errors of the folds along the first axis
+    """
+    n_folds = is_train.shape[1]
+    if n_jobs is None or n_jobs == 1 or n_folds == 1:
+        with threadpool_limits(limits=blas_threads, user_api="blas"):
+            return np.stack([
+                fit_fold(sp_graph, is_train[:, fold], fold, **kwargs)
+                for fold in range(n_folds)
+            ])
+
+    n_cpus = os.cpu_count() or 1
+    if n_jobs < 0:
+        n_jobs = n_cpus
+    n_jobs = min(n_jobs, n_folds)
+    if blas_threads is None:
+        blas_threads = max(1, n_cpus // n_jobs)
+
+    with ProcessPoolExecutor(
+        max_workers=n_jobs,
+        initializer=_init_fold_worker,
+        initargs=(sp_graph, blas_threads),
+    ) as pool:
+        futures = [
+            pool.submit(_run_fold_worker, fit_fold, is_train[:, fold], fold, kwargs)
+            for fold in range(n_folds)
+        ]
+        return np.stack([future.result() for future in futures])
 
 def setup_k_fold_cv(sp_graph, n_splits=5, random_state=12):
     """Setup cross-validation indicies.
@@ -324,15 +1020,20 @@ def copy_spatial_graph(sp_graph, subsample_idx):
     Returns:
         sp_graph_copy (:obj:`SpatialGraph`): SpatialGraph class
     """
-    sp_graph_copy = deepcopy(sp_graph)
-    # add spatial coordinates to node attributes
-    for i in range(len(sp_graph_copy)):
-        sp_graph_copy.nodes[i]["n_samples"] = 0
-        sp_graph_copy.nodes[i]["sample_idx"] = []
+    assert sp_graph.genotypes is not None, (
+        "cross-validation requires the individual genotypes (e.g. not a graph "
+        "built with SpatialGraph.from_bed)"
+    )
+
+    # shallow copy, the graph structure and operators are shared
+    sp_graph_copy = copy(sp_graph)
 
+    # reuse the assignment of the full graph instead of querying the nodes again
     sp_graph_copy.sample_pos = sp_graph.sample_pos[subsample_idx]
     sp_graph_copy._assign_samples_to_nodes(
-        sp_graph_copy.sample_pos, sp_graph_copy.node_pos
+        sp_graph_copy.sample_pos,
+        sp_graph_copy.node_pos,
+        assned_node_idx=sp_graph.assned_node_idx[subsample_idx],
     )
     sp_graph_copy._permute_nodes()
 
@@ -343,11 +1044,23 @@ def copy_spatial_graph(sp_graph, subsample_idx):
         : sp_graph_copy.n_observed_nodes
     ]
     sp_graph_copy._create_perm_diag_op()  # create perm operator
+    # the observed nodes differ so L11 has a new sparsity pattern, the symbolic
+    # analysis is looked up (or computed) on the next laplacian update
     sp_graph_copy.factor = None
 
-    # estimate allele frequencies at observed locations (in permuted order)
-    sp_graph_copy.genotypes = sp_graph.genotypes[subsample_idx, :]
-    sp_graph_copy._estimate_allele_frequencies()
+    # the genotypes of the copy are a view of the rows of the full matrix.
+    # The allele frequencies at observed locations (in permuted order) are
+    # estimated directly from the full matrix, only the indicator matrix is
+    # rebuilt (expanded to all of its rows) so the genotypes are never copied
+    sp_graph_copy.genotypes = GenotypeRows(sp_graph.genotypes, subsample_idx)
+    sp_graph_copy._comp_sample_indicator()
+    genotypes = sp_graph_copy.genotypes.genotypes
+    deme_idx = np.full(genotypes.shape[0], -1)
+    deme_idx[sp_graph_copy.genotypes.rows] = sp_graph_copy.sample_deme_idx
+    sp_graph_copy._estimate_allele_frequencies(
+        genotypes,
+        sample_indicator_matrix(deme_idx, sp_graph_copy.n_observed_nodes),
+    )
 
     if sp_graph.scale_snps:
         sp_graph_copy.frequencies = sp_graph_copy.frequencies / np.sqrt(
@@ -358,9 +1071,7 @@ def copy_spatial_graph(sp_graph, subsample_idx):
     sp_graph_copy.comp_precision(s2=1)
 
     # estimate sample covariance matrix
-    sp_graph_copy.S = (
-        sp_graph_copy.frequencies @ sp_graph_copy.frequencies.T / sp_graph_copy.n_snps
-    )
+    sp_graph_copy._comp_sample_covariance()
 
     return sp_graph_copy
 
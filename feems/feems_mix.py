@@ -151,7 +151,7 @@ class FeemsMix:
 
     def _search_hull(self, n, max_res_nodes, lamb_cv):
         # TODO: put a progress bar
-        spl = dict(nx.all_pairs_shortest_path_length(self.graph[n],cutoff=4))
+        spl = dict(nx.all_pairs_shortest_path_length(self.graph[n].nx_graph,cutoff=4))
 
         # get closest (within distance 3) AND sampled nodes to create a set of nodes to search over
         n1 = [k for (k, v) in spl[max_res_nodes[0][0]].items() if v>0 and v<4 and k in np.array(np.where(query_node_attributes(self.graph[n],"n_samples")>0))]
@@ -183,11 +183,11 @@ class FeemsMix:
         self.graph[n].remove_edge(*mrn)
         self.graph[n].add_edge(*new_mrn)
         
-        self.graph[n].Delta_q = nx.incidence_matrix(self.graph[1], oriented=True).T.tocsc()
-        self.graph[n].adj_base = sp.triu(nx.adjacency_matrix(self.graph[n]), k=1)
+        self.graph[n].Delta_q = nx.incidence_matrix(self.graph[1].nx_graph, oriented=True).T.tocsc()
+        self.graph[n].adj_base = sp.triu(self.graph[n].adj_csr, k=1)
         self.graph[n].nnz_idx = self.graph[n].adj_base.nonzero()
         self.graph[n].Delta = self.graph[n]._create_incidence_matrix()
-        self.graph[n].diag_oper = self.graph[n]._create_vect_matrix()
+        self.graph[n]._create_perm_diag_op()
         self.graph[n].w = np.ones(self.graph[n].size())
         self.graph[n].comp_grad_w()
 
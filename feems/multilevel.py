@@ -0,0 +1,136 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+import time
+
+import numpy as np
+from sklearn.neighbors import KDTree
+
+from .spatial_graph import query_node_attributes
+
+
+def lookup_coordinates(pos, metric="euclidean"):
+    """Coordinates in which nearest neighbors are looked up, the positions
+    for planar coordinates and points on the unit sphere for (long., lat.)
+    in degrees (chord distance is monotone in the great circle distance and
+    there is no wrap around at the dateline)
+    """
+    if metric != "haversine":
+        return np.asarray(pos, dtype=np.float64)
+    lon, lat = np.radians(pos[:, 0]), np.radians(pos[:, 1])
+    return np.column_stack(
+        (np.cos(lat) * np.cos(lon), np.cos(lat) * np.sin(lon), np.sin(lat))
+    )
+
+
+def edge_midpoints(sp_graph):
+    """Midpoints of the edges of the graph (in the order of sp_graph.w) in
+    the lookup coordinates
+    """
+    pos = lookup_coordinates(query_node_attributes(sp_graph, "pos"), sp_graph.metric)
+    row, col = sp_graph.nnz_idx
+    return (pos[row] + pos[col]) / 2
+
+
+def prolong(coarse, fine):
+    """Prolongs the fitted edge weights and residual variances of the coarse
+    graph onto the fine graph, each fine edge (node) gets the value of the
+    closest coarse edge (node). The weights depend on the spacing of the
+    grid so only the spatial pattern of the log-weights (and log-s2) is
+    prolonged, their mean is taken from the null model of the fine graph
+    (fine.w0 and fine.s2 from fit_null_model)
+
+    Required:
+        coarse (:obj:`feems.SpatialGraph`): fitted graph on the coarse grid
+        fine (:obj:`feems.SpatialGraph`): graph on the fine grid
+
+    Returns:
+        w_init (:obj:`numpy.ndarray`): weights on the edges of fine
+        s2_init (:obj:`numpy.ndarray`): residual variances of fine (one per
+            node in the permuted order, or the single value of coarse)
+    """
+    tree = KDTree(edge_midpoints(coarse))
+    idx = tree.query(edge_midpoints(fine), k=1, return_distance=False)[:, 0]
+    log_w = np.log(coarse.w)[idx]
+    w_init = np.exp(log_w - log_w.mean() + np.log(fine.w0).mean())
+
+    s2 = np.atleast_1d(coarse.s2)
+    if s2.shape[0] != len(coarse):
+        return w_init, fine.s2
+    # s2 is in the permuted order of the nodes on both graphs
+    coarse_pos = query_node_attributes(coarse, "pos")[coarse.perm_idx]
+    fine_pos = query_node_attributes(fine, "pos")[fine.perm_idx]
+    tree = KDTree(lookup_coordinates(coarse_pos, coarse.metric))
+    idx = tree.query(lookup_coordinates(fine_pos, fine.metric), k=1,
+                     return_distance=False)[:, 0]
+    log_s2 = np.log(s2)[idx]
+    return w_init, np.exp(log_s2 - log_s2.mean() + np.log(np.mean(fine.s2)))
+
+
+def fit_multilevel(sp_graphs, lamb, lamb_q=None, alpha=None, alpha_q=None,
+                   optimize_q='n-dim', verbose=True, **fit_kwargs):
+    """Fits the graphs from the coarsest to the finest grid, each level is
+    initialized by prolonging the fit of the previous level (the first from
+    the null model). The penalties of each level are the same as in
+    SpatialGraph.fit (alpha and alpha_q from its null model), so the finest
+    level converges to the same optimum as a direct fit
+
+    Required:
+        sp_graphs (:obj:`list` of :obj:`feems.SpatialGraph`): graphs of the
+            same samples on grids from coarse to fine e.g. grid_500,
+            grid_250 and grid_100
+        lamb (:obj:`float`): penalty strength on weights
+
+    Optional:
+        lamb_q, alpha, alpha_q, optimize_q: see SpatialGraph.fit
+        verbose (:obj:`Bool`): print the timings of each level
+        fit_kwargs: passed to SpatialGraph.fit
+
+    Returns:
+        levels (:obj:`list` of :obj:`dict`): per level the number of nodes
+            and edges, the time of the null model, prolongation and fit,
+            the number of L-BFGS iterations and the train loss
+    """
+    levels = []
+    coarse = None
+    for level, sp_graph in enumerate(sp_graphs):
+        start = time.time()
+        sp_graph.fit_null_model(verbose=False)
+        level_alpha = 1.0 / sp_graph.w0.mean() if alpha is None else alpha
+        level_alpha_q = 1.0 / np.mean(sp_graph.s2) if alpha_q is None else alpha_q
+        t_null = time.time() - start
+
+        start = time.time()
+        if coarse is None:
+            w_init, s2_init = sp_graph.w0, sp_graph.s2
+        else:
+            w_init, s2_init = prolong(coarse, sp_graph)
+        t_prolong = time.time() - start
+
+        start = time.time()
+        sp_graph.fit(lamb=lamb, lamb_q=lamb_q, w_init=w_init, s2_init=s2_init,
+                     alpha=level_alpha, alpha_q=level_alpha_q,
+                     optimize_q=optimize_q, **fit_kwargs)
+        t_fit = time.time() - start
+
+        levels.append({
+            "level": level,
+            "n_nodes": len(sp_graph),
+            "n_edges": sp_graph.size(),
+            "time_null": t_null,
+            "time_prolong": t_prolong,
+            "time_fit": t_fit,
+            "n_iter": sp_graph.n_iter,
+            "train_loss": sp_graph.train_loss,
+        })
+        if verbose:
+            sys.stdout.write(
+                (
+                    "level {:d}: nodes={:d}, edges={:d}, null={:.2f}s, "
+                    "prolong={:.2f}s, fit={:.2f}s, {:d} iterations, "
+                    "train_loss={:.3f}\n"
+                ).format(level, len(sp_graph), sp_graph.size(), t_null,
+                         t_prolong, t_fit, sp_graph.n_iter, sp_graph.train_loss)
+            )
+        coarse = sp_graph
+    return levels
@@ -1,12 +1,14 @@
 from __future__ import absolute_import, division, print_function
 
 # import allel
+from collections import OrderedDict
 from copy import deepcopy
+import hashlib
 import itertools as it
 import networkx as nx
 import numpy as np
 import pandas as pd
-from scipy.linalg import det, pinvh
+from scipy.linalg import det, eigh, pinvh, cho_factor, cho_solve, lu_factor, lu_solve
 import scipy.sparse as sp
 from scipy.optimize import minimize
 from scipy.stats import wishart, norm, chi2
@@ -14,15 +16,22 @@ from scipy.stats import wishart, norm, chi2
 from .utils import cov_to_dist, dist_to_cov, benjamini_hochberg, get_outlier_idx
 
 class Objective(object):
-    def __init__(self, sp_graph):
+    def __init__(self, sp_graph, dtype=np.float64):
         """Evaluations and gradient of the feems objective function
 
         Args:
             sp_graph (:obj:`feems.SpatialGraph`): feems spatial graph object
+            dtype (:obj:`numpy.dtype`): precision of the dense matrix products
+                in the gradient (float64 or float32), the factorizations,
+                log-determinant and loss are always computed in float64
         """
         # spatial graph
         self.sp_graph = sp_graph
 
+        # precision of the bulk matrix products
+        self.dtype = np.dtype(dtype)
+        assert self.dtype in (np.float32, np.float64), "dtype must be float32 or float64"
+
         # reg params
         self.lamb = None
         self.alpha = None
@@ -38,6 +47,87 @@ class Objective(object):
 
         self.CDCt = self.C @ self.sp_graph.Dhat @ self.C.T
 
+        # stochastic mode: sparse solves and randomized trace estimates with
+        # n_probes probe vectors drawn from probe_seed instead of the dense
+        # o x o inverses (see stochastic_lbfgs in spatial_graph)
+        self.stochastic = False
+        self.n_probes = 30
+        self.probe_seed = 0
+
+        # LRU cache of loss / gradient evaluations in loss_wrapper (set
+        # cache_size to 0 to disable)
+        self.cache_size = 4
+        self._cache = OrderedDict()
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # attributes of the graph set by comp_graph_laplacian / comp_precision
+    _cached_graph_attrs = (
+        "m", "w", "W", "D", "L", "L_block", "factor", "s2", "q", "q_diag",
+        "q_inv_diag", "q_inv_grad",
+    )
+
+    def _cache_key(self, z):
+        """Hash of the parameters and the settings the loss depends on"""
+        h = hashlib.sha1()
+        h.update(np.ascontiguousarray(z, dtype=np.float64).tobytes())
+        settings = (
+            self.lamb, self.alpha, self.lamb_q, self.alpha_q,
+            self.sp_graph.optimize_q, self.sp_graph.option, self.sp_graph.edge,
+            self.dtype.str, self.stochastic, self.n_probes, self.probe_seed,
+        )
+        h.update(repr(settings).encode())
+        c = self.sp_graph.c if self.sp_graph.c is not None else []
+        h.update(np.asarray(c, dtype=np.float64).tobytes())
+        return h.hexdigest()
+
+    def _cache_lookup(self, z):
+        """Returns the cached (loss, grad) at z and restores the inverses /
+        graph laplacian of that evaluation, None if z is not cached
+        """
+        if self.cache_size == 0:
+            return None
+        key = self._cache_key(z)
+        if key not in self._cache:
+            self.cache_misses += 1
+            return None
+        self.cache_hits += 1
+        self._cache.move_to_end(key)
+        loss, grad, obj_state, graph_state = self._cache[key]
+        self.__dict__.update(obj_state)
+        for name, value in graph_state.items():
+            setattr(self.sp_graph, name, _restore_state(value))
+        return loss, grad.copy()
+
+    def _cache_store(self, z, loss, grad):
+        """Stores an evaluation, the arrays of the objective are recomputed
+        on each evaluation so references are enough but the sparse matrices
+        of the graph are updated in place so their data is copied
+        """
+        if self.cache_size == 0:
+            return
+        obj_state = {
+            k: v for k, v in self.__dict__.items()
+            if k not in ("sp_graph", "_cache", "cache_hits", "cache_misses", "cache_size")
+        }
+        graph_state = {
+            name: _snapshot_state(getattr(self.sp_graph, name))
+            for name in self._cached_graph_attrs if hasattr(self.sp_graph, name)
+        }
+        self._cache[self._cache_key(z)] = (loss, grad.copy(), obj_state, graph_state)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def cache_info(self):
+        """Hits, misses and current size of the loss / gradient cache"""
+        return {"hits": self.cache_hits, "misses": self.cache_misses, "size": len(self._cache)}
+
+    def _lowp(self, A):
+        """Casts A to the precision of the bulk matrix products (no copy in
+        float64)
+        """
+        return A.astype(self.dtype, copy=False)
+
     def _rank_one_solver(self, B):
         """Solver for linear system (L_{d-o,d-o} + ones/d) * X = B using rank
         ones update equation
@@ -96,20 +186,12 @@ class Objective(object):
         ## Eqn 16 (pg. 23)
         self.L_double_inv = self.sp_graph.L_block["oo"].toarray() + 1.0 / d - A - B
 
+        # factor once, reused for the inverse and the log-determinant
+        self.L_double_inv_factor = spd_factor(self.L_double_inv)
+
     def _comp_diag_pinv(self):
-        """Compute the diagonal of the pseudo-inverse using LU decomposition."""
-        n = len(self.sp_graph)
-        L_mod = self.sp_graph.L + np.eye(n) / n  # Make L invertible
-        LU = sp.linalg.splu(sp.csc_matrix(L_mod))
-        
-        diag = np.zeros(n); ei = np.zeros(n)
-        for i in range(n):
-            ei[i] = 1
-            xi = LU.solve(ei)
-            diag[i] = xi[i]
-            ei[i] = 0
-        
-        return diag - 1  # Correct for the added identity matrix
+        """Compute the diagonal of the pseudo-inverse using selected inversion."""
+        return self.sp_graph.comp_diag_pinv()
         
     def _comp_inv_lap(self, B=None):
         """Computes submatrices of inverse of lap"""
@@ -119,16 +201,20 @@ class Objective(object):
         # inverse of graph laplacian
         # compute o-by-o submatrix of inverse of lap
         self.Linv_block = {}
-        self.Linv_block["oo"] = np.linalg.solve(self.L_double_inv, B)
+        self.Linv_block["oo"] = spd_solve(self.L_double_inv_factor, B)
         # compute (d-o)-by-o submatrix of inverse of lap
-        self.Linv_block["do"] = -self.lap_sol @ self.Linv_block["oo"]
+        self.Linv_block["do"] = -(
+            self._lowp(self.lap_sol) @ self._lowp(self.Linv_block["oo"])
+        )
 
         # store the diagonal elements of the (d-o) elements
         if self.sp_graph.option == 'onlyc':
             self.Linv_diag = self._comp_diag_pinv()
 
         # stack the submatrices
-        self.Linv = np.vstack((self.Linv_block["oo"], self.Linv_block["do"]))
+        self.Linv = np.vstack(
+            (self._lowp(self.Linv_block["oo"]), self.Linv_block["do"])
+        )
 
     def _comp_inv_cov(self, B=None):
         """Computes inverse of the covariance matrix"""
@@ -140,14 +226,35 @@ class Objective(object):
         if B is None:
             B = np.eye(self.sp_graph.n_observed_nodes)
 
-        # solve o-by-o linear system to get X
-        self.X = np.linalg.solve(A, B)
+        # solve o-by-o linear system to get X, -A = Q^-1 (Q + L_double_inv) Q^-1
+        # is s.p.d. so its cholesky factor is used (and kept for the logdet)
+        self.neg_A_factor = spd_factor(-A)
+        self.X = -spd_solve(self.neg_A_factor, B)
 
         # inverse covariance matrix
         self.inv_cov = self.X + np.diag(self.sp_graph.q)
         self.inv_cov_sum = self.inv_cov.sum(axis=0)
         self.denom = self.inv_cov_sum.sum()
 
+    def _comp_grad_obj_L(self, M):
+        """Computes the entries of dLoss / dL = n_snps * Linv @ M @ Linv.T
+        that the gradient needs, the diagonal and the edges (nnz_idx_perm), as
+        row-wise dot products of Linv @ M (d x o) with Linv instead of forming
+        the dense d x d matrix
+        """
+        LinvM = self.Linv @ M
+        row, col = self.sp_graph.nnz_idx_perm
+        diag = np.einsum("ij,ij->i", LinvM, self.Linv).astype(np.float64, copy=False)
+        edges = np.einsum("ij,ij->i", LinvM[row], self.Linv[col]).astype(np.float64, copy=False)
+        return self.sp_graph.n_snps * diag, self.sp_graph.n_snps * edges
+
+    def _comp_grad_degree(self, diag):
+        """Maps the diagonal of dLoss / dL onto the edges, i.e. the degree of
+        both endpoints of an edge changes with its weight
+        """
+        row, col = self.sp_graph.nnz_idx_perm
+        return diag[row] + diag[col]
+
     def _comp_grad_obj(self):
         """Computes the gradient of the objective function with respect to the
         latent variables dLoss / dL
@@ -155,16 +262,16 @@ class Objective(object):
         # compute inverses
         self._comp_inv_lap()
 
-        self.comp_B = self.inv_cov - (1.0 / self.denom) * np.outer(
+        self.comp_B = self._lowp(self.inv_cov - (1.0 / self.denom) * np.outer(
             self.inv_cov_sum, self.inv_cov_sum
-        )
-        self.comp_A = self.comp_B @ self.sp_graph.S @ self.comp_B
+        ))
+        self.comp_A = self.comp_B @ self._lowp(self.sp_graph.S) @ self.comp_B
         M = self.comp_A - self.comp_B
-        self.grad_obj_L = self.sp_graph.n_snps * (self.Linv @ M @ self.Linv.T)
+        grad_obj_L_diag, grad_obj_L_edges = self._comp_grad_obj_L(M)
 
         # grads
-        gradD = np.diag(self.grad_obj_L) @ self.sp_graph.P
-        gradW = 2 * self.grad_obj_L[self.sp_graph.nnz_idx_perm]  # use symmetry
+        gradD = self._comp_grad_degree(grad_obj_L_diag)
+        gradW = 2 * grad_obj_L_edges  # use symmetry
         self.grad_obj = gradD - gradW
 
         # grads for d diag(Jq^-1) / dq
@@ -237,10 +344,10 @@ class Objective(object):
             self.comp_A = self.comp_B @ self.sp_graph.S @ self.comp_B
             M = self.comp_A - self.comp_B
             
-        self.grad_obj_L = self.sp_graph.n_snps * (self.Linv @ M @ self.Linv.T)
+        grad_obj_L_diag, grad_obj_L_edges = self._comp_grad_obj_L(M)
 
-        gradD = np.diag(self.grad_obj_L) @ self.sp_graph.P
-        gradW = 2 * self.grad_obj_L[self.sp_graph.nnz_idx_perm]  # use symmetry
+        gradD = self._comp_grad_degree(grad_obj_L_diag)
+        gradW = 2 * grad_obj_L_edges  # use symmetry
         self.grad_obj = np.ravel(gradD - gradW)
         
         # grads for d diag(Jq^-1) / dq
@@ -277,8 +384,93 @@ class Objective(object):
             self.grad_pen_q = self.sp_graph.Delta_q.T @ self.sp_graph.Delta_q @ (lamb_q * term)
             self.grad_pen_q = self.grad_pen_q * (alpha_q / (1 - np.exp(-alpha_q * self.sp_graph.s2)))
 
+    def _stochastic_inv(self):
+        """Sparse cholesky factors of L + 11^T/d and of K = L + 11^T/d +
+        diag(q) on the observed nodes, which replace the dense inverses in the
+        stochastic mode. The log-determinant is exact as the schur complements
+        onto the observed nodes share the block of the unobserved nodes
+        """
+        o = self.sp_graph.n_observed_nodes
+        self.lap_factor = self.sp_graph.comp_grounded_factor()
+        self.cov_factor = self.sp_graph.comp_grounded_factor(q=self.sp_graph.q)
+        self.inv_cov_sum = self._inv_cov_matvec(np.ones(o))
+        self.denom = self.inv_cov_sum.sum()
+        self.logdet = (
+            self.lap_factor.logdet()
+            - self.cov_factor.logdet()
+            + np.sum(np.log(self.sp_graph.q))
+        )
+
+    def _inv_cov_matvec(self, X):
+        """inv_cov @ X = Q X - Q (K^-1)_{o,o} Q X by one sparse solve"""
+        o = self.sp_graph.n_observed_nodes
+        QX = _scale_rows(self.sp_graph.q, X)
+        Y = np.zeros((len(self.sp_graph),) + X.shape[1:])
+        Y[:o] = QX
+        return QX - _scale_rows(self.sp_graph.q, self.cov_factor(Y)[:o])
+
+    def _proj_matvec(self, X):
+        """comp_B @ X, i.e. inv_cov projected orthogonal to the ones"""
+        return (
+            self._inv_cov_matvec(X)
+            - np.multiply.outer(self.inv_cov_sum, self.inv_cov_sum @ X) / self.denom
+        )
+
+    def _lap_matvec(self, X):
+        """Linv @ X, the observed columns of (L + 11^T/d)^-1 times X"""
+        Y = np.zeros((len(self.sp_graph),) + X.shape[1:])
+        Y[: self.sp_graph.n_observed_nodes] = X
+        return self.lap_factor(Y)
+
+    def _probes(self):
+        """Probe vectors V for tr(S @ comp_B) ~ tr(V^T S comp_B V) (Hutch++
+        with the sketch taken on S, so V only depends on the data and the seed
+        and the estimate is a smooth function of the parameters)
+        """
+        if getattr(self, "_probe_key", None) != (self.probe_seed, self.n_probes):
+            rng = np.random.default_rng(self.probe_seed)
+            self._probe_V = hutchpp_probes(self.sp_graph.S, self.n_probes, rng)
+            self._probe_SV = self.sp_graph.S @ self._probe_V
+            self._probe_key = (self.probe_seed, self.n_probes)
+        return self._probe_V, self._probe_SV
+
+    def _stochastic_neg_log_lik(self):
+        """Negative log-likelihood with tr(S @ comp_B) estimated by Hutch++"""
+        o = self.sp_graph.n_observed_nodes
+        V, SV = self._probes()
+        self.tr = np.sum(SV * self._proj_matvec(V))
+        return self.sp_graph.n_snps * (self.tr - self.logdet - np.log(o / self.denom))
+
+    def _stochastic_grad_obj(self):
+        """Gradient of the stochastic objective, dLoss / dL = n_snps * Linv M
+        Linv^T on the edges with M = B S B - B estimated by B V V^T (S B - I)
+        using the probes of the trace. Both terms share the probes so the
+        noise vanishes with M (at the optimum) instead of adding up
+        """
+        V, SV = self._probes()
+        BV = self._proj_matvec(V)
+        R = self._proj_matvec(SV) - V
+        a, b = self._lap_matvec(BV), self._lap_matvec(R)
+        row, col = self.sp_graph.nnz_idx_perm
+        self.grad_obj = self.sp_graph.n_snps * np.einsum(
+            "ij,ij->i", a[row] - a[col], b[row] - b[col]
+        )
+
+        # grads for d diag(Jq^-1) / dq
+        diag_M = np.einsum("ij,ij->i", BV, R)
+        o = self.sp_graph.n_observed_nodes
+        if self.sp_graph.optimize_q == 'n-dim':
+            self.grad_obj_q = np.zeros(len(self.sp_graph))
+            self.grad_obj_q[:o] = self.sp_graph.n_snps * (diag_M @ self.sp_graph.q_inv_grad)
+        elif self.sp_graph.optimize_q == '1-dim':
+            self.grad_obj_q = self.sp_graph.n_snps * (diag_M @ self.sp_graph.q_inv_grad)
+
     def inv(self):
         """Computes relevant inverses for gradient computations"""
+        if self.stochastic:
+            self._stochastic_inv()
+            return
+
         # compute inverses
         self._solve_lap_sys()
         self._comp_mat_block_inv()
@@ -287,7 +479,9 @@ class Objective(object):
     def grad(self, reg=True):
         """Computes relevent gradients the objective"""
         # compute derivatives
-        if self.sp_graph.option == 'default':
+        if self.sp_graph.option == 'default' and self.stochastic:
+            self._stochastic_grad_obj()
+        elif self.sp_graph.option == 'default':
             self._comp_grad_obj()
         elif self.sp_graph.option == 'onlyc':
             self._comp_grad_obj_c()
@@ -298,20 +492,27 @@ class Objective(object):
     def neg_log_lik(self):
         """Evaluate the negative log-likelihood function given the current
         params"""
+        if self.stochastic:
+            return self._stochastic_neg_log_lik()
 
         o = self.sp_graph.n_observed_nodes
-        self.trA = self.sp_graph.S @ self.inv_cov
 
-        # trace
-        self.trB = self.inv_cov_sum @ self.trA.sum(axis=1)
-        self.tr = np.trace(self.trA) - self.trB / self.denom
+        # trace, tr(S @ inv_cov) without forming the product (both symmetric)
+        self.trB = self.inv_cov_sum @ (self.sp_graph.S @ self.inv_cov_sum)
+        self.tr = np.sum(self.sp_graph.S * self.inv_cov) - self.trB / self.denom
 
         # det
         # E = self.X + np.diag(self.sp_graph.q)
         # self.det = np.linalg.det(self.inv_cov) * o / self.denom
 
         # VS: made a change here to accommodate larger data sets (was leading to overflow without the log)
-        self.logdet = np.linalg.slogdet(self.inv_cov)[1]
+        # inv_cov = Q (Q + L_double_inv)^-1 L_double_inv, so the logdet follows
+        # from the factors computed in inv() without another factorization
+        self.logdet = (
+            spd_logdet(self.L_double_inv_factor)
+            - spd_logdet(self.neg_A_factor)
+            - np.sum(np.log(self.sp_graph.q))
+        )
 
         # negative log-likelihood
         # nll = self.sp_graph.n_snps * (self.tr - np.log(self.det))
@@ -427,6 +628,69 @@ class Objective(object):
 
         return np.array(resmat)
 
+def spd_factor(A):
+    """Factors the symmetric positive definite matrix A (cholesky) so the
+    factor can be reused for solves and the log-determinant, falls back to
+    an LU factorization if A is not numerically positive definite
+    """
+    try:
+        return ("cholesky", cho_factor(A, lower=True))
+    except np.linalg.LinAlgError:
+        return ("lu", lu_factor(A))
+
+
+def spd_solve(factor, B):
+    """Solves A X = B given the factor of A from spd_factor"""
+    kind, f = factor
+    if kind == "cholesky":
+        return cho_solve(f, B)
+    return lu_solve(f, B)
+
+
+def spd_logdet(factor):
+    """Log-determinant of A given the factor of A from spd_factor"""
+    kind, f = factor
+    if kind == "cholesky":
+        return 2 * np.sum(np.log(np.diag(f[0])))
+    return np.sum(np.log(np.abs(np.diag(f[0]))))
+
+
+def _scale_rows(v, X):
+    """diag(v) @ X for a vector or matrix X"""
+    return (v * X.T).T
+
+
+def rademacher(shape, rng):
+    """Random +-1 probe vectors"""
+    return 2.0 * rng.integers(0, 2, size=shape) - 1.0
+
+
+def hutchpp_probes(Y, n_probes, rng):
+    """Probe vectors V such that tr(A) ~ tr(V^T A V) (Hutch++): an orthonormal
+    basis Q of the range of Y @ Omega, on which the trace is exact, and
+    rademacher vectors deflated by Q for the rest (Hutchinson)
+
+    Args:
+        Y (:obj:`numpy.ndarray`): n x n matrix whose range is sketched,
+            e.g. A itself or a fixed matrix close to it
+        n_probes (:obj:`int`): number of probe vectors, a third of them
+            (at most n) sketch the range of Y
+        rng (:obj:`numpy.random.Generator`): random number generator
+
+    Returns:
+        V (:obj:`numpy.ndarray`): n x k probe vectors
+    """
+    n = Y.shape[0]
+    m = min(max(n_probes // 3, 1), n)
+    Q, _ = np.linalg.qr(Y @ rademacher((n, m), rng))
+    if m == n:
+        return Q
+    n_rest = max(n_probes - m, 1)
+    G = rademacher((n, n_rest), rng)
+    G -= Q @ (Q.T @ G)
+    return np.hstack((Q, G / np.sqrt(n_rest)))
+
+
 def neg_log_lik_w0_s2(z, obj):
     """Computes negative log likelihood for a constant w and residual variance"""
     z = np.clip(z, -20, 20)
@@ -443,9 +707,79 @@ def neg_log_lik_w0_s2(z, obj):
     return nll
 
 
+def comp_null_spectrum(obj):
+    """Spectrum of the null model: for a constant weight w the laplacian is
+    w * L1 (L1 with unit weights) so the covariance of the contrasts C is
+    C L1^+ C^T / w + s2 * C N^-1 C^T (N the sample sizes). The generalized
+    eigendecomposition of the two matrices, computed once, makes the
+    likelihood a sum over the eigenvalues for any (w, s2)
+
+    Returns:
+        lam (:obj:`numpy.ndarray`): generalized eigenvalues
+        t (:obj:`numpy.ndarray`): C S C^T in the eigenvector basis (diagonal)
+    """
+    sp_graph = obj.sp_graph
+    sp_graph.comp_graph_laplacian(np.ones(sp_graph.size()))
+    obj._solve_lap_sys()
+    obj._comp_mat_block_inv()
+    obj._comp_inv_lap()
+    C = obj.C
+    R = C @ obj.Linv_block["oo"] @ C.T
+    D = (C / sp_graph.n_samples_per_obs_node_permuted) @ C.T
+    lam, V = eigh(R, D)
+    t = np.einsum("ij,ij->j", V, (C @ sp_graph.S @ C.T) @ V)
+    return lam, t
+
+
+def neg_log_lik_w0_s2_spectral(z, lam, t, n_snps):
+    """Negative log likelihood for a constant w and residual variance (up to
+    a constant) from the null model spectrum, with the gradient and hessian
+    with respect to z = (log(w), log(s2))
+    """
+    a = lam * np.exp(-z[0])
+    b = np.exp(z[1])
+    m = a + b
+    nll = n_snps * np.sum(t / m + np.log(m))
+
+    # derivatives w.r.t. m, dm / dz = (-a, b)
+    g = n_snps * (1.0 / m - t / m ** 2)
+    h = n_snps * (2 * t / m ** 3 - 1.0 / m ** 2)
+    grad = np.array([-np.sum(g * a), np.sum(g) * b])
+    hess = np.array([
+        [np.sum(h * a ** 2 + g * a), -np.sum(h * a) * b],
+        [-np.sum(h * a) * b, np.sum(h) * b ** 2 + np.sum(g) * b],
+    ])
+    return nll, grad, hess
+
+
+def _snapshot_state(value):
+    """Copies the data of sparse matrices (possibly in a dict) along with a
+    reference to the matrix
+    """
+    if sp.issparse(value):
+        return ("sparse", value, value.data.copy())
+    if isinstance(value, dict):
+        return ("dict", {k: _snapshot_state(v) for k, v in value.items()})
+    return ("value", value)
+
+
+def _restore_state(state):
+    """Writes back the data saved by _snapshot_state"""
+    if state[0] == "sparse":
+        state[1].data[:] = state[2]
+        return state[1]
+    if state[0] == "dict":
+        return {k: _restore_state(v) for k, v in state[1].items()}
+    return state[1]
+
+
 def loss_wrapper(z, obj):
     """Wrapper function to optimize z=log(w,q) which returns the loss and gradient
     (v2.0: changed to include node-specific variances as parameters)"""                
+    cached = obj._cache_lookup(z)
+    if cached is not None:
+        return cached
+
     n_edges = obj.sp_graph.size()
     if obj.sp_graph.optimize_q is not None:
         z = np.clip(z, -20, 20)
@@ -475,8 +809,22 @@ def loss_wrapper(z, obj):
         grad[:n_edges] = obj.grad_obj * obj.sp_graph.w + obj.grad_pen * obj.sp_graph.w
         grad[n_edges:] = obj.grad_obj_q * obj.sp_graph.s2    
 
+    obj._cache_store(z, loss, grad)
     return (loss, grad)
 
+def loss_hvp(z, v, obj, eps=1e-5):
+    """Hessian of loss_wrapper at z applied to v, by a forward difference of
+    the gradient along v (one extra gradient instead of forming the hessian).
+    The graph is left at z"""
+    _, grad = loss_wrapper(z, obj)
+    v_norm = np.linalg.norm(v)
+    if v_norm == 0:
+        return np.zeros_like(v)
+    h = eps / v_norm
+    hv = (loss_wrapper(z + h * v, obj)[1] - grad) / h
+    loss_wrapper(z, obj)
+    return hv
+
 def comp_mats(obj):
     """Compute fitted covariance matrix and its inverse & empirical convariance matrix"""
     obj.inv()
@@ -499,10 +847,11 @@ def comp_mats(obj):
         mu0 = frequencies_ns.mean(axis=0) / 2 # compute mean of allele frequencies in the original scale
         mu = 2*mu0 / np.sqrt(sp_graph.mu*(1-sp_graph.mu))
         frequencies_centered = sp_graph.frequencies - mu
+        emp_cov = frequencies_centered @ frequencies_centered.T / n_snps
     else:
-        frequencies_centered = sp_graph.frequencies
-
-    emp_cov = frequencies_centered @ frequencies_centered.T / n_snps
+        # same as frequencies @ frequencies.T / n_snps but also handles missing
+        # data and graphs built from S without the frequencies
+        emp_cov = sp_graph.S
     
     return fit_cov, inv_cov, emp_cov
 
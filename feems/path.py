@@ -0,0 +1,166 @@
+from __future__ import absolute_import, division, print_function
+
+import sys
+
+import numpy as np
+from scipy.optimize import fmin_l_bfgs_b
+
+from .objective import Objective, loss_wrapper
+
+
+class PathResult(object):
+    def __init__(self, lamb_grid, lamb_q_grid, n_edges, n_s2):
+        """Solutions of SpatialGraph.fit over a grid of penalties, stored in
+        arrays indexed like the cv errors of run_cv_joint i.e., (lamb_q, lamb)
+
+        Required:
+            lamb_grid (:obj:`numpy.ndarray`): penalties on the weights
+            lamb_q_grid (:obj:`numpy.ndarray`): penalties on the residual
+                variances
+            n_edges (:obj:`int`): number of edges
+            n_s2 (:obj:`int`): number of residual variances
+        """
+        self.lamb_grid = np.asarray(lamb_grid, dtype=np.float64)
+        self.lamb_q_grid = np.asarray(lamb_q_grid, dtype=np.float64)
+        shape = (self.lamb_q_grid.shape[0], self.lamb_grid.shape[0])
+        self.log_w = np.full(shape + (n_edges,), np.nan)
+        self.log_s2 = np.full(shape + (n_s2,), np.nan)
+        self.train_loss = np.full(shape, np.nan)
+        self.n_iter = np.zeros(shape, dtype=np.int64)
+        # False where the fit was skipped because the path had stabilized,
+        # the solution there is copied from the previous lambda
+        self.fitted = np.zeros(shape, dtype=bool)
+
+    @property
+    def shape(self):
+        return self.train_loss.shape
+
+    @property
+    def nbytes(self):
+        return sum(a.nbytes for a in (self.log_w, self.log_s2, self.train_loss,
+                                      self.n_iter, self.fitted))
+
+    def solution(self, i, iq):
+        """Edge weights and residual variances at lamb_grid[i], lamb_q_grid[iq]"""
+        return np.exp(self.log_w[iq, i]), np.exp(self.log_s2[iq, i])
+
+    def set_graph(self, sp_graph, i, iq):
+        """Sets the weights and residual variances of the graph to a solution"""
+        w, s2 = self.solution(i, iq)
+        sp_graph.w = w
+        sp_graph.s2 = s2
+        sp_graph.comp_graph_laplacian(w)
+        sp_graph.comp_precision(s2=s2)
+
+
+def fit_path(sp_graph, lamb_grid, lamb_q_grid, alpha=None, alpha_q=None,
+             optimize_q='n-dim', factr=1e7, m=10, maxls=50, maxiter=15000,
+             stab_tol=None, patience=2, verbose=False):
+    """Fits the graph over a grid of penalties. The null model is fit once,
+    every grid point shares one Objective (and the symbolic factorization
+    of the laplacian) and is fit like SpatialGraph.fit (fmin_l_bfgs_b on
+    loss_wrapper, which clips the log weights and log s2 to [-20, 20])
+    started from the solution of its neighbour: the previous lamb, or for the
+    first lamb the first solution of the previous lamb_q (the same warm starts
+    as run_cv_joint).
+    If stab_tol is given, along a lamb_q row the fits stop once the solution
+    changes by less than stab_tol (max abs change of the log weights and log
+    s2) for patience grid points in a row, the rest of the row gets the last
+    solution (and its loss at the penalties of the grid point)
+
+    Required:
+        sp_graph (:obj:`feems.SpatialGraph`): graph
+        lamb_grid (:obj:`numpy.ndarray`): penalties on the weights, ordered
+            as they should be visited e.g. from large to small
+        lamb_q_grid (:obj:`numpy.ndarray`): penalties on the residual
+            variances
+
+    Optional:
+        alpha, alpha_q, optimize_q: see SpatialGraph.fit
+        factr, m, maxls, maxiter: see fmin_l_bfgs_b
+        stab_tol (:obj:`float`): change of the solution below which the path
+            has stabilized, by default None i.e., all grid points are fit
+        patience (:obj:`int`): number of stable grid points before stopping
+        verbose (:obj:`Bool`): print a line per grid point
+
+    Returns:
+        path (:obj:`feems.path.PathResult`): solutions, the graph is left at
+            the last fitted grid point
+    """
+    lamb_grid = np.atleast_1d(np.asarray(lamb_grid, dtype=np.float64))
+    lamb_q_grid = np.atleast_1d(np.asarray(lamb_q_grid, dtype=np.float64))
+    assert np.all(lamb_grid >= 0), "lamb must be >= 0"
+    assert np.all(lamb_q_grid >= 0), "lamb_q must be >= 0"
+    assert optimize_q in ("n-dim", "1-dim", None), "unknown optimize_q"
+
+    sp_graph.option = "default"
+    sp_graph.fit_null_model(verbose=False)
+    if alpha is None:
+        alpha = 1.0 / sp_graph.w0.mean()
+    if alpha_q is None:
+        alpha_q = 1.0 / np.mean(sp_graph.s2)
+
+    sp_graph.optimize_q = optimize_q
+    obj = Objective(sp_graph)
+    obj.alpha, obj.alpha_q = alpha, alpha_q
+
+    n_edges = sp_graph.size()
+    if optimize_q is None:
+        x0 = np.log(sp_graph.w0)
+    elif optimize_q == "1-dim":
+        x0 = np.r_[np.log(sp_graph.w0), np.log(np.atleast_1d(sp_graph.s2)[:1])]
+    else:
+        x0 = np.r_[np.log(sp_graph.w0), np.log(sp_graph.s2 * np.ones(len(sp_graph)))]
+    path = PathResult(lamb_grid, lamb_q_grid, n_edges, x0.shape[0] - n_edges)
+
+    row_start = x0
+    for iq, lq in enumerate(lamb_q_grid):
+        x = row_start
+        n_stable = 0
+        for i, lw in enumerate(lamb_grid):
+            obj.lamb, obj.lamb_q = float(lw), float(lq)
+            if stab_tol is not None and n_stable >= patience:
+                # the penalized loss depends on lamb so it is evaluated at
+                # the copied solution
+                path.log_w[iq, i] = path.log_w[iq, i - 1]
+                path.log_s2[iq, i] = path.log_s2[iq, i - 1]
+                path.train_loss[iq, i] = loss_wrapper(x, obj)[0]
+                continue
+
+            x_new, f, d = fmin_l_bfgs_b(
+                func=loss_wrapper,
+                x0=x,
+                args=[obj],
+                factr=factr,
+                m=m,
+                maxls=maxls,
+                maxiter=maxiter,
+                approx_grad=False,
+            )
+            if stab_tol is not None:
+                n_stable = n_stable + 1 if np.max(np.abs(x_new - x)) < stab_tol else 0
+            x = x_new
+            if i == 0:
+                row_start = x
+
+            path.log_w[iq, i] = x[:n_edges]
+            path.log_s2[iq, i] = x[n_edges:]
+            path.train_loss[iq, i] = f
+            path.n_iter[iq, i] = d["nit"]
+            path.fitted[iq, i] = True
+            if verbose:
+                sys.stdout.write(
+                    (
+                        "lambda={:.3e}, lambda_q={:.3e}, "
+                        "converged in {} iterations, "
+                        "train_loss={:.3f}\n"
+                    ).format(lw, lq, d["nit"], f)
+                )
+
+    # leave the graph at the last fitted solution
+    sp_graph.w = np.exp(x[:n_edges])
+    sp_graph.comp_graph_laplacian(sp_graph.w)
+    if optimize_q is not None:
+        sp_graph.s2 = np.exp(x[n_edges:])
+        sp_graph.comp_precision(s2=sp_graph.s2)
+    return path
@@ -1,5 +1,8 @@
 from __future__ import absolute_import, division, print_function
 
+from collections import OrderedDict
+import hashlib
+import os
 import sys
 
 from copy import copy, deepcopy
@@ -10,25 +13,59 @@ import numpy as np
 from scipy.linalg import pinvh
 from scipy.optimize import fmin_l_bfgs_b, minimize
 import scipy.sparse as sp
+import scipy.sparse.linalg as spla
 from scipy.stats import chi2, norm
 from sklearn.mixture import GaussianMixture
-import sksparse.cholmod as cholmod
+from sklearn.neighbors import BallTree, KDTree
+try:
+    import sksparse.cholmod as cholmod
+except ImportError:  # only the iterative solver (set_solver("pcg")) is available
+    cholmod = None
 import pandas as pd
 from statsmodels.distributions.empirical_distribution import ECDF
 
 import matplotlib.pyplot as plt
 
-from .objective import Objective, loss_wrapper, neg_log_lik_w0_s2, comp_mats, interpolate_q
+from .objective import (Objective, loss_wrapper, neg_log_lik_w0_s2, comp_mats, interpolate_q,
+                        comp_null_spectrum, neg_log_lik_w0_s2_spectral)
+from .path import fit_path
 from .utils import cov_to_dist, dist_to_cov, benjamini_hochberg, parametric_bootstrap
 
-class SpatialGraph(nx.Graph):
-    def __init__(self, genotypes, sample_pos, node_pos, edges, scale_snps=True):
+# bump when the layout of the cached graph operators changes
+GRAPH_CACHE_VERSION = 1
+
+# code of a missing genotype in the compact (int8) genotype storage
+GENOTYPE_MISSING = -1
+
+# symbolic cholmod analyses (fill-reducing ordering) keyed by the sparsity
+# pattern of L_block["dd"], shared by all graphs e.g. CV folds and copies
+SYMBOLIC_CACHE_SIZE = 32
+_symbolic_cache = OrderedDict()
+
+class SpatialGraph(object):
+    def __init__(
+        self,
+        genotypes,
+        sample_pos,
+        node_pos,
+        edges,
+        scale_snps=True,
+        metric="euclidean",
+        cache_dir=None,
+    ):
         """Represents the spatial network which the data is defined on and
         stores relevant matrices / performs linear algebra routines needed for
-        the model and optimization. Inherits from the networkx Graph object.
+        the model and optimization. The graph structure (CSR adjacency) and
+        the node attributes (numpy arrays) are stored as arrays, a networkx
+        graph built from them (see nx_graph) is used for plotting and graph
+        algorithms.
 
         Required:
-            genotypes (:obj:`numpy.ndarray`): genotypes for samples
+            genotypes (:obj:`numpy.ndarray`): genotypes for samples, missing
+                genotypes are coded as np.nan (and are left out when
+                computing the allele frequencies, no imputation needed).
+                Genotypes in {0, 1, 2} are stored as int8 with missing
+                genotypes as GENOTYPE_MISSING
             sample_pos (:obj:`numpy.ndarray`): spatial positions for samples
             node_pos (:obj:`numpy.ndarray`):  spatial positions of nodes
             edges (:obj:`numpy.ndarray`): edge array
@@ -36,87 +73,327 @@ class SpatialGraph(nx.Graph):
         Optional:
             scale_snps (:obj:`Bool`): boolean to scale SNPs by SNP specific
                 Binomial variance estimates
+            metric (:obj:`str`): distance used to assign samples to nodes,
+                'euclidean' (planar coordinates, k-d tree) or 'haversine'
+                (great circle distance on (long., lat.) in degrees, ball tree)
+            cache_dir (:obj:`str`): directory of the on-disk cache of the graph
+                operators, keyed by the grid and the sample assignment (the
+                operators are computed and saved on a miss and loaded on a hit)
         """
         # check inputs
+        assert metric in ("euclidean", "haversine"), "metric must be 'euclidean' or 'haversine'"
         assert len(genotypes.shape) == 2
         assert len(sample_pos.shape) == 2
-        assert np.all(~np.isnan(genotypes)), "no missing genotypes are allowed"
         assert np.all(~np.isinf(genotypes)), "non inf genotypes are allowed"
         assert (
             genotypes.shape[0] == sample_pos.shape[0]
         ), "genotypes and sample positions must be the same size"
 
-        # remove invariant SNPs
-        if np.sum(np.where(genotypes.sum(axis=0)==0)[0]) > 0 or np.sum(np.where(genotypes.sum(axis=0)==2*genotypes.shape[0])[0]) > 0:
-            print('FEEMS requires polymorphic SNPs, but ID(s) {:g} were found to be invariant. '.format(list(np.where(genotypes.sum(axis=0)==0)[0]) + list(np.where(genotypes.sum(axis=0)==2*genotypes.shape[0])[0])))
+        # store hard calls compactly (int8) instead of the float matrix
+        genotypes = compact_genotypes(genotypes)
+
+        # remove invariant SNPs (only counting the observed genotypes)
+        alt_counts, n_called = count_alleles(genotypes)
+        invariant = (alt_counts == 0) | (alt_counts == 2 * n_called)
+        if np.any(invariant):
+            print('FEEMS requires polymorphic SNPs, but ID(s) {} were found to be invariant. '.format(np.where(invariant)[0].tolist()))
             print('Running analyses by removing these SNPs from the genotype matrix...')
-            genotypes = np.delete(genotypes,np.where(genotypes.sum(axis=0)==0)[0],1)
-            genotypes = np.delete(genotypes,np.where(genotypes.sum(axis=0)==2*genotypes.shape[0])[0],1)
+            genotypes = genotypes[:, ~invariant]
+
+        self._init_spatial(sample_pos, node_pos, edges, scale_snps, metric, cache_dir)
+
+        # estimate allele frequencies at observed locations (in permuted order)
+        self.genotypes = genotypes
+        self._estimate_allele_frequencies()
+
+        if scale_snps:
+            self.mu = self.frequencies.mean(axis=0) / 2
+            self.frequencies = self.frequencies / np.sqrt(self.mu * (1 - self.mu))
+
+        # estimate sample covariance matrix
+        self._comp_sample_covariance()
+
+        self._init_model()
+
+    @classmethod
+    def from_bed(
+        cls,
+        path,
+        sample_pos,
+        node_pos,
+        edges,
+        scale_snps=True,
+        metric="euclidean",
+        cache_dir=None,
+        chunk_snps=10000,
+        n_threads=None,
+    ):
+        """Builds the spatial graph by streaming blocks of SNPs from PLINK
+        files instead of holding the full genotype matrix in memory. Per deme
+        allele frequencies and the covariance S are accumulated block by block
+        (missing genotypes are handled as in SpatialGraph).
+        The genotypes are not stored so the graph can be fit but not split for
+        cross-validation.
+
+        Required:
+            path (:obj:`str`): prefix of the PLINK .bed/.bim/.fam files
+            sample_pos (:obj:`numpy.ndarray`): spatial positions for samples
+                (in the order of the .fam file)
+            node_pos (:obj:`numpy.ndarray`):  spatial positions of nodes
+            edges (:obj:`numpy.ndarray`): edge array
+
+        Optional:
+            scale_snps, metric, cache_dir: see SpatialGraph
+            chunk_snps (:obj:`int`): number of SNPs read per block
+            n_threads (:obj:`int`): number of threads used to decode a block
+                (default: dask's threaded scheduler default)
+
+        Returns:
+            sp_graph (:obj:`SpatialGraph`)
+        """
+        from pandas_plink import read_plink
+
+        assert isinstance(chunk_snps, numbers.Integral) and chunk_snps > 0, "chunk_snps must be a positive int"
+
+        # lazy (dask) genotype matrix of size n_snps x n_samples
+        (_, _, G) = read_plink(path, verbose=False)
+        assert (
+            G.shape[1] == sample_pos.shape[0]
+        ), "genotypes and sample positions must be the same size"
+
+        sp_graph = cls.__new__(cls)
+        sp_graph._init_spatial(sample_pos, node_pos, edges, scale_snps, metric, cache_dir)
+        sp_graph.genotypes = None
+
+        o = sp_graph.n_observed_nodes
+        n_samples = sample_pos.shape[0]
+        n_per_deme = sp_graph.n_samples_per_obs_node_permuted
+
+        print("Streaming genotypes in blocks of {} SNPs".format(chunk_snps), end="...")
+        if n_threads is None:
+            compute_kwargs = {"scheduler": "threads"}
+        else:
+            compute_kwargs = {"scheduler": "threads", "num_workers": n_threads}
+
+        frequencies = []
+        n_calls = []
+        mu = []
+        S = np.zeros((o, o))
+        n_pairs = np.zeros((o, o))
+        n_invariant = 0
+        for start in range(0, G.shape[0], chunk_snps):
+            g = np.asarray(G[start : start + chunk_snps].compute(**compute_kwargs), dtype=float).T
+
+            # remove invariant (or entirely missing) SNPs
+            alt_counts, n_called = count_alleles(g)
+            keep = (alt_counts > 0) & (alt_counts < 2 * n_called)
+            n_invariant += np.sum(~keep)
+            g = g[:, keep]
+
+            f, c = deme_allele_frequencies(g, sp_graph.Z, n_per_deme)
+            if scale_snps:
+                m = f.mean(axis=0) / 2
+                f = f / np.sqrt(m * (1 - m))
+                mu.append(m)
+            frequencies.append(f)
+            n_calls.append(c)
+
+            FFt, n = sample_covariance_terms(f, c)
+            S += FFt
+            n_pairs += n
+
+        if n_invariant > 0:
+            print("removed {} invariant SNPs".format(n_invariant), end="...")
+
+        sp_graph.frequencies = np.hstack(frequencies)
+        sp_graph.n_snps = sp_graph.frequencies.shape[1]
+        if all(c is None for c in n_calls):
+            sp_graph.n_calls = None
+        else:
+            sp_graph.n_calls = np.hstack(
+                [
+                    np.broadcast_to(n_per_deme, f.shape) if c is None else c
+                    for f, c in zip(frequencies, n_calls)
+                ]
+            )
+        if scale_snps:
+            sp_graph.mu = np.concatenate(mu)
+        sp_graph.S = S / np.maximum(n_pairs, 1)
+
+        sp_graph._init_model()
+        return sp_graph
+
+    @classmethod
+    def from_sufficient_stats(
+        cls,
+        node_pos,
+        edges,
+        obs_node_idx,
+        n_samples,
+        allele_counts=None,
+        n_calls=None,
+        S=None,
+        n_snps=None,
+        scale_snps=True,
+        cache_dir=None,
+    ):
+        """Builds the spatial graph from summaries of the data on each deme
+        instead of the individual genotypes, e.g. allele counts reduced over
+        chromosomes elsewhere. Either the per deme allele counts or the
+        covariance S of the (scaled) allele frequencies have to be given. The
+        graph can be fit (fit, extract_outliers, sequential_fit) but not split
+        for cross-validation.
+
+        Required:
+            node_pos (:obj:`numpy.ndarray`):  spatial positions of nodes
+            edges (:obj:`numpy.ndarray`): edge array
+            obs_node_idx (:obj:`numpy.ndarray`): node (row of node_pos) of
+                each deme
+            n_samples (:obj:`numpy.ndarray`): number of samples on each deme
+
+        Optional:
+            allele_counts (:obj:`numpy.ndarray`): alternative allele counts
+                on each deme (demes x SNPs)
+            n_calls (:obj:`numpy.ndarray`): number of observed genotypes on
+                each deme (demes x SNPs), default: no missing genotypes
+            S (:obj:`numpy.ndarray`): covariance of the allele frequencies
+                between demes (demes x demes), used if allele_counts is None
+            n_snps (:obj:`int`): number of SNPs S was computed from
+            scale_snps (:obj:`Bool`): boolean to scale SNPs by SNP specific
+                Binomial variance estimates (only used with allele_counts)
+            cache_dir (:obj:`str`): see SpatialGraph
+
+        Returns:
+            sp_graph (:obj:`SpatialGraph`)
+        """
+        obs_node_idx = np.asarray(obs_node_idx)
+        n_samples = np.asarray(n_samples)
+        assert (
+            np.unique(obs_node_idx).shape[0] == obs_node_idx.shape[0]
+        ), "each node can only be one deme"
+        assert np.all(n_samples > 0), "each deme needs at least one sample"
+        assert (allele_counts is None) != (S is None), "either allele_counts or S must be given"
+        if S is not None:
+            assert n_snps is not None, "n_snps must be given with S"
+
+        # every deme gets n_samples pseudo-samples on its node
+        assned_node_idx = np.repeat(obs_node_idx, n_samples)
+        sp_graph = cls.__new__(cls)
+        sp_graph._init_spatial(
+            node_pos[assned_node_idx],
+            node_pos,
+            edges,
+            scale_snps,
+            "euclidean",
+            cache_dir,
+            assned_node_idx=assned_node_idx,
+        )
+        sp_graph.genotypes = None
+
+        # rows of the inputs in the (permuted) order of the observed nodes
+        deme_of_node = np.empty(len(sp_graph), dtype=int)
+        deme_of_node[obs_node_idx] = np.arange(obs_node_idx.shape[0])
+        order = deme_of_node[sp_graph.perm_idx[: sp_graph.n_observed_nodes]]
+
+        if allele_counts is not None:
+            allele_counts = np.asarray(allele_counts, dtype=float)[order]
+            if n_calls is None:
+                sp_graph.n_calls = None
+                n_calls = np.broadcast_to(
+                    sp_graph.n_samples_per_obs_node_permuted[:, np.newaxis],
+                    allele_counts.shape,
+                )
+            else:
+                sp_graph.n_calls = np.asarray(n_calls, dtype=float)[order]
+                n_calls = sp_graph.n_calls
+
+            # remove invariant SNPs
+            alt_total = allele_counts.sum(axis=0)
+            n_called = n_calls.sum(axis=0)
+            keep = (alt_total > 0) & (alt_total < 2 * n_called)
+            if not np.all(keep):
+                print("removed {} invariant SNPs".format(np.sum(~keep)), end="...")
+                allele_counts = allele_counts[:, keep]
+                n_calls = n_calls[:, keep]
+                if sp_graph.n_calls is not None:
+                    sp_graph.n_calls = n_calls
+
+            sp_graph.frequencies = frequencies_from_counts(allele_counts, n_calls)
+            sp_graph.n_snps = sp_graph.frequencies.shape[1]
+            if scale_snps:
+                sp_graph.mu = sp_graph.frequencies.mean(axis=0) / 2
+                sp_graph.frequencies = sp_graph.frequencies / np.sqrt(
+                    sp_graph.mu * (1 - sp_graph.mu)
+                )
+            sp_graph._comp_sample_covariance()
+        else:
+            sp_graph.frequencies = None
+            sp_graph.n_calls = None
+            sp_graph.n_snps = n_snps
+            sp_graph.S = np.asarray(S, dtype=float)[np.ix_(order, order)]
+
+        sp_graph._init_model()
+        return sp_graph
 
-        # inherits from networkx Graph object -- changed this to new signature for python3
+    def _init_spatial(
+        self, sample_pos, node_pos, edges, scale_snps, metric, cache_dir, assned_node_idx=None
+    ):
+        """Sets up the graph, the assignment of samples to nodes and the graph
+        operators (everything which does not depend on the genotypes)
+        """
         print("Initializing graph...")
-        super().__init__()
         self._init_graph(node_pos, edges)  # init graph
 
         # inputs
         self.sample_pos = sample_pos
         self.node_pos = node_pos
         self.scale_snps = scale_snps
+        self.metric = metric
         self.option = 'default'
 
         self.optimize_q = None
         
-        print("Computing graph attributes...")
-        # signed incidence_matrix
-        self.Delta_q = nx.incidence_matrix(self, oriented=True).T.tocsc()
-
-        # track nonzero edges upper triangular
-        self.adj_base = sp.triu(nx.adjacency_matrix(self), k=1)
-        self.nnz_idx = self.adj_base.nonzero()
-
-        # adjacency matrix on the edges
-        self.Delta = self._create_incidence_matrix()
-
-        # vectorization operator on the edges
-        self.diag_oper = self._create_vect_matrix()
+        print("Assigning samples to nodes...")
+        self._build_node_tree(node_pos)  # spatial index on the nodes
+        self._assign_samples_to_nodes(sample_pos, node_pos, assned_node_idx)  # assn samples
+
+        print("Computing graph attributes", end="...")
+        cache_path = None
+        if cache_dir is not None:
+            key = graph_cache_key(node_pos, edges, self.assned_node_idx, metric)
+            cache_path = os.path.join(cache_dir, "feems_graph_{}.npz".format(key))
+        if cache_path is not None and os.path.exists(cache_path):
+            self._load_graph_operators(cache_path)
+        else:
+            self._comp_graph_operators()
+            if cache_path is not None:
+                self._save_graph_operators(cache_path)
 
-        print("Assigning samples to nodes", end="...")
-        self._assign_samples_to_nodes(sample_pos, node_pos)  # assn samples
-        self._permute_nodes()  # permute nodes
         n_samples_per_node = query_node_attributes(self, "n_samples")
         permuted_idx = query_node_attributes(self, "permuted_idx")
         n_samps = n_samples_per_node[permuted_idx]
         self.n_samples_per_obs_node_permuted = n_samps[: self.n_observed_nodes]
-        self._create_perm_diag_op()  # create perm operator
+        self._comp_sample_indicator()
         self.factor = None  # sparse cholesky factorization of L11
+        self._lap_buffers = None  # preallocated laplacian, see laplacian_buffers
+
+        # backend of the solves against L11, see set_solver
+        self.solver = "cholmod" if cholmod is not None else "pcg"
+        self.solver_opts = {}
 
         # initialize w
         self.w = np.ones(self.size())
 
-        # compute gradient of the graph laplacian with respect to w (dL / dw)
-        # this only needs to be done once
-        self.comp_grad_w()
-
-        # estimate allele frequencies at observed locations (in permuted order)
-        self.genotypes = genotypes
-        self._estimate_allele_frequencies()
-
-        if scale_snps:
-            self.mu = self.frequencies.mean(axis=0) / 2
-            self.frequencies = self.frequencies / np.sqrt(self.mu * (1 - self.mu))
-
+    def _init_model(self):
+        """Initializes the model parameters and containers once the allele
+        frequencies and S have been computed
+        """
         # compute precision
         self.comp_precision(s2=1)
 
         # vector to store the kriging-interpolated q values
         self.q_prox = np.ones(len(self) - self.n_observed_nodes)
 
-        # estimate sample covariance matrix
-        self.S = self.frequencies @ self.frequencies.T / self.n_snps
-
-        # creating an internal index for easier access
-        self.perm_idx = query_node_attributes(self, "permuted_idx") 
-
         # container to store long-range edge attributes
         self.edge = []
         self.c = []
@@ -136,73 +413,278 @@ class SpatialGraph(nx.Graph):
             node_pos (:obj:`numpy.ndarray`):  spatial positions of nodes
             edges (:obj:`numpy.ndarray`): edge array
         """
-        self.add_nodes_from(np.arange(node_pos.shape[0]))
-        self.add_edges_from((edges - 1).tolist())
+        n_nodes = node_pos.shape[0]
+
+        # symmetric adjacency matrix (duplicate edges and self loops dropped)
+        row, col = (edges - 1).T
+        A = sp.coo_matrix((np.ones(row.shape[0]), (row, col)), shape=(n_nodes, n_nodes))
+        A = ((A + A.T) > 0).astype(float).tocsr()
+        A.setdiag(0)
+        A.eliminate_zeros()
+        A.sort_indices()
+        self.adj_csr = A
+
+        # node attributes stored as arrays
+        self._node_attrs = {
+            "idx": np.arange(n_nodes),
+            "pos": node_pos,
+            "n_samples": np.zeros(n_nodes, dtype=int),
+            "sample_idx": np.empty(n_nodes, dtype=object),
+        }
+        for i in range(n_nodes):
+            self._node_attrs["sample_idx"][i] = []
+        self._nx_graph = None  # built from the arrays when first used
+
+    @property
+    def nx_graph(self):
+        """networkx graph with the edges and node attributes of the arrays,
+        built the first time it is used and after edges are added or removed
+        (changes made to it are not kept in the arrays)
+        """
+        if self._nx_graph is None:
+            n_nodes = len(self)
+            graph = nx.Graph()
+            graph.add_nodes_from(
+                (i, {name: values[i] for name, values in self._node_attrs.items()})
+                for i in range(n_nodes)
+            )
+            row, col = sp.triu(self.adj_csr, k=1).nonzero()
+            graph.add_edges_from(zip(row.tolist(), col.tolist()))
+            self._nx_graph = graph
+        return self._nx_graph
+
+    def _set_adj_csr(self, A):
+        """Sets the CSR adjacency (symmetric, no self loops) after edges were
+        added or removed
+        """
+        A = ((A + A.T) > 0).astype(float).tocsr()
+        A.setdiag(0)
+        A.eliminate_zeros()
+        A.sort_indices()
+        self.adj_csr = A
+        self._nx_graph = None
+
+    def _edge_matrix(self, ebunch):
+        """Sparse matrix with ones on the edges in ebunch"""
+        ebunch = [tuple(e[:2]) for e in ebunch]
+        if any(u not in self or v not in self for u, v in ebunch):
+            raise ValueError("the nodes of a SpatialGraph are fixed")
+        row, col = np.array(ebunch, dtype=int).reshape(-1, 2).T
+        return sp.csr_matrix(
+            (np.ones(row.shape[0]), (row, col)), shape=self.adj_csr.shape
+        )
+
+    # edges can be added or removed (e.g. long range edges in feems_mix), the
+    # nodes are fixed by the node attribute arrays
+    def add_edge(self, u_of_edge, v_of_edge):
+        self.add_edges_from([(u_of_edge, v_of_edge)])
+
+    def add_edges_from(self, ebunch_to_add):
+        self._set_adj_csr(self.adj_csr + self._edge_matrix(ebunch_to_add))
+
+    def remove_edge(self, u, v):
+        if u not in self or v not in self.neighbors(u):
+            raise ValueError("the edge {}-{} is not in the graph".format(u, v))
+        self.remove_edges_from([(u, v)])
+
+    def remove_edges_from(self, ebunch):
+        E = self._edge_matrix(ebunch)
+        self._set_adj_csr(self.adj_csr - self.adj_csr.multiply(E + E.T))
+
+    def add_node(self, node_for_adding, **attr):
+        raise ValueError("the nodes of a SpatialGraph are fixed")
+
+    def add_nodes_from(self, nodes_for_adding, **attr):
+        raise ValueError("the nodes of a SpatialGraph are fixed")
+
+    def remove_node(self, n):
+        raise ValueError("the nodes of a SpatialGraph are fixed")
+
+    def remove_nodes_from(self, nodes):
+        raise ValueError("the nodes of a SpatialGraph are fixed")
+
+    def __copy__(self):
+        """Shallow copy sharing the graph structure and operators, which are
+        fixed, but not the node attributes or long range edge containers
+        """
+        sp_graph_copy = self.__class__.__new__(self.__class__)
+        sp_graph_copy.__dict__.update(self.__dict__)
+        sp_graph_copy._node_attrs = {
+            name: values.copy() for name, values in self._node_attrs.items()
+        }
+        sp_graph_copy._nx_graph = None
+        sp_graph_copy.edge = copy(self.edge)
+        sp_graph_copy.c = copy(self.c)
+        # the laplacian buffers are updated in place so can't be shared
+        sp_graph_copy._lap_buffers = None
+        return sp_graph_copy
+
+    def __getstate__(self):
+        """The cholmod factor can't be pickled or deep copied so it is dropped
+        and recomputed (from the cached symbolic analysis) on the next update
+        of the graph laplacian
+        """
+        state = self.__dict__.copy()
+        state["factor"] = None
+        state["_nx_graph"] = None
+        return state
+
+    def __len__(self):
+        return self.adj_csr.shape[0]
+
+    def __iter__(self):
+        return iter(range(len(self)))
+
+    def __contains__(self, n):
+        return isinstance(n, numbers.Integral) and 0 <= n < len(self)
+
+    def number_of_nodes(self):
+        return len(self)
+
+    def size(self):
+        return self.adj_csr.nnz // 2
+
+    # networkx graph views, read from nx_graph
+    @property
+    def nodes(self):
+        return self.nx_graph.nodes
+
+    @property
+    def edges(self):
+        return self.nx_graph.edges
+
+    @property
+    def adj(self):
+        return self.nx_graph.adj
+
+    @property
+    def degree(self):
+        return self.nx_graph.degree
+
+    def __getitem__(self, n):
+        return self.nx_graph[n]
+
+    def neighbors(self, n):
+        """Iterator over the neighbors of node n read from the CSR adjacency"""
+        indptr = self.adj_csr.indptr
+        return iter(self.adj_csr.indices[indptr[n] : indptr[n + 1]].tolist())
+
+    def _comp_graph_operators(self):
+        """Computes the operators which only depend on the graph and on the
+        assignment of samples to nodes
+        """
+        # track nonzero edges upper triangular
+        self.adj_base = sp.triu(self.adj_csr, k=1)
+        self.nnz_idx = self.adj_base.nonzero()
+
+        # signed incidence_matrix
+        edge_idx = np.arange(self.size())
+        self.Delta_q = sp.csc_matrix(
+            (
+                np.r_[-np.ones(self.size()), np.ones(self.size())],
+                (np.r_[edge_idx, edge_idx], np.r_[self.nnz_idx[0], self.nnz_idx[1]]),
+            ),
+            shape=(self.size(), len(self)),
+        )
+
+        # adjacency matrix on the edges
+        self.Delta = self._create_incidence_matrix()
+
+        self._permute_nodes()  # permute nodes
+        self._create_perm_diag_op()  # create perm operator
+
+        # compute gradient of the graph laplacian with respect to w (dL / dw)
+        # this only needs to be done once
+        self.comp_grad_w()
+
+    def _save_graph_operators(self, path):
+        """Saves the graph operators to a .npz file (written to a temporary
+        file first so concurrent runs never read a partial file)
+        """
+        arrays = {
+            "nnz_idx": np.vstack(self.nnz_idx),
+            "nnz_idx_perm": np.vstack(self.nnz_idx_perm),
+            "permuted_idx": self.perm_idx,
+        }
+        for name in ("Delta", "Delta_q", "B"):
+            M = getattr(self, name).tocsc()
+            arrays[name + "_data"] = M.data
+            arrays[name + "_indices"] = M.indices
+            arrays[name + "_indptr"] = M.indptr
+            arrays[name + "_shape"] = np.array(M.shape)
+
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        tmp_path = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp_path, "wb") as f:
+            np.savez(f, **arrays)
+        os.replace(tmp_path, path)
+
+    def _load_graph_operators(self, path):
+        """Loads the graph operators saved by _save_graph_operators"""
+        with np.load(path) as arrays:
+            self.nnz_idx = tuple(arrays["nnz_idx"])
+            self.adj_base = sp.coo_matrix(
+                (np.ones(self.nnz_idx[0].shape[0]), self.nnz_idx),
+                shape=(len(self), len(self)),
+            )
+            for name in ("Delta", "Delta_q", "B"):
+                M = sp.csc_matrix(
+                    (
+                        arrays[name + "_data"],
+                        arrays[name + "_indices"],
+                        arrays[name + "_indptr"],
+                    ),
+                    shape=tuple(arrays[name + "_shape"]),
+                )
+                setattr(self, name, M)
 
-        # add spatial coordinates to node attributes
-        for i in range(len(self)):
-            self.nodes[i]["idx"] = i
-            self.nodes[i]["pos"] = node_pos[i, :]
-            self.nodes[i]["n_samples"] = 0
-            self.nodes[i]["sample_idx"] = []
+            self._node_attrs["permuted_idx"] = arrays["permuted_idx"]
+            self._nx_graph = None
+            self.perm_idx = arrays["permuted_idx"]
+
+            row, col = arrays["nnz_idx_perm"]
+            self.nnz_idx_perm = (row, col)
+            self.adj_perm = sp.coo_matrix(
+                (np.ones(self.size()), (row, col)), shape=(len(self), len(self))
+            )
 
     def _create_incidence_matrix(self):
         """Create a signed incidence matrix on the edges
         * note this is computed only once
         """
-        data = np.array([], dtype=float)
-        row_idx = np.array([], dtype=int)
-        col_idx = np.array([], dtype=int)
-        n_count = 0
-        for i in range(self.size()):
-            edge1 = np.array([self.nnz_idx[0][i], self.nnz_idx[1][i]])
-            for j in range(i + 1, self.size()):
-                edge2 = np.array([self.nnz_idx[0][j], self.nnz_idx[1][j]])
-                if len(np.intersect1d(edge1, edge2)) > 0:
-                    data = np.append(data, 1)
-                    row_idx = np.append(row_idx, n_count)
-                    col_idx = np.append(col_idx, i)
-
-                    data = np.append(data, -1)
-                    row_idx = np.append(row_idx, n_count)
-                    col_idx = np.append(col_idx, j)
-
-                    # increment
-                    n_count += 1
-
-        Delta = sp.csc_matrix(
-            (data, (row_idx, col_idx)), shape=(int(len(data) / 2.0), self.size())
-        )
-        return Delta
+        return edge_incidence_matrix(self.nnz_idx, len(self))
 
-    def _create_vect_matrix(self):
-        """Construct matrix operators S so that S*vec(W) is the degree vector
-        * note this is computed only once
+    def _build_node_tree(self, node_pos):
+        """Builds the spatial index on the node positions which is used to find
+        the closest node to each sample
+        * note this is computed only once and shared by copies of the graph
         """
-        row_idx = np.repeat(np.arange(len(self)), len(self))
-        col_idx = np.array([], dtype=int)
-        for ite, i in enumerate(range(len(self))):
-            idx = np.arange(0, len(self) ** 2, len(self)) + ite
-            col_idx = np.append(col_idx, idx)
-        S = sp.csc_matrix(
-            (np.ones(len(self) ** 2), (row_idx, col_idx)),
-            shape=(len(self), len(self) ** 2),
-        )
-        return S
+        if self.metric == "haversine":
+            self.node_tree = BallTree(np.radians(node_pos[:, ::-1]), metric="haversine")
+        else:
+            self.node_tree = KDTree(node_pos)
 
-    def _assign_samples_to_nodes(self, sample_pos, node_pos):
+    def _assign_samples_to_nodes(self, sample_pos, node_pos, assned_node_idx=None):
         """Assigns each sample to a node on the graph by finding the closest
-        node to that sample
+        node to that sample (or using a precomputed assignment)
         """
-        n_samples = sample_pos.shape[0]
-        assned_node_idx = np.zeros(n_samples, "int")
-        for i in range(n_samples):
-            dist = (sample_pos[i, :] - node_pos) ** 2
-            idx = np.argmin(np.sum(dist, axis=1))
-            assned_node_idx[i] = idx
-            self.nodes[idx]["n_samples"] += 1
-            self.nodes[idx]["sample_idx"].append(i)
-        n_samples_per_node = query_node_attributes(self, "n_samples")
+        if assned_node_idx is None:
+            if self.metric == "haversine":
+                query_pos = np.radians(sample_pos[:, ::-1])
+            else:
+                query_pos = sample_pos
+            assned_node_idx = self.node_tree.query(query_pos, k=1, return_distance=False)[:, 0]
+
+        # group the samples by node
+        n_samples_per_node = np.bincount(assned_node_idx, minlength=len(self))
+        sample_order = np.argsort(assned_node_idx, kind="stable")
+        sample_idx = np.empty(len(self), dtype=object)
+        for i, s in enumerate(np.split(sample_order, np.cumsum(n_samples_per_node)[:-1])):
+            sample_idx[i] = s.tolist()
+        self._node_attrs["n_samples"] = n_samples_per_node
+        self._node_attrs["sample_idx"] = sample_idx
+        self._nx_graph = None
+
         self.n_observed_nodes = np.sum(n_samples_per_node != 0)
         self.assned_node_idx = assned_node_idx
 
@@ -218,11 +700,16 @@ class SpatialGraph(nx.Graph):
         ns = n_samples_per_node != 0
         s = n_samples_per_node == 0
         permuted_node_idx = np.concatenate([node_idx[ns], node_idx[s]])
-        permuted_idx_dict = dict(zip(node_idx, permuted_node_idx))
-        nx.set_node_attributes(self, permuted_idx_dict, "permuted_idx")
+        self._node_attrs["permuted_idx"] = permuted_node_idx
+        self._nx_graph = None
+
+        # creating an internal index for easier access
+        self.perm_idx = permuted_node_idx
 
     def _create_perm_diag_op(self):
-        """Creates permute diag operator"""
+        """Creates the edge indices and adjacency matrix in the permuted node
+        order (the degree part of the gradient is gathered from nnz_idx_perm)
+        """
         # query permuted node ids
         permuted_node_idx = query_node_attributes(self, "permuted_idx")
 
@@ -234,11 +721,6 @@ class SpatialGraph(nx.Graph):
             (np.ones(self.size()), (row, col)), shape=(len(self), len(self))
         )
 
-        # permute diag operator
-        vect_idx_r = row + len(self) * col
-        vect_idx_c = col + len(self) * row
-        self.P = self.diag_oper[:, vect_idx_r] + self.diag_oper[:, vect_idx_c]
-
     def _get_dist(self, u, v, e=None):
         return 1/self.W[np.where(self.perm_idx==u)[0], np.where(self.perm_idx==v)[0]]
 
@@ -274,8 +756,25 @@ class SpatialGraph(nx.Graph):
 
     def comp_graph_laplacian(self, weight, perm=True):
         """Computes the graph laplacian (note: this is computed each step of the
-        optimization so needs to be fast)
+        optimization so needs to be fast). For edge weights on the permuted
+        graph the preallocated W, D, L and blocks of L are rewritten in place
         """
+        if "array" in str(type(weight)) and perm:
+            if weight.shape[0] == len(self):
+                self.m = weight
+                weight = self.B @ self.m
+            self.w = weight
+            buffers = getattr(self, "_lap_buffers", None)
+            if buffers is None or buffers["nnz_idx"] is not self.nnz_idx_perm:
+                buffers = laplacian_buffers(self.nnz_idx_perm, len(self),
+                                            self.n_observed_nodes)
+                self._lap_buffers = buffers
+            update_laplacian_buffers(buffers, self.w)
+            self.W, self.D, self.L = buffers["W"], buffers["D"], buffers["L"]
+            self.L_block = buffers["L_block"]
+            self._factor_laplacian()
+            return
+
         if "array" in str(type(weight)) and weight.shape[0] == len(self):
             self.m = weight
             self.w = self.B @ self.m
@@ -296,12 +795,37 @@ class SpatialGraph(nx.Graph):
             "do": self.L[self.n_observed_nodes :, : self.n_observed_nodes],
             "od": self.L[: self.n_observed_nodes, self.n_observed_nodes :],
         }
+        self._factor_laplacian()
+
+    def set_solver(self, solver="pcg", **opts):
+        """Sets the backend of the solves against L_block["dd"] in the
+        objective: "cholmod" (sparse cholesky factor) or "pcg" (conjugate
+        gradients, see PCGSolver for the options), which has no fill-in and
+        does not need scikit-sparse
 
-        if self.factor is None:
+        Optional:
+            solver (:obj:`str`): "cholmod" or "pcg"
+            opts: options of the solver e.g. preconditioner, rtol, maxiter
+        """
+        assert solver in ("cholmod", "pcg"), "solver must be 'cholmod' or 'pcg'"
+        if solver == "cholmod":
+            assert cholmod is not None, "cholmod solver needs scikit-sparse"
+        self.solver = solver
+        self.solver_opts = opts
+        self.factor = None
+
+    def _factor_laplacian(self):
+        """Numeric cholesky factorization of L_block["dd"] (or the setup of the
+        iterative solver)
+        """
+        if self.factor is None and getattr(self, "solver", "cholmod") == "pcg":
+            self.factor = PCGSolver(self.L_block["dd"], **self.solver_opts)
+        elif self.factor is None:
             # initialize the object if the cholesky factorization has not been
-            # computed yet. This will perform the fill-in reducing permutation
-            # and the cholesky factorization which is "slow" initially
-            self.factor = cholmod.cholesky(self.L_block["dd"])
+            # computed yet. The fill-in reducing permutation (symbolic
+            # analysis) is "slow" so it is shared between graphs with the same
+            # sparsity pattern of L11 and only the numeric factorization is done
+            self.factor = symbolic_analysis(self.L_block["dd"]).cholesky(self.L_block["dd"])
         else:
             # if it has been computed we can quickly update the factorization
             # by calling the cholesky method of factor which does not perform
@@ -309,6 +833,39 @@ class SpatialGraph(nx.Graph):
             # pattern of L11 is fixed throughout the algorithm
             self.factor = self.factor.cholesky(self.L_block["dd"])
 
+    def comp_diag_pinv(self):
+        """Computes the diagonal of the regularized inverse of the graph
+        laplacian, diag((L + I/d)^-1) - 1, by selected inversion on the sparse
+        factor (instead of d solves against unit vectors)
+        """
+        d = len(self)
+        A = self.L + sp.identity(d, format="csc") / d  # make L invertible
+        return selected_inverse_diag(A) - 1
+
+    def comp_grounded_factor(self, q=None):
+        """Factor of L + 11^T/d, plus diag(q) on the observed nodes if q is
+        given, without the dense rank one term: the laplacian grounded at node
+        0, L + e_0 e_0^T (+ diag(q)), is sparse s.p.d. so it gets a sparse
+        cholesky factor and the rank two difference is handled by woodbury
+
+        Optional:
+            q (:obj:`numpy.ndarray`): residual precisions of the observed nodes
+
+        Returns:
+            factor (:obj:`LowRankUpdatedFactor`): call factor(B) to solve and
+                factor.logdet() for the log-determinant
+        """
+        d = len(self)
+        diag = np.zeros(d)
+        diag[0] = 1.0
+        if q is not None:
+            diag[: self.n_observed_nodes] += q
+        A = self.L + sp.diags(diag, format="csc")
+        U = np.zeros((d, 2))
+        U[:, 0] = 1.0 / np.sqrt(d)
+        U[0, 1] = 1.0
+        return LowRankUpdatedFactor(sparse_spd_factor(A), U, np.array([1.0, -1.0]))
+
     def comp_grad_w(self):
         """Computes the derivative of the graph laplacian with respect to the
         latent variables (dw / dm) note this is computed only once
@@ -329,29 +886,56 @@ class SpatialGraph(nx.Graph):
 
     # ------------------------- Data -------------------------
 
-    def _estimate_allele_frequencies(self):
-        """Estimates allele frequencies by maximum likelihood on the observed
-        nodes (in permuted order) of the spatial graph
+    def _comp_sample_indicator(self):
+        """Computes the sparse (o x n) indicator matrix Z of the samples on
+        the observed nodes (in permuted order) so per deme sums of the
+        genotypes are a single sparse product Z @ genotypes
         """
-        self.n_snps = self.genotypes.shape[1]
-
-        # create the data matrix of means
-        self.frequencies = np.empty((self.n_observed_nodes, self.n_snps))
-
-        # get indicies
-        sample_idx = nx.get_node_attributes(self, "sample_idx")
-        permuted_idx = query_node_attributes(self, "permuted_idx")
-        observed_permuted_idx = permuted_idx[: self.n_observed_nodes]
+        node_to_deme = np.empty(len(self), dtype=int)
+        node_to_deme[self.perm_idx] = np.arange(len(self))
+        self.sample_deme_idx = node_to_deme[self.assned_node_idx]
+        self.Z = sample_indicator_matrix(self.sample_deme_idx, self.n_observed_nodes)
 
-        # loop of the observed nodes in order of the permuted nodes
-        for i, node_id in enumerate(observed_permuted_idx):
+    def _estimate_allele_frequencies(self, genotypes=None, Z=None, chunk_snps=10000):
+        """Estimates allele frequencies by maximum likelihood on the observed
+        nodes (in permuted order) of the spatial graph, using only the
+        observed (non-missing) genotypes. The genotypes are processed in
+        blocks of SNPs so no masked / imputed copy of the full matrix is made.
 
-            # find the samples assigned to the ith node
-            s = sample_idx[node_id]
+        Optional:
+            genotypes (:obj:`numpy.ndarray`): genotypes to use instead of the
+                ones stored on the graph
+            Z (:obj:`scipy.sparse.csr_matrix`): indicator matrix matching the
+                rows of genotypes (default: the one stored on the graph)
+            chunk_snps (:obj:`int`): number of SNPs per block
+        """
+        if genotypes is None:
+            genotypes = self.genotypes
+        if Z is None:
+            Z = self.Z
+        self.n_snps = genotypes.shape[1]
 
-            # compute mean at each node
-            allele_counts = np.mean(self.genotypes[s, :], axis=0) / 2 
-            self.frequencies[i, :] = allele_counts
+        n_per_deme = self.n_samples_per_obs_node_permuted
+        self.frequencies = np.empty((self.n_observed_nodes, self.n_snps))
+        self.n_calls = None  # number of observed genotypes per deme and SNP
+        for start in range(0, self.n_snps, chunk_snps):
+            stop = min(start + chunk_snps, self.n_snps)
+            f, c = deme_allele_frequencies(genotypes[:, start:stop], Z, n_per_deme)
+            self.frequencies[:, start:stop] = f
+            if c is not None:
+                if self.n_calls is None:
+                    self.n_calls = np.repeat(
+                        n_per_deme[:, np.newaxis].astype(float), self.n_snps, axis=1
+                    )
+                self.n_calls[:, start:stop] = c
+
+    def _comp_sample_covariance(self):
+        """Computes the sample covariance S of the (scaled) allele frequencies,
+        with missing data each pair of demes is averaged over the SNPs
+        observed on both demes
+        """
+        FFt, n_pairs = sample_covariance_terms(self.frequencies, self.n_calls)
+        self.S = FFt / np.maximum(n_pairs, 1)
 
     def comp_precision(self, s2):
         """Computes the residual precision matrix"""
@@ -375,12 +959,24 @@ class SpatialGraph(nx.Graph):
 
     # ------------------------- Optimizers -------------------------
 
-    def fit_null_model(self, verbose=True):
+    def fit_null_model(self, verbose=True, n_probes=None):
         """Estimates of the edge weights and residual variance
-        under the model that all the edge weights have the same value
+        under the model that all the edge weights have the same value. The
+        likelihood is a function of the spectrum of the laplacian with unit
+        weights (computed once) so it is minimized by newton's method (trust
+        region) with the exact gradient and hessian. With n_probes the
+        stochastic objective is used instead (no dense inverse) and minimized
+        by Nelder-Mead
         """
         obj = Objective(self)
-        res = minimize(neg_log_lik_w0_s2, [0.0, 0.0], method="Nelder-Mead", args=(obj))
+        if n_probes is not None:
+            obj.stochastic, obj.n_probes = True, n_probes
+            res = minimize(neg_log_lik_w0_s2, [0.0, 0.0], method="Nelder-Mead", args=(obj))
+        else:
+            lam, t = comp_null_spectrum(obj)
+            fun = lambda z: neg_log_lik_w0_s2_spectral(z, lam, t, self.n_snps)
+            res = minimize(lambda z: fun(z)[:2], [0.0, 0.0], method="trust-exact",
+                           jac=True, hess=lambda z: fun(z)[2])
         assert res.success is True, "did not converge"
         w0_hat = np.exp(res.x[0])
         s2_hat = np.exp(res.x[1])
@@ -761,7 +1357,8 @@ class SpatialGraph(nx.Graph):
         maxiter=15000,
         verbose=False,
         option='default',
-        long_range_edges=None
+        long_range_edges=None,
+        dtype=np.float64,
     ):
         """Estimates the edge weights of the full model holding the residual
         variance fixed using a quasi-newton algorithm, specifically L-BFGS.
@@ -782,6 +1379,8 @@ class SpatialGraph(nx.Graph):
             ub (:obj:`int`): upper bound of log weights
             maxiter (:obj:`int`): maximum number of iterations to run L-BFGS
             verbose (:obj:`Bool`): boolean to print summary of results
+            dtype (:obj:`numpy.dtype`): precision of the dense matrix products
+                in the gradient, float32 is faster for many observed nodes
 
         Returns:
             None
@@ -834,7 +1433,7 @@ class SpatialGraph(nx.Graph):
                 alpha_q = 1. / self.s2.mean()
 
             # run l-bfgs
-            obj = Objective(self)
+            obj = Objective(self, dtype=dtype)
             obj.sp_graph.optimize_q = optimize_q; obj.lamb = lamb; obj.alpha = alpha
             
             x0 = np.log(w_init)
@@ -870,7 +1469,7 @@ class SpatialGraph(nx.Graph):
             if alpha_q is None:
                 alpha_q = 1.0 / self.s2.mean()
 
-            obj = Objective(self)
+            obj = Objective(self, dtype=dtype)
             obj.sp_graph.optimize_q = optimize_q; obj.lamb = lamb; obj.alpha = alpha
             if obj.sp_graph.optimize_q is not None:
                 obj.lamb_q = lamb_q
@@ -905,8 +1504,10 @@ class SpatialGraph(nx.Graph):
             else:    
                 self.w = np.exp(res[0])
                 
-            # print update
+            # print update (cached from the last l-bfgs evaluation)
             self.train_loss, _ = loss_wrapper(res[0], obj)
+            self.loss_cache_info = obj.cache_info()
+            self.n_iter = res[2]["nit"]
             if verbose:
                 sys.stdout.write(
                     (
@@ -917,6 +1518,122 @@ class SpatialGraph(nx.Graph):
                     ).format(lamb, alpha, res[2]["nit"], self.train_loss)
                 ) 
 
+    def fit_stochastic(
+        self,
+        lamb,
+        lamb_q=None,
+        w_init=None,
+        s2_init=None,
+        alpha=None,
+        alpha_q=None,
+        optimize_q='n-dim',
+        n_probes=30,
+        n_rounds=4,
+        seed=0,
+        factr=1e10,
+        maxls=50,
+        m=10,
+        maxiter=15000,
+        verbose=False,
+    ):
+        """Estimates the edge weights (and residual variances) like fit but with
+        the stochastic objective, sparse solves against the graph laplacian
+        and randomized trace estimates instead of dense o x o inverses, for
+        graphs with many observed nodes. The long range edges and the kriging
+        of the residual variances onto the unobserved nodes (q_prox) need the
+        dense inverse and are not supported
+
+        Required:
+            lamb (:obj:`float`): penalty strength on weights
+
+        Optional:
+            lamb_q (:obj:`float`): penalty strength on the residual variances
+            w_init (:obj:`numpy.ndarray`): initial value for the edge weights
+            s2_init (:obj:`numpy.ndarray`): initial value for s2
+            alpha (:obj:`float`): penalty strength on log weights
+            alpha_q (:obj:`float`): penalty strength on log residual variances
+            n_probes (:obj:`int`): number of probe vectors per estimate
+            n_rounds (:obj:`int`): rounds of L-BFGS with fresh probe vectors
+            seed (:obj:`int`): seed of the probe vectors
+            factr (:obj:`float`): tolerance for convergence in each round
+            maxls (:obj:`int`): maximum number of line search steps
+            m (:obj:`int`): the maximum number of variable metric corrections
+            maxiter (:obj:`int`): maximum number of iterations in each round
+            verbose (:obj:`Bool`): boolean to print summary of results
+
+        Returns:
+            None
+        """
+        # check inputs
+        assert isinstance(lamb, (numbers.Real,)) and lamb >= 0, "lamb must be a float >=0"
+        if lamb_q is None:
+            lamb_q = lamb
+        assert isinstance(lamb_q, (numbers.Real,)) and lamb_q >= 0, "lamb_q must be a float >= 0"
+        assert isinstance(n_probes, (numbers.Integral,)) and n_probes > 0, "n_probes must be a positive int"
+        assert isinstance(n_rounds, (numbers.Integral,)) and n_rounds > 0, "n_rounds must be a positive int"
+
+        self.optimize_q = optimize_q
+        self.option = 'default'
+
+        # init from null model if no init weights are provided
+        if w_init is None and s2_init is None:
+            self.fit_null_model(verbose=verbose, n_probes=n_probes)
+            w_init = self.w0
+        else:
+            assert w_init.shape == self.w.shape, "weights must have shape of edges"
+            assert np.all(w_init > 0.0), "weights must be non-negative"
+            self.w0 = w_init
+            self.comp_precision(s2=s2_init)
+
+        if alpha is None:
+            alpha = 1.0 / self.w0.mean()
+        if alpha_q is None:
+            alpha_q = 1.0 / np.mean(self.s2)
+
+        obj = Objective(self)
+        obj.lamb, obj.alpha = lamb, alpha
+        obj.lamb_q, obj.alpha_q = lamb_q, alpha_q
+        obj.stochastic, obj.n_probes, obj.probe_seed = True, n_probes, seed
+
+        x0 = np.log(w_init)
+        if optimize_q is not None:
+            s2_init = np.array([self.s2]) if optimize_q == "1-dim" else self.s2 * np.ones(len(self))
+            x0 = np.r_[x0, np.log(s2_init)]
+
+        res = stochastic_lbfgs(obj, x0, n_rounds=n_rounds, factr=factr, m=m,
+                               maxls=maxls, maxiter=maxiter, verbose=verbose)
+
+        self.w = np.exp(res[0][: self.size()])
+        if optimize_q is not None:
+            self.s2 = np.exp(res[0][self.size() :])
+        self.comp_graph_laplacian(self.w)
+        self.comp_precision(s2=self.s2)
+        self.train_loss = res[1]
+        if verbose:
+            sys.stdout.write(
+                (
+                    "lambda={:.3f}, "
+                    "alpha={:.4f}, "
+                    "converged in {} iterations, "
+                    "train_loss={:.3f} (stochastic)\n"
+                ).format(lamb, alpha, res[2]["nit"], self.train_loss)
+            )
+
+    def fit_path(self, lamb_grid, lamb_q_grid, **kwargs):
+        """Fits the model over a grid of penalties reusing the factorization
+        and warm starting each grid point from its neighbour, see
+        feems.path.fit_path for the options
+
+        Required:
+            lamb_grid (:obj:`numpy.ndarray`): penalties on the weights
+            lamb_q_grid (:obj:`numpy.ndarray`): penalties on the residual
+                variances
+
+        Returns:
+            path (:obj:`feems.path.PathResult`): solutions at all grid points
+        """
+        return fit_path(self, lamb_grid, lamb_q_grid, **kwargs)
+
     def _calculate_chisq(
         self, 
         ed, fd,
@@ -994,7 +1711,7 @@ class SpatialGraph(nx.Graph):
             # code to convert single index to matrix indices
             x.append(np.floor(np.sqrt(2*k+0.25)-0.5).astype('int')+1); y.append(int(k - 0.5*x[-1]*(x[-1]-1)))
 
-            ls.append([self.perm_idx[x[-1]], self.perm_idx[y[-1]], tuple(self.nodes[self.perm_idx[x[-1]]]['pos'][::-1]), tuple(self.nodes[self.perm_idx[y[-1]]]['pos'][::-1]), logratio[k]])
+            ls.append([self.perm_idx[x[-1]], self.perm_idx[y[-1]], tuple(self.node_pos[self.perm_idx[x[-1]]][::-1]), tuple(self.node_pos[self.perm_idx[y[-1]]][::-1]), logratio[k]])
 
         rm = []
         newls = []
@@ -1008,7 +1725,7 @@ class SpatialGraph(nx.Graph):
             else:
                 # approximately similar likelihood of either deme being destination 
                 if np.abs(rescopp.fun - resc.fun) <= tol:
-                    newls.append([self.perm_idx[y[k]], self.perm_idx[x[k]], tuple(self.nodes[self.perm_idx[y[k]]]['pos'][::-1]), tuple(self.nodes[self.perm_idx[x[k]]]['pos'][::-1]), logratio[k]])
+                    newls.append([self.perm_idx[y[k]], self.perm_idx[x[k]], tuple(self.node_pos[self.perm_idx[y[k]]][::-1]), tuple(self.node_pos[self.perm_idx[x[k]]][::-1]), logratio[k]])
                 else:
                     # if the "opposite" direction has a much higher log-likelihood then replace it entirely 
                     if rescopp.fun < resc.fun:
@@ -1076,7 +1793,7 @@ class SpatialGraph(nx.Graph):
             # code to convert single index to matrix indices
             x.append(np.floor(np.sqrt(2*k+0.25)-0.5).astype('int')+1); y.append(int(k - 0.5*x[-1]*(x[-1]-1)))
 
-            ls.append([self.perm_idx[x[-1]], self.perm_idx[y[-1]], tuple(self.nodes[self.perm_idx[x[-1]]]['pos'][::-1]), tuple(self.nodes[self.perm_idx[y[-1]]]['pos'][::-1]), emp_dist[k]-fit_dist[k]])
+            ls.append([self.perm_idx[x[-1]], self.perm_idx[y[-1]], tuple(self.node_pos[self.perm_idx[x[-1]]][::-1]), tuple(self.node_pos[self.perm_idx[y[-1]]][::-1]), emp_dist[k]-fit_dist[k]])
 
         rm = []
         newls = []
@@ -1090,7 +1807,7 @@ class SpatialGraph(nx.Graph):
             else:
                 # approximately similar likelihood of either deme being destination 
                 if np.abs(rescopp.fun - resc.fun) <= tol:
-                    newls.append([self.perm_idx[y[k]], self.perm_idx[x[k]], tuple(self.nodes[self.perm_idx[y[k]]]['pos'][::-1]), tuple(self.nodes[self.perm_idx[x[k]]]['pos'][::-1]), ls[k][-1]])
+                    newls.append([self.perm_idx[y[k]], self.perm_idx[x[k]], tuple(self.node_pos[self.perm_idx[y[k]]][::-1]), tuple(self.node_pos[self.perm_idx[x[k]]][::-1]), ls[k][-1]])
                 else:
                     # if the "opposite" direction has a much higher log-likelihood then replace it entirely 
                     if rescopp.fun < resc.fun:
@@ -1293,8 +2010,8 @@ class SpatialGraph(nx.Graph):
             randedge = []
             for n in range(self.number_of_nodes()):
                 # checking for lat. & long. of all possible nodes in graph
-                if self.nodes[n]['pos'][0] > opts[0][0] and self.nodes[n]['pos'][0] < opts[0][1]:
-                    if self.nodes[n]['pos'][1] > opts[1][0] and self.nodes[n]['pos'][1] < opts[1][1]:
+                if self.node_pos[n][0] > opts[0][0] and self.node_pos[n][0] < opts[0][1]:
+                    if self.node_pos[n][1] > opts[1][0] and self.node_pos[n][1] < opts[1][1]:
                         randedge.append((n,destid))
 
             # remove tuple of dest -> dest ONLY if it is in randedge
@@ -1425,10 +2142,738 @@ def coordinate_descent(
 
     return res
 
+
+def stochastic_lbfgs(
+    obj,
+    x0,
+    n_rounds=4,
+    factr=1e10,
+    m=10,
+    maxls=50,
+    maxiter=15000,
+    verbose=False
+):
+    """L-BFGS on the stochastic objective (obj.stochastic). Within a round the
+    probe vectors are fixed so L-BFGS minimizes a smooth sample average of
+    the objective (the line search and curvature pairs see the same noise),
+    the next round draws new probes and warm starts from the last solution.
+    The solution is the average of the rounds after the first, which
+    reduces the error due to the probes
+
+    Required:
+        obj (:obj:`feems.Objective`): objective with stochastic=True
+        x0 (:obj:`numpy.ndarray`): initial log weights (and log s2)
+
+    Optional:
+        n_rounds (:obj:`int`): number of rounds of fresh probe vectors
+        factr, m, maxls, maxiter: passed to fmin_l_bfgs_b in each round
+
+    Returns:
+        (x, f, d) like fmin_l_bfgs_b, d has the total number of iterations
+    """
+    assert obj.stochastic, "objective must be in stochastic mode"
+    seed = obj.probe_seed
+    x, xs, nit, warnflag = x0, [], 0, 0
+    for r in range(n_rounds):
+        obj.probe_seed = seed + r
+        res = fmin_l_bfgs_b(
+            func=loss_wrapper,
+            x0=x,
+            args=[obj],
+            factr=factr,
+            m=m,
+            maxls=maxls,
+            maxiter=maxiter,
+            approx_grad=False,
+        )
+        x = res[0]
+        xs.append(x)
+        nit += res[2]["nit"]
+        warnflag = max(warnflag, res[2]["warnflag"])
+        if verbose:
+            print("round {:d}: loss={:.3f}, {:d} iterations".format(r + 1, res[1], res[2]["nit"]))
+    x = np.mean(xs[1:] if n_rounds > 1 else xs, axis=0)
+    obj.probe_seed = seed
+    return x, loss_wrapper(x, obj)[0], {"nit": nit, "warnflag": warnflag}
+
+
+class PCGSolver(object):
+    def __init__(self, A, preconditioner="ilu", rtol=1e-10, maxiter=100,
+                 drop_tol=1e-4, fill_factor=4, warm_start=False,
+                 warm_starts=None):
+        """Solves A X = B for the sparse s.p.d. matrix A by preconditioned
+        conjugate gradients, on all the columns of B at once, as an
+        alternative to the cholmod factor (same interface: call the solver
+        to solve and solver.cholesky(A) for a new matrix with the same
+        pattern). Columns that don't converge in maxiter iterations (e.g.
+        for weights at the bounds of the fit, where L11 is too ill
+        conditioned for rtol) are solved directly with SparseLUFactor
+
+        Required:
+            A (:obj:`scipy.sparse.csc_matrix`): s.p.d. matrix
+
+        Optional:
+            preconditioner (:obj:`str`): "ilu" (incomplete factorization
+                without pivoting, close to incomplete cholesky for L11),
+                "amg" (smoothed aggregation multigrid, needs pyamg),
+                "jacobi" or None
+            rtol (:obj:`float`): relative residual at convergence
+            maxiter (:obj:`int`): maximum number of iterations
+            drop_tol (:obj:`float`): drop tolerance of the ilu
+            fill_factor (:obj:`float`): maximum fill of the ilu
+            warm_start (:obj:`Bool`): start each solve from the last solution
+                for the same shape of B (e.g. of the previous L-BFGS step),
+                the solutions then depend on the previous solves within rtol
+            warm_starts (:obj:`dict`): last solutions keyed by shape
+        """
+        self.A = sp.csc_matrix(A, copy=True)
+        self.preconditioner = preconditioner
+        self.rtol = rtol
+        self.maxiter = maxiter
+        self.drop_tol = drop_tol
+        self.fill_factor = fill_factor
+        self.warm_start = warm_start
+        self.warm_starts = {} if warm_starts is None else warm_starts
+        self.n_iter = 0
+        self.M = pcg_preconditioner(self.A, preconditioner, drop_tol, fill_factor)
+        self.direct = None
+
+    def cholesky(self, A):
+        """Solver for A sharing the options (and warm starts)"""
+        return PCGSolver(A, self.preconditioner, self.rtol, self.maxiter,
+                         self.drop_tol, self.fill_factor, self.warm_start,
+                         self.warm_starts)
+
+    def __call__(self, B):
+        X0 = self.warm_starts.get(np.shape(B)) if self.warm_start else None
+        X, self.n_iter, converged = block_pcg(self.A, B, self.M, X0=X0,
+                                              rtol=self.rtol,
+                                              maxiter=self.maxiter)
+        if not np.all(converged):
+            if self.direct is None:
+                self.direct = SparseLUFactor(self.A)
+            X = X.reshape(self.A.shape[0], -1)
+            B2 = np.asarray(B, dtype=np.float64).reshape(self.A.shape[0], -1)
+            X[:, ~converged] = self.direct(B2[:, ~converged])
+            X = X.reshape(np.shape(B))
+        if self.warm_start:
+            self.warm_starts[np.shape(B)] = X
+        return X
+
+
+def pcg_preconditioner(A, kind="ilu", drop_tol=1e-4, fill_factor=4):
+    """Returns a function applying the preconditioner M^-1 ~ A^-1 to the
+    columns of a matrix (see PCGSolver)
+    """
+    if kind is None:
+        return lambda R: R
+    if kind == "jacobi":
+        diag = A.diagonal()
+        return lambda R: (R.T / diag).T
+    if kind == "ilu":
+        # no pivoting or column permutation so the factors stay close to
+        # the (symmetric) incomplete cholesky factors of the m-matrix
+        ilu = spla.spilu(sp.csc_matrix(A), drop_tol=drop_tol,
+                         fill_factor=fill_factor, permc_spec="NATURAL",
+                         diag_pivot_thresh=0.0)
+        return ilu.solve
+    if kind == "amg":
+        try:
+            import pyamg
+        except ImportError:
+            raise ImportError("the amg preconditioner needs pyamg")
+        ml = pyamg.smoothed_aggregation_solver(sp.csr_matrix(A), symmetry="symmetric")
+        M = ml.aspreconditioner(cycle="V")
+
+        def apply(R):
+            if R.ndim == 1:
+                return M @ R
+            return np.column_stack([M @ R[:, j] for j in range(R.shape[1])])
+        return apply
+    raise ValueError("unknown preconditioner {}".format(kind))
+
+
+def block_pcg(A, B, M, X0=None, rtol=1e-10, maxiter=None):
+    """Preconditioned conjugate gradients for A X = B on all the columns of
+    B at once (one sparse product per iteration for the columns that have
+    not converged yet)
+
+    Args:
+        A (:obj:`scipy.sparse.csc_matrix`): s.p.d. matrix
+        B (:obj:`numpy.ndarray`): right hand side, vector or matrix
+        M (:obj:`function`): applies the preconditioner to the columns of a
+            matrix
+        X0 (:obj:`numpy.ndarray`): starting point, zeros if None
+        rtol (:obj:`float`): relative residual at convergence
+        maxiter (:obj:`int`): maximum number of iterations (default n)
+
+    Returns:
+        X (:obj:`numpy.ndarray`): solution with the shape of B
+        n_iter (:obj:`int`): number of iterations
+        converged (:obj:`numpy.ndarray`): whether each column of B converged
+    """
+    n = A.shape[0]
+    B2 = np.asarray(B, dtype=np.float64).reshape(n, -1)
+    X = np.zeros_like(B2) if X0 is None else np.array(X0, dtype=np.float64).reshape(n, -1)
+    maxiter = n if maxiter is None else maxiter
+
+    R = B2 - A @ X
+    Z = M(R)
+    P = Z.copy()
+    rz = np.sum(R * Z, axis=0)
+    tol = rtol * np.maximum(np.linalg.norm(B2, axis=0), np.finfo(float).tiny)
+    active = np.flatnonzero(np.linalg.norm(R, axis=0) > tol)
+    n_iter = 0
+    while active.size > 0 and n_iter < maxiter:
+        n_iter += 1
+        P_a = P[:, active]
+        AP = A @ P_a
+        alpha = rz[active] / np.sum(P_a * AP, axis=0)
+        X[:, active] += alpha * P_a
+        R[:, active] -= alpha * AP
+        Z = M(R[:, active])
+        rz_new = np.sum(R[:, active] * Z, axis=0)
+        P[:, active] = Z + (rz_new / rz[active]) * P_a
+        rz[active] = rz_new
+        active = active[np.linalg.norm(R[:, active], axis=0) > tol[active]]
+    converged = np.ones(B2.shape[1], dtype=bool)
+    converged[active] = False
+    return X.reshape(np.shape(B)), n_iter, converged
+
+
+def inverse_diag_by_solves(A, chunk_size=256):
+    """Diagonal of the inverse of the sparse matrix A by solves against
+    blocks of unit vectors with a sparse LU factorization (used when the LU
+    factor can't be used for the selected inversion)
+    """
+    n = A.shape[0]
+    lu = spla.splu(sp.csc_matrix(A))
+    diag = np.empty(n)
+    for start in range(0, n, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, n))
+        E = np.zeros((n, len(idx)))
+        E[idx, np.arange(len(idx))] = 1.0
+        diag[idx] = lu.solve(E)[idx, np.arange(len(idx))]
+    return diag
+
+
+class LowRankUpdatedFactor(object):
+    def __init__(self, factor, U, c):
+        """Solves and log-determinant of A + U diag(c) U^T from the sparse
+        cholesky factor of A by the woodbury identity (same interface as the
+        cholmod factor)
+
+        Args:
+            factor (:obj:`sksparse.cholmod.Factor`): cholesky factor of A (or
+                SparseLUFactor)
+            U (:obj:`numpy.ndarray`): n x k matrix of the low rank term
+            c (:obj:`numpy.ndarray`): k non-zero weights of the low rank term
+        """
+        self.factor = factor
+        self.U = U
+        self.AU = factor(U)
+        self.cap = np.diag(1.0 / c) + U.T @ self.AU
+        self._logdet = (
+            factor.logdet()
+            + np.sum(np.log(np.abs(c)))
+            + np.linalg.slogdet(self.cap)[1]
+        )
+
+    def __call__(self, B):
+        AB = self.factor(B)
+        return AB - self.AU @ np.linalg.solve(self.cap, self.U.T @ AB)
+
+    def logdet(self):
+        return self._logdet
+
+
+class SparseLUFactor(object):
+    def __init__(self, A):
+        """Sparse LU factorization of the s.p.d. matrix A with the solve and
+        log-determinant interface of the cholmod factor, used when
+        scikit-sparse is not installed (the iterative solver has no
+        log-determinant)
+
+        Args:
+            A (:obj:`scipy.sparse.csc_matrix`): sparse s.p.d. matrix
+        """
+        self.lu = spla.splu(
+            sp.csc_matrix(A),
+            permc_spec="MMD_AT_PLUS_A",
+            options=dict(SymmetricMode=True),
+        )
+
+    def cholesky(self, A):
+        return SparseLUFactor(A)
+
+    def __call__(self, B):
+        return self.lu.solve(np.asarray(B, dtype=np.float64))
+
+    def logdet(self):
+        # L has a unit diagonal and det(A) > 0
+        return np.sum(np.log(np.abs(self.lu.U.diagonal())))
+
+
+def sparse_spd_factor(A):
+    """Sparse factor of the s.p.d. matrix A, cholmod (with the cached symbolic
+    analysis) if it is installed and SparseLUFactor otherwise"""
+    if cholmod is None:
+        return SparseLUFactor(A)
+    return symbolic_analysis(A).cholesky(A)
+
+
+def laplacian_buffers(nnz_idx, n_nodes, n_observed):
+    """Preallocates the weight matrix, degree matrix, graph laplacian and its
+    blocks in csc format for a fixed set of edges, with the indices to
+    scatter the edge weights into their data arrays
+
+    Args:
+        nnz_idx (:obj:`tuple` of :obj:`numpy.ndarray`): rows and columns of
+            the edges in the upper triangle of the (permuted) adjacency matrix
+        n_nodes (:obj:`int`): number of nodes
+        n_observed (:obj:`int`): number of observed nodes (ordered first)
+
+    Returns:
+        buffers (:obj:`dict`): "W", "D", "L" and "L_block" matrices and the
+            scatter / gather indices used by update_laplacian_buffers
+    """
+    row, col = nnz_idx
+    n_edges = len(row)
+    diag = np.arange(n_nodes)
+    shape = (n_nodes, n_nodes)
+
+    # label the entries 1, 2, ... in the order (upper, lower, diagonal) and
+    # read back where each label lands in the data array of the csc matrix
+    labels = np.arange(1, 2 * n_edges + n_nodes + 1, dtype=np.float64)
+    L = sp.csc_matrix(
+        (labels, (np.r_[row, col, diag], np.r_[col, row, diag])), shape=shape
+    )
+    L_pos = np.empty(len(labels), dtype=np.int64)
+    L_pos[L.data.astype(np.int64) - 1] = np.arange(len(labels))
+
+    # blocks of L gather their entries from L.data through the labels
+    o = n_observed
+    slices = {
+        "oo": (slice(None, o), slice(None, o)),
+        "dd": (slice(o, None), slice(o, None)),
+        "do": (slice(o, None), slice(None, o)),
+        "od": (slice(None, o), slice(o, None)),
+    }
+    L_block, block_idx = {}, {}
+    for name, (rows, cols) in slices.items():
+        L_block[name] = L[rows, cols]
+        block_idx[name] = L_pos[L_block[name].data.astype(np.int64) - 1]
+
+    W = sp.csc_matrix(
+        (labels[: 2 * n_edges], (np.r_[row, col], np.r_[col, row])), shape=shape
+    )
+    W_pos = np.empty(2 * n_edges, dtype=np.int64)
+    W_pos[W.data.astype(np.int64) - 1] = np.arange(2 * n_edges)
+
+    return {
+        "nnz_idx": nnz_idx,
+        "W": W,
+        "D": sp.identity(n_nodes, format="csc"),
+        "L": L,
+        "L_block": L_block,
+        "W_upper": W_pos[:n_edges],
+        "W_lower": W_pos[n_edges:],
+        "L_upper": L_pos[:n_edges],
+        "L_lower": L_pos[n_edges : 2 * n_edges],
+        "L_diag": L_pos[2 * n_edges :],
+        "block_idx": block_idx,
+    }
+
+
+def update_laplacian_buffers(buffers, w):
+    """Writes the edge weights w into the preallocated matrices from
+    laplacian_buffers (no sparse matrices are allocated)
+    """
+    W, D, L = buffers["W"], buffers["D"], buffers["L"]
+    W.data[buffers["W_upper"]] = w
+    W.data[buffers["W_lower"]] = w
+    # same order of summation as W.sum(axis=1)
+    D.data[:] = W @ np.ones(W.shape[0])
+    L.data[buffers["L_upper"]] = -w
+    L.data[buffers["L_lower"]] = -w
+    L.data[buffers["L_diag"]] = D.data
+    for name, block in buffers["L_block"].items():
+        np.take(L.data, buffers["block_idx"][name], out=block.data)
+
+
+def symbolic_analysis(A):
+    """Symbolic cholmod analysis of the sparse matrix A, cached by the
+    sparsity pattern so graphs with the same pattern (e.g. copies of the
+    graph or repeated CV runs) only do the numeric factorization
+
+    Args:
+        A (:obj:`scipy.sparse.csc_matrix`): sparse symmetric matrix
+
+    Returns:
+        analysis (:obj:`sksparse.cholmod.Factor`): factor holding only the
+            symbolic analysis, call analysis.cholesky(A) to factor A
+    """
+    if cholmod is None:
+        raise ImportError(
+            "scikit-sparse (cholmod) is not installed, use the iterative "
+            "solver with sp_graph.set_solver('pcg')"
+        )
+    A = sp.csc_matrix(A)
+    h = hashlib.sha1()
+    h.update(np.array(A.shape, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(A.indptr, dtype=np.int64).tobytes())
+    h.update(np.ascontiguousarray(A.indices, dtype=np.int64).tobytes())
+    key = h.hexdigest()
+
+    if key in _symbolic_cache:
+        _symbolic_cache.move_to_end(key)
+        return _symbolic_cache[key]
+
+    analysis = cholmod.analyze(A)
+    _symbolic_cache[key] = analysis
+    if len(_symbolic_cache) > SYMBOLIC_CACHE_SIZE:
+        _symbolic_cache.popitem(last=False)
+    return analysis
+
+
+def selected_inverse_diag(A):
+    """Diagonal of the inverse of the sparse symmetric positive definite
+    matrix A by selected inversion (Takahashi recurrences) on its sparse
+    factor A[P, P] = L D L^T. Only the entries of the inverse on the (filled)
+    sparsity pattern of L are computed, which costs about as much as the
+    factorization itself. The factor is the cholmod cholesky factor or, when
+    scikit-sparse is not installed, the sparse LU factor with diagonal pivots
+    (U = D L^T for a s.p.d. matrix)
+
+    Args:
+        A (:obj:`scipy.sparse.csc_matrix`): sparse s.p.d. matrix
+
+    Returns:
+        diag (:obj:`numpy.ndarray`): diagonal of the inverse of A
+    """
+    A = sp.csc_matrix(A)
+    if cholmod is None:
+        lu = spla.splu(
+            A,
+            permc_spec="MMD_AT_PLUS_A",
+            diag_pivot_thresh=0.0,
+            options=dict(SymmetricMode=True),
+        )
+        if not np.array_equal(lu.perm_r, lu.perm_c):
+            # rows were pivoted so the factor isn't symmetric
+            return inverse_diag_by_solves(A)
+        L = sp.csc_matrix(lu.L)
+        L.sort_indices()
+        return takahashi_inverse_diag(L, lu.U.diagonal())[lu.perm_c]
+
+    factor = symbolic_analysis(A).cholesky(A)
+    L = sp.csc_matrix(factor.L())
+    l_diag = L.diagonal()
+    L = sp.csc_matrix(L @ sp.diags(1.0 / l_diag))  # unit diagonal
+    L.sort_indices()
+    diag = np.empty(L.shape[0])
+    diag[factor.P()] = takahashi_inverse_diag(L, l_diag ** 2)
+    return diag
+
+
+def takahashi_inverse_diag(L, d):
+    """Diagonal of the inverse of L diag(d) L^T by the Takahashi recurrences
+
+    Args:
+        L (:obj:`scipy.sparse.csc_matrix`): unit lower triangular factor with
+            sorted indices and a closed (filled) sparsity pattern
+        d (:obj:`numpy.ndarray`): pivots
+
+    Returns:
+        diag (:obj:`numpy.ndarray`): diagonal of the inverse
+    """
+    indptr, indices, data = L.indptr, L.indices, L.data
+
+    # entries of the inverse Z on the pattern of L, columns from last to first:
+    # Z_ij = -sum_k L_kj Z_ki and Z_jj = 1 / d_j - sum_k L_kj Z_kj over the
+    # rows k > j of column j, the diagonal is first in each column
+    Z = np.zeros(data.shape[0])
+    for j in range(L.shape[0] - 1, -1, -1):
+        start, stop = indptr[j], indptr[j + 1]
+        rows = indices[start + 1 : stop]
+        l = data[start + 1 : stop]
+
+        # gather Z[rows, rows] from the columns already computed, the pattern
+        # of L is closed so all of them are stored
+        Z_rows = np.empty((rows.shape[0], rows.shape[0]))
+        for a, k in enumerate(rows):
+            k_start, k_stop = indptr[k], indptr[k + 1]
+            pos = k_start + np.searchsorted(indices[k_start:k_stop], rows[a:])
+            Z_rows[a:, a] = Z[pos]
+            Z_rows[a, a + 1 :] = Z[pos[1:]]
+
+        z = -Z_rows @ l
+        Z[start + 1 : stop] = z
+        Z[start] = 1.0 / d[j] - l @ z
+
+    return Z[indptr[:-1]]
+
+
+def graph_cache_key(node_pos, edges, assned_node_idx, metric="euclidean"):
+    """Content hash of the grid and of the sample to node assignment used to
+    key the on-disk cache of graph operators
+    """
+    h = hashlib.sha1()
+    h.update("v{}-{}".format(GRAPH_CACHE_VERSION, metric).encode())
+    for arr, dtype in ((node_pos, np.float64), (edges, np.int64), (assned_node_idx, np.int64)):
+        arr = np.ascontiguousarray(arr, dtype=dtype)
+        h.update(str(arr.shape).encode())
+        h.update(arr.tobytes())
+    return h.hexdigest()
+
+def edge_incidence_matrix(nnz_idx, n_nodes):
+    """Signed incidence matrix on the edges, i.e. one row per pair of edges
+    (i < j) that share a node with +1 in column i and -1 in column j. Rows are
+    ordered by i and then j.
+
+    The pairs are read off the upper triangle of N^T N where N is the unsigned
+    node-edge incidence matrix, so the cost is O(E * degree) instead of the
+    O(E^2) loop over all pairs of edges.
+
+    Args:
+        nnz_idx (:obj:`tuple`): (row, col) node indices of each edge
+        n_nodes (:obj:`int`): number of nodes in the graph
+
+    Returns:
+        Delta (:obj:`scipy.sparse.csc_matrix`): n_pairs x n_edges operator
+    """
+    n_edges = nnz_idx[0].shape[0]
+    edge_idx = np.arange(n_edges)
+
+    # unsigned node-edge incidence matrix
+    N = sp.csr_matrix(
+        (np.ones(2 * n_edges), (np.r_[nnz_idx[0], nnz_idx[1]], np.r_[edge_idx, edge_idx])),
+        shape=(n_nodes, n_edges),
+    )
+
+    # nonzeros above the diagonal of N^T N are the adjacent pairs of edges
+    A = sp.triu(N.T @ N, k=1).tocsr()
+    A.sort_indices()
+    row = np.repeat(edge_idx, np.diff(A.indptr))
+    col = A.indices
+
+    n_pairs = col.shape[0]
+    pair_idx = np.arange(n_pairs)
+    Delta = sp.csc_matrix(
+        (
+            np.r_[np.ones(n_pairs), -np.ones(n_pairs)],
+            (np.r_[pair_idx, pair_idx], np.r_[row, col]),
+        ),
+        shape=(n_pairs, n_edges),
+    )
+    return Delta
+
+def sample_indicator_matrix(deme_idx, n_demes):
+    """Sparse (n_demes x n_samples) matrix with a one at (k, i) if sample i
+    is on deme k, samples with deme index -1 are left out
+
+    Args:
+        deme_idx (:obj:`numpy.ndarray`): deme of each sample
+        n_demes (:obj:`int`): number of demes
+
+    Returns:
+        Z (:obj:`scipy.sparse.csr_matrix`): indicator matrix
+    """
+    deme_idx = np.asarray(deme_idx)
+    (cols,) = np.nonzero(deme_idx >= 0)
+    Z = sp.csr_matrix(
+        (np.ones(cols.shape[0]), (deme_idx[cols], cols)),
+        shape=(n_demes, deme_idx.shape[0]),
+    )
+    return Z
+
+
+def compact_genotypes(genotypes, chunk_snps=10000):
+    """Converts genotypes to int8 with missing genotypes (np.nan or negative
+    integers) coded as GENOTYPE_MISSING. Genotypes which are not all 0, 1 or
+    2 (e.g. dosages or imputed genotypes) are returned unchanged
+
+    Args:
+        genotypes (:obj:`numpy.ndarray`): genotypes (samples x SNPs)
+        chunk_snps (:obj:`int`): number of SNPs converted per block
+
+    Returns:
+        genotypes (:obj:`numpy.ndarray`): compact genotypes
+    """
+    if genotypes.dtype == np.int8:
+        return genotypes
+
+    compact = np.empty(genotypes.shape, dtype=np.int8)
+    for start in range(0, genotypes.shape[1], chunk_snps):
+        g = genotypes[:, start : start + chunk_snps]
+        missing = missing_genotypes(g)
+        if not np.all(missing | (g == 0) | (g == 1) | (g == 2)):
+            return genotypes
+        compact[:, start : start + chunk_snps] = np.where(missing, GENOTYPE_MISSING, g)
+    return compact
+
+
+class GenotypeRows(object):
+    def __init__(self, genotypes, rows):
+        """Read only view of a subset of the rows (samples) of a genotype
+        matrix, the rows are only gathered when they are read (e.g. one block
+        of SNPs at a time) so the genotypes of cross-validation folds are
+        never copied. A view of a view refers to the original matrix
+
+        Args:
+            genotypes (:obj:`numpy.ndarray`): genotypes (samples x SNPs) or a
+                GenotypeRows view
+            rows (:obj:`numpy.ndarray`): indices or boolean mask of the rows
+        """
+        rows = np.arange(genotypes.shape[0])[rows]
+        if isinstance(genotypes, GenotypeRows):
+            rows = genotypes.rows[rows]
+            genotypes = genotypes.genotypes
+        self.genotypes = genotypes
+        self.rows = rows
+
+    @property
+    def shape(self):
+        return (self.rows.shape[0], self.genotypes.shape[1])
+
+    @property
+    def dtype(self):
+        return self.genotypes.dtype
+
+    @property
+    def ndim(self):
+        return 2
+
+    def __len__(self):
+        return self.rows.shape[0]
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            return self.genotypes[self.rows[key]]
+        rows, cols = key
+        # select the SNPs first so only those columns of the rows are copied
+        return self.genotypes[:, cols][self.rows[rows]]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self.genotypes[self.rows], dtype=dtype)
+
+
+def missing_genotypes(genotypes):
+    """Boolean mask of the missing genotypes, np.nan for float genotypes and
+    negative values (GENOTYPE_MISSING) for integer genotypes
+    """
+    if np.issubdtype(genotypes.dtype, np.integer):
+        return genotypes < 0
+    return np.isnan(genotypes)
+
+
+def count_alleles(genotypes, chunk_snps=10000):
+    """Counts the alternative alleles and the observed (non-missing)
+    genotypes of each SNP, in blocks of SNPs
+
+    Args:
+        genotypes (:obj:`numpy.ndarray`): genotypes (samples x SNPs), missing
+            genotypes are np.nan (or GENOTYPE_MISSING in compact storage)
+        chunk_snps (:obj:`int`): number of SNPs per block
+
+    Returns:
+        alt_counts (:obj:`numpy.ndarray`): alternative allele counts
+        n_called (:obj:`numpy.ndarray`): number of observed genotypes
+    """
+    n_samples, n_snps = genotypes.shape
+    alt_counts = np.empty(n_snps)
+    n_called = np.empty(n_snps)
+    for start in range(0, n_snps, chunk_snps):
+        g = genotypes[:, start : start + chunk_snps]
+        missing = missing_genotypes(g)
+        if missing.any():
+            alt_counts[start : start + chunk_snps] = np.where(missing, 0.0, g).sum(axis=0)
+            n_called[start : start + chunk_snps] = n_samples - missing.sum(axis=0)
+        else:
+            alt_counts[start : start + chunk_snps] = g.sum(axis=0)
+            n_called[start : start + chunk_snps] = n_samples
+    return alt_counts, n_called
+
+
+def deme_allele_frequencies(genotypes, Z, n_per_deme):
+    """Allele frequencies on each deme from the observed genotypes. A deme
+    without any observed genotype at a SNP gets the mean frequency of the
+    other demes at that SNP
+
+    Args:
+        genotypes (:obj:`numpy.ndarray`): genotypes (samples x SNPs), missing
+            genotypes are np.nan (or GENOTYPE_MISSING in compact storage)
+        Z (:obj:`scipy.sparse.csr_matrix`): sample indicator matrix
+            (demes x samples)
+        n_per_deme (:obj:`numpy.ndarray`): number of samples per deme
+
+    Returns:
+        frequencies (:obj:`numpy.ndarray`): allele frequencies (demes x SNPs)
+        n_calls (:obj:`numpy.ndarray`): number of observed genotypes per deme
+            and SNP, None if no genotypes are missing
+    """
+    missing = missing_genotypes(genotypes)
+    if not missing.any():
+        frequencies = Z @ genotypes / n_per_deme[:, np.newaxis] / 2
+        return frequencies, None
+
+    n_calls = Z @ (~missing).astype(float)
+    frequencies = frequencies_from_counts(Z @ np.where(missing, 0.0, genotypes), n_calls)
+    return frequencies, n_calls
+
+
+def frequencies_from_counts(allele_counts, n_calls):
+    """Allele frequencies on each deme from the allele counts and the number
+    of observed genotypes. A deme without any observed genotype at a SNP
+    gets the mean frequency of the other demes at that SNP
+
+    Args:
+        allele_counts (:obj:`numpy.ndarray`): alternative allele counts
+            (demes x SNPs)
+        n_calls (:obj:`numpy.ndarray`): number of observed genotypes
+            (demes x SNPs)
+
+    Returns:
+        frequencies (:obj:`numpy.ndarray`): allele frequencies (demes x SNPs)
+    """
+    frequencies = allele_counts / np.maximum(n_calls, 1) / 2
+    called = n_calls > 0
+    if np.all(called):
+        return frequencies
+    f_mean = frequencies.sum(axis=0) / np.maximum(called.sum(axis=0), 1)
+    return np.where(called, frequencies, f_mean)
+
+
+def sample_covariance_terms(frequencies, n_calls):
+    """Sum of products of the allele frequencies over SNPs and the number of
+    SNPs they were summed over for each pair of demes (only the SNPs observed
+    on both demes count when genotypes are missing)
+
+    Args:
+        frequencies (:obj:`numpy.ndarray`): allele frequencies (demes x SNPs)
+        n_calls (:obj:`numpy.ndarray`): number of observed genotypes per deme
+            and SNP or None
+
+    Returns:
+        FFt (:obj:`numpy.ndarray`): sum of products (demes x demes)
+        n_pairs (:obj:`numpy.ndarray` or :obj:`int`): number of SNPs
+    """
+    if n_calls is None:
+        return frequencies @ frequencies.T, frequencies.shape[1]
+
+    called = (n_calls > 0).astype(float)
+    f = frequencies * called
+    return f @ f.T, called @ called.T
+
+
 def query_node_attributes(graph, name):
     """Query the node attributes of a nx graph. This wraps get_node_attributes
-    and returns an array of values for each node instead of the dict
+    and returns an array of values for each node instead of the dict (for a
+    SpatialGraph a copy of the stored array is returned)
     """
+    node_attrs = getattr(graph, "_node_attrs", {})
+    if name in node_attrs:
+        return node_attrs[name].copy()
     d = nx.get_node_attributes(graph, name)
     arr = np.array(list(d.values()))
     return arr
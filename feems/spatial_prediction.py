@@ -1,5 +1,5 @@
 from .objective import Objective, comp_mats
-from .spatial_graph import query_node_attributes
+from .spatial_graph import query_node_attributes, missing_genotypes
 from .cross_validation import train_test_split
 
 import numpy as np
@@ -26,9 +26,6 @@ def predict_held_out_samples(sp_graph, coord, predict_type='point_mu', fit_feems
     permuted_idx = query_node_attributes(sp_graph, "permuted_idx")
 
 
-    # deepcopy doesn't like sp_graph.factor...
-    sp_graph.factor = None
-    
     # remove test demes from training
     n = sp_graph.sample_pos.shape[0]
     split = ~np.isnan(coord[:, 0])
@@ -49,9 +46,9 @@ def predict_held_out_samples(sp_graph, coord, predict_type='point_mu', fit_feems
         sp_graph_train.fit(**fit_kwargs)
 
 
-    # get genotypes of test deme
+    # get genotypes of test deme (missing or imputed genotypes are skipped
+    # when computing the assignment probabilities)
     g = sp_graph.genotypes
-    g[~np.isclose(g, g.astype(int))] = np.nan
     
     # predict
     if predict_type == 'point_mu':
@@ -106,9 +103,6 @@ def leave_node_out_spatial_prediction(sp_graph, predict_type='point_mu', fit_fee
 
     for node, samples in list(obsnode2sample.items())[:max_nodes]:
         print('fit feems w/o observations @ node: {}'.format(node))
-        # deepcopy doesn't like sp_graph.factor...
-        sp_graph.factor = None
-        
         # remove deme from training
         n = sp_graph.sample_pos.shape[0]
         split = ~np.isin(np.arange(n), samples)
@@ -120,14 +114,9 @@ def leave_node_out_spatial_prediction(sp_graph, predict_type='point_mu', fit_fee
                 fit_kwargs['lamb'] = 20.
                 sp_graph_train.fit(**fit_kwargs)
 
-        # get genotypes of test deme
-        g = sp_graph_test.genotypes
-
-        # this is a bit hacky... set non-integer genotypes to nan
-        # if genotypes aren't [0, 1, 2] they're imputed
-        # and I didn't want them to contribute towards the prediction
-        # TODO: skip step or have safer way of doing it
-        g[~np.isclose(sp_graph_test.genotypes, sp_graph_test.genotypes.astype(int))] = np.nan
+        # get genotypes of test deme (the split graphs don't keep a copy),
+        # missing or imputed genotypes are skipped in the prediction
+        g = sp_graph.genotypes[~split, :]
         
         # predict
         if predict_type == 'point_mu':
@@ -137,8 +126,6 @@ def leave_node_out_spatial_prediction(sp_graph, predict_type='point_mu', fit_fee
         if predict_type == 'trunc':
             z, post_mean = predict_deme_trunc_normal_mu(g, sp_graph_train)
 
-        sp_graph_train.factor = None  # avoids error when copying graph
-
         results[node] = {
             'post_assignment': z, # assignment probabilities
             'w': sp_graph_train.w, # 
@@ -157,14 +144,27 @@ def logsumexp(x):
     c = x.max(1)
     return c + np.log(np.sum(np.exp(x - c[:, None]), 1))
 
-def _compute_assignment_probabilities_point_mu(g, f, pi=None, eps=1e-5):
+def _observed_genotypes(g):
+    """
+    genotypes as floats with missing (nan or GENOTYPE_MISSING) and imputed
+    (non-integer) genotypes set to zero, and the mask of observed genotypes
+
+    g: genotypes [samples x snps], float or compact int8
+    """
+    observed = ~missing_genotypes(g)
+    if not np.issubdtype(g.dtype, np.integer):
+        observed &= np.isclose(g, np.round(g))
+    return np.where(observed, g, 0.), observed
+
+def _compute_assignment_probabilities_point_mu(g, f, pi=None, eps=1e-5, chunk_snps=10000):
     """
     compute assignment probabilities using point estimates of allele frequencies
 
-    g: genotypes [samples x snps]
+    g: genotypes [samples x snps], float or compact int8
     f: point estimates of allele frequencies [snps x demes]
     pi: prior over demes, vector of positive values that sums to one
     eps: small positive value used to truncate frequences [eps, 1-eps]
+    chunk_snps: number of snps processed at once
     """
     if pi is None:
         pi = np.atleast_2d([0])
@@ -177,9 +177,14 @@ def _compute_assignment_probabilities_point_mu(g, f, pi=None, eps=1e-5):
     lp = np.log(f_clip)
     lq = np.log(1 - f_clip)
     g = np.atleast_2d(g)
-    c = np.log(np.isclose(g, 1) + 1)  # (2 choose g)
 
-    z = (lp @ np.nan_to_num(g.T) + lq @ np.nan_to_num(2 - g.T)).T
+    # loop over blocks of snps so only a block of the genotypes is ever
+    # converted to floats
+    z = np.zeros((g.shape[0], f.shape[0]))
+    for start in range(0, g.shape[1], chunk_snps):
+        blk = slice(start, start + chunk_snps)
+        g_obs, observed = _observed_genotypes(g[:, blk])
+        z += (lp[:, blk] @ g_obs.T + lq[:, blk] @ (2 * observed - g_obs).T).T
     z = z + pi
     z = z - logsumexp(z)[:, None]
     return z
@@ -203,13 +208,14 @@ def _truncated_moments(mu, scale, a=0, b=1):
         - scale * (m1 - mu)**2
     return m1, var
 
-def _compute_assignment_probabilities_trunc_normal(g, mu, var, pi=None, eps=1e-5):
+def _compute_assignment_probabilities_trunc_normal(g, mu, var, pi=None, eps=1e-5, chunk_snps=10000):
     """
     compute assignment probabilities integrating over truncated FEEMS posterior
 
-    g: genotypes [samples x snps]
+    g: genotypes [samples x snps], float or compact int8
     mu: posterior mean allele frequency [snps x demes]
     var: posterior variance allele frequency [snps x demes]
+    chunk_snps: number of snps processed at once
     """
     if pi is None:
         pi = np.atleast_2d([0])
@@ -220,9 +226,17 @@ def _compute_assignment_probabilities_trunc_normal(g, mu, var, pi=None, eps=1e-5
 
     f, v = _truncated_moments(mu, np.sqrt(var))
     f2 = v + f ** 2
-    z = (np.log(f2) @ (g.T == 2) +
-        np.log(2 * (f - f2)) @ (g.T == 1) +
-        np.log(1 - 2*f + f2) @ (g.T == 0)).T
+    lp2 = np.log(f2)
+    lp1 = np.log(2 * (f - f2))
+    lp0 = np.log(1 - 2*f + f2)
+    g = np.atleast_2d(g)
+    z = np.zeros((g.shape[0], f.shape[0]))
+    for start in range(0, g.shape[1], chunk_snps):
+        blk = slice(start, start + chunk_snps)
+        g_obs, observed = _observed_genotypes(g[:, blk])
+        z += (lp2[:, blk] @ ((g_obs == 2) & observed).T +
+              lp1[:, blk] @ ((g_obs == 1) & observed).T +
+              lp0[:, blk] @ ((g_obs == 0) & observed).T).T
     z = z + pi
     z = z - logsumexp(z)[:, None]
     return z
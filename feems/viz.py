@@ -152,7 +152,7 @@ class Viz(object):
         self.c_cmap = plt.get_cmap('Greys')
 
         # extract node positions on the lattice
-        self.idx = nx.adjacency_matrix(self.sp_graph).nonzero()
+        self.idx = self.sp_graph.adj_csr.nonzero()
 
         # edge weights
         if weights is None:
@@ -278,7 +278,7 @@ class Viz(object):
         if not use_foldchange:
             if use_weights:
                 nx.draw(
-                    self.sp_graph,
+                    self.sp_graph.nx_graph,
                     ax=self.ax,
                     node_size=0.0,
                     edge_cmap=self.edge_cmap,
@@ -293,7 +293,7 @@ class Viz(object):
                 )
             else:
                 nx.draw(
-                    self.sp_graph,
+                    self.sp_graph.nx_graph,
                     ax=self.ax,
                     node_size=0.0,
                     alpha=self.edge_alpha,
@@ -304,7 +304,7 @@ class Viz(object):
                 )
         else:
             nx.draw(
-                    self.sp_graph,
+                    self.sp_graph.nx_graph,
                     ax=self.ax,
                     node_size=0.0,
                     edge_cmap=self.edge_cmap,
@@ -994,7 +994,7 @@ def recover_nnz_entries(sp_graph):
     """Permute W matrix and vectorize according to the CSC index format"""
     W = sp_graph.inv_triu(sp_graph.w, perm=False)
     w = np.array([])
-    idx = nx.adjacency_matrix(sp_graph).nonzero()
+    idx = sp_graph.adj_csr.nonzero()
     idx = list(np.column_stack(idx))
     for i in range(len(idx)):
         w = np.append(w, W[idx[i][0], idx[i][1]])
@@ -1006,7 +1006,7 @@ def recover_nnz_entries_foldchange(sp_graph, oldweights):
     # norm_weights = (sp_graph.w - np.mean(sp_graph.w))/np.std(sp_graph.w)
     W = sp_graph.inv_triu((sp_graph.w-oldweights)*100/oldweights, perm=False)
     w = np.array([])
-    idx = nx.adjacency_matrix(sp_graph).nonzero()
+    idx = sp_graph.adj_csr.nonzero()
     idx = list(np.column_stack(idx))
     for i in range(len(idx)):
         w = np.append(w, W[idx[i][0], idx[i][1]])
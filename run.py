@@ -10,7 +10,6 @@
 # base
 import numpy as np
 from importlib import resources
-from sklearn.impute import SimpleImputer
 from pandas_plink import read_plink
 import statsmodels.api as sm
 import pickle
@@ -44,9 +43,8 @@ print('Reading in input data...')
 (bim, fam, G) = read_plink(path_to_plink)
 coord = np.loadtxt(path_to_sample_coords)
 
-# imputing any missing genotypes
-imp = SimpleImputer(missing_values=np.nan, strategy="mean")
-genotypes = imp.fit_transform((np.array(G)).T)
+# missing genotypes (nan) are handled by feems, no need to impute
+genotypes = (np.array(G)).T
 print("n_samples={}, n_snps={}\n".format(genotypes.shape[0], genotypes.shape[1]))
 
 # discrete global grid (DGG), could supply custom triangular grid
@@ -62,6 +60,10 @@ outer, edges, grid, _ = prepare_graph_inputs(coord=coord,
 #---------- GRAPH SETUP ----------
 print('\nSetting up graph...')
 sp_graph = SpatialGraph(genotypes, coord, grid, edges, scale_snps=True)
+# for data sets too large to hold in memory the genotypes can instead be
+# streamed from the plink files in blocks of SNPs (note: no cross-validation
+# possible since the individual genotypes are not kept)
+# sp_graph = SpatialGraph.from_bed(path_to_plink, coord, grid, edges, chunk_snps=10000)
 
 # change projection here
 projection = ccrs.PlateCarree()
@@ -80,6 +82,11 @@ mean_cv_err = np.mean(cv_err, axis=0)
 
 lamb_q_cv = lamb_q_grid[np.where(mean_cv_err == np.min(mean_cv_err))[0][0]]
 lamb_cv = lamb_grid[np.where(mean_cv_err == np.min(mean_cv_err))[1][0]]
+# alternatively, an adaptive search over the same grid (few folds & loose
+# tolerance first, then only the best pairs) needs a fraction of the fits
+# from feems.cross_validation import search_cv_joint
+# cv_search = search_cv_joint(sp_graph, lamb_grid, lamb_q_grid, n_folds=5, factr=1e10)
+# lamb_cv, lamb_q_cv = cv_search["lamb_cv"], cv_search["lamb_q_cv"]
 print(r"\nlambda_CV values: ({}, {})".format(lamb_cv, lamb_q_cv))
 
 #---------- BASELINE FEEMS FIT ----------
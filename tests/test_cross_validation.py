@@ -0,0 +1,148 @@
+from __future__ import absolute_import, division, print_function
+
+import contextlib
+import io
+import unittest
+
+import numpy as np
+from feems import SpatialGraph
+from feems.cross_validation import (copy_spatial_graph, cv_joint_fold,
+                                    cv_pairs_fold, run_cv, run_cv_joint,
+                                    search_cv_joint, setup_k_fold_cv)
+from feems.sim import setup_graph, simulate_genotypes
+
+
+class TestCrossValidation(unittest.TestCase):
+    """Tests for the feems cross-validation on a small simulated graph
+    """
+    # 4 x 6 triangular lattice with a barrier, samples on about 60% of the
+    # nodes
+    np.random.seed(3)
+    with contextlib.redirect_stdout(io.StringIO()):
+        graph, coord, grid, edge = setup_graph(n_rows=4, n_columns=6,
+                                               n_samples_per_node=5,
+                                               sample_prob=0.6, corridor_w=0.5,
+                                               barrier_w=0.1)
+        genotypes = simulate_genotypes(graph, target_n_snps=300)
+        sp_graph = SpatialGraph(genotypes, coord, grid, edge, scale_snps=True)
+
+    lamb_grid = np.array([10.0, 1.0, 0.1])
+    lamb_q_grid = np.array([1.0])
+
+    def run_cv_joint(self, **kwargs):
+        with contextlib.redirect_stdout(io.StringIO()):
+            return run_cv_joint(self.sp_graph, self.lamb_grid,
+                                self.lamb_q_grid, **kwargs)
+
+    def test_n_jobs(self):
+        """Tests that the folds fit on a process pool give the errors of the
+        serial run
+        """
+        cv_err = self.run_cv_joint(n_folds=4)
+        cv_err_pool = self.run_cv_joint(n_folds=4, n_jobs=2, blas_threads=1)
+        np.testing.assert_array_equal(cv_err_pool, cv_err)
+        cv_err_serial = self.run_cv_joint(n_folds=4, blas_threads=1)
+        np.testing.assert_array_equal(cv_err_serial, cv_err)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            cv_err = run_cv(self.sp_graph, self.lamb_grid, n_folds=4)
+            cv_err_pool = run_cv(self.sp_graph, self.lamb_grid, n_folds=4,
+                                 n_jobs=2)
+        np.testing.assert_array_equal(cv_err_pool, cv_err)
+
+    def test_copy_spatial_graph(self):
+        """Tests that the genotypes of a fold are a view of the rows of the
+        full graph and that a fold can be split again
+        """
+        is_train = setup_k_fold_cv(self.sp_graph, 4, random_state=500)
+        sample_train = is_train[:, 0]
+        train_graph = copy_spatial_graph(self.sp_graph, sample_train)
+        self.assertIs(train_graph.genotypes.genotypes, self.sp_graph.genotypes)
+        np.testing.assert_array_equal(
+            np.asarray(train_graph.genotypes),
+            self.sp_graph.genotypes[sample_train])
+        np.testing.assert_array_equal(
+            train_graph.genotypes[:, 5:10],
+            self.sp_graph.genotypes[sample_train, 5:10])
+
+        # split the fold again, same as one split of the full graph
+        keep = np.arange(train_graph.genotypes.shape[0]) % 3 != 0
+        nested_graph = copy_spatial_graph(train_graph, keep)
+        sample_idx = np.flatnonzero(sample_train)[keep]
+        exp_graph = copy_spatial_graph(self.sp_graph, sample_idx)
+        self.assertIs(nested_graph.genotypes.genotypes, self.sp_graph.genotypes)
+        np.testing.assert_array_equal(nested_graph.genotypes.rows, sample_idx)
+        np.testing.assert_array_equal(nested_graph.frequencies,
+                                      exp_graph.frequencies)
+        np.testing.assert_array_equal(nested_graph.S, exp_graph.S)
+
+    def test_approx_loo(self):
+        """Tests that the approximate leave-one-out errors track the exact
+        ones and that the graph is not modified
+        """
+        cv_err = self.run_cv_joint()
+
+        self.sp_graph.fit_null_model(verbose=False)
+        state = (self.sp_graph.w.copy(), np.copy(self.sp_graph.s2),
+                 self.sp_graph.q.copy(), self.sp_graph.L.toarray())
+        cv_err_approx = self.run_cv_joint(approx_loo=True)
+        self.assertEqual(cv_err_approx.shape, cv_err.shape)
+        np.testing.assert_allclose(cv_err_approx, cv_err, rtol=0.1)
+        np.testing.assert_allclose(cv_err_approx.mean(axis=0),
+                                   cv_err.mean(axis=0), rtol=0.05)
+        for before, after in zip(state, (self.sp_graph.w, self.sp_graph.s2,
+                                         self.sp_graph.q,
+                                         self.sp_graph.L.toarray())):
+            np.testing.assert_allclose(after, before)
+
+    def test_cv_pairs_fold(self):
+        """Tests that the fits of the search on the full grid are the ones
+        of run_cv_joint (same warm starts)
+        """
+        self.sp_graph.fit_null_model(verbose=False)
+        is_train = setup_k_fold_cv(self.sp_graph, 5, random_state=500)
+        lamb_q_grid = np.array([10.0, 1.0])
+        kwargs = dict(lamb_grid=self.lamb_grid, lamb_q_grid=lamb_q_grid,
+                      alpha_cv=1.0 / self.sp_graph.w0.mean(),
+                      alpha_q=1.0 / self.sp_graph.s2.mean(),
+                      w0=self.sp_graph.w0, s2=self.sp_graph.s2, lb=1e-6,
+                      ub=1e6, factr=1e10, outer_verbose=False,
+                      inner_verbose=False)
+        cv_err = cv_joint_fold(self.sp_graph, is_train[:, 0], 0, **kwargs)
+
+        # the order of the pairs doesn't matter, the fits are the same up to
+        # the accuracy of the solves
+        pairs = [(i, iq) for i in range(3) for iq in range(2)][::-1]
+        cv_err_pairs = cv_pairs_fold(self.sp_graph, is_train[:, 0], 0,
+                                     pairs=pairs, **kwargs)
+        np.testing.assert_allclose(
+            cv_err_pairs, [cv_err[iq, i] for i, iq in pairs], rtol=1e-10)
+
+    def test_search_cv_joint(self):
+        """Tests that the search takes fewer fits than the grid, and runs the
+        grid when it would not
+        """
+        with contextlib.redirect_stdout(io.StringIO()):
+            search = search_cv_joint(self.sp_graph,
+                                     np.geomspace(10.0, 0.01, 8),
+                                     self.lamb_q_grid)
+        self.assertLess(search["n_fits"], search["n_fits_grid"])
+        self.assertEqual(len(search["rounds"]), 2)
+        self.assertEqual(search["rounds"][-1]["n_folds"],
+                         self.sp_graph.n_observed_nodes)
+        self.assertIn(search["lamb_cv"], np.geomspace(10.0, 0.01, 8))
+
+        # 2 x 2 grid on 5 folds, the refined last round is the full grid
+        lamb_q_grid = np.array([10.0, 1.0])
+        with contextlib.redirect_stdout(io.StringIO()):
+            search = search_cv_joint(self.sp_graph, self.lamb_grid[:2],
+                                     lamb_q_grid, n_folds=5)
+        self.assertEqual(search["n_fits"], search["n_fits_grid"])
+        cv_err = run_cv_joint(self.sp_graph, self.lamb_grid[:2], lamb_q_grid,
+                              n_folds=5, outer_verbose=False)
+        np.testing.assert_allclose(search["mean_cv_err"],
+                                   cv_err.mean(axis=0), rtol=1e-10)
+
+
+if __name__ == "__main__":
+    unittest.main()
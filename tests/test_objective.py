@@ -5,6 +5,8 @@ import unittest
 import numpy as np
 import pkg_resources
 from feems import Objective, SpatialGraph
+from feems.objective import (loss_wrapper, neg_log_lik_w0_s2, comp_null_spectrum,
+                             neg_log_lik_w0_s2_spectral)
 from feems.utils import prepare_graph_inputs
 from pandas_plink import read_plink
 from sklearn.impute import SimpleImputer
@@ -44,6 +46,135 @@ class TestObjective(unittest.TestCase):
         """
         self.assertEqual(self.sp_graph.n_observed_nodes, 78)
 
+    def test_grad_obj_L(self):
+        """Tests the entries of dLoss / dL needed for the gradient against
+        the dense d x d formula
+        """
+        w = np.random.default_rng(0).uniform(0.5, 2.0, self.sp_graph.size())
+        self.sp_graph.comp_graph_laplacian(w)
+        self.obj.inv()
+        self.obj.grad(reg=False)
+        M = self.obj.comp_A - self.obj.comp_B
+        grad_obj_L = self.sp_graph.n_snps * (self.obj.Linv @ M @ self.obj.Linv.T)
+        diag, edges = self.obj._comp_grad_obj_L(M)
+        np.testing.assert_allclose(diag, np.diag(grad_obj_L))
+        np.testing.assert_allclose(edges,
+                                   grad_obj_L[self.sp_graph.nnz_idx_perm])
+
+    def test_neg_log_lik(self):
+        """Tests the log-determinant and trace computed from the cholesky
+        factors against the dense formulas
+        """
+        w = np.random.default_rng(1).uniform(0.5, 2.0, self.sp_graph.size())
+        self.sp_graph.comp_graph_laplacian(w)
+        self.obj.inv()
+        self.obj.neg_log_lik()
+        inv_cov = self.obj.inv_cov
+        self.assertAlmostEqual(self.obj.logdet,
+                               np.linalg.slogdet(inv_cov)[1], places=6)
+        trA = self.sp_graph.S @ inv_cov
+        tr = (np.trace(trA)
+              - self.obj.inv_cov_sum @ trA.sum(axis=1) / self.obj.denom)
+        self.assertAlmostEqual(self.obj.tr, tr, places=6)
+
+    def test_loss_cache(self):
+        """Tests that repeated evaluations of the loss are served from the
+        cache and restore the state of the evaluation
+        """
+        obj = Objective(self.sp_graph)
+        optimize_q = self.sp_graph.optimize_q
+        self.sp_graph.optimize_q = None
+        obj.lamb, obj.alpha = 2.0, 1.0
+        rng = np.random.default_rng(2)
+        z0 = rng.normal(0, 0.1, self.sp_graph.size())
+        z1 = rng.normal(0, 0.1, self.sp_graph.size())
+        loss0, grad0 = loss_wrapper(z0, obj)
+        loss1, grad1 = loss_wrapper(z1, obj)
+        loss, grad = loss_wrapper(z0, obj)
+        self.assertEqual(obj.cache_info()["hits"], 1)
+        self.assertEqual(obj.cache_info()["misses"], 2)
+        self.assertEqual(loss, loss0)
+        np.testing.assert_array_equal(grad, grad0)
+        np.testing.assert_allclose(self.sp_graph.w, np.exp(z0))
+
+        # changing the penalty invalidates the cached evaluations
+        obj.lamb = obj.lamb + 1.0
+        loss_wrapper(z0, obj)
+        self.assertEqual(obj.cache_info()["misses"], 3)
+        self.sp_graph.optimize_q = optimize_q
+
+    def test_float32(self):
+        """Tests the loss and gradient with the float32 matrix products
+        against float64
+        """
+        optimize_q = self.sp_graph.optimize_q
+        self.sp_graph.optimize_q = None
+        z = np.random.default_rng(3).normal(0, 0.3, self.sp_graph.size())
+        res = []
+        for dtype in (np.float64, np.float32):
+            obj = Objective(self.sp_graph, dtype=dtype)
+            obj.lamb, obj.alpha = 2.0, 1.0
+            res.append(loss_wrapper(z, obj))
+        self.sp_graph.optimize_q = optimize_q
+        self.assertEqual(res[1][1].dtype, np.float64)
+        self.assertAlmostEqual(res[0][0], res[1][0], places=6)
+        np.testing.assert_allclose(res[1][1], res[0][1],
+                                   atol=1e-3 * np.abs(res[0][1]).max())
+
+    def test_stochastic(self):
+        """Tests the stochastic loss and gradient against the exact ones when
+        the probe vectors span all the observed nodes (the trace estimate is
+        then exact)
+        """
+        optimize_q = self.sp_graph.optimize_q
+        self.sp_graph.optimize_q = 'n-dim'
+        self.sp_graph.comp_precision(s2=np.ones(len(self.sp_graph)))
+        rng = np.random.default_rng(4)
+        z = np.r_[rng.normal(0, 0.3, self.sp_graph.size()),
+                  rng.normal(0, 0.2, len(self.sp_graph))]
+        res = []
+        for stochastic in (False, True):
+            obj = Objective(self.sp_graph)
+            obj.lamb, obj.alpha, obj.lamb_q, obj.alpha_q = 2.0, 1.0, 1.0, 1.0
+            obj.stochastic = stochastic
+            obj.n_probes = 3 * self.sp_graph.n_observed_nodes
+            res.append(loss_wrapper(z, obj))
+        self.sp_graph.optimize_q = optimize_q
+        self.assertAlmostEqual(res[0][0], res[1][0], places=5)
+        np.testing.assert_allclose(res[1][1], res[0][1], rtol=1e-6, atol=1e-6)
+
+    def test_null_spectrum(self):
+        """Tests that the null model likelihood from the spectrum differs from
+        the full computation by a constant
+        """
+        obj = Objective(self.sp_graph)
+        lam, t = comp_null_spectrum(obj)
+        diffs = []
+        for z in [np.array([0.0, 0.0]), np.array([0.5, -1.0]),
+                  np.array([-1.0, 0.7])]:
+            nll, _, _ = neg_log_lik_w0_s2_spectral(z, lam, t,
+                                                   self.sp_graph.n_snps)
+            diffs.append(neg_log_lik_w0_s2(z, obj) - nll)
+        np.testing.assert_allclose(diffs, diffs[0], rtol=1e-8)
+
+    def test_from_bed(self):
+        """Tests that streaming the genotypes from the bed file in blocks
+        gives the same frequencies and covariance as the full matrix
+        """
+        sp_graph = SpatialGraph.from_bed("{}/wolvesadmix".format(self.data_path),
+                                         self.coord, self.grid, self.edges,
+                                         chunk_snps=5000)
+        self.assertIsNone(sp_graph.genotypes)
+
+        # genotypes with missing data (not imputed)
+        sp_graph_dense = SpatialGraph(np.array(self.G).T, self.coord,
+                                      self.grid, self.edges)
+        self.assertEqual(sp_graph.n_snps, sp_graph_dense.n_snps)
+        np.testing.assert_allclose(sp_graph.frequencies,
+                                   sp_graph_dense.frequencies)
+        np.testing.assert_allclose(sp_graph.n_calls, sp_graph_dense.n_calls)
+        np.testing.assert_allclose(sp_graph.S, sp_graph_dense.S)
+
 
 def dense_neg_log_lik():
     """TODO: fill in function for computation of negative log-likelihood
@@ -1,10 +1,26 @@
 from __future__ import absolute_import, division, print_function
 
+import contextlib
+import io
+import pickle
+from copy import copy
+import tempfile
 import unittest
+from unittest import mock
 
 import networkx as nx
 import numpy as np
-from feems import SpatialGraph, query_node_attributes
+import scipy.sparse as sp
+from feems import Objective, SpatialGraph, query_node_attributes
+from feems.objective import loss_wrapper
+from feems.spatial_graph import selected_inverse_diag
+from feems.multilevel import prolong
+from feems.sim import setup_graph, simulate_genotypes
+
+try:
+    import sksparse.cholmod as cholmod
+except ImportError:
+    cholmod = None
 
 
 class TestSpatialGraph(unittest.TestCase):
@@ -50,6 +66,36 @@ class TestSpatialGraph(unittest.TestCase):
         self.assertEqual(sample_idx_dict[2], [2, 3])
         self.assertEqual(sample_idx_dict[3], [])
 
+    def test_haversine_assignment(self):
+        """Tests that the great circle assignment of samples to nodes wraps
+        around the dateline
+        """
+        node_pos = np.array([[179.0, 10.0], [-170.0, 10.0], [170.0, 10.0]])
+        edges = np.array([[1, 2], [2, 3], [1, 3]])
+        sample_pos = np.array([[-179.5, 10.0], [179.5, 10.0], [-171.0, 10.0]])
+        genotypes = np.array([[0, 1, 2], [1, 1, 0], [2, 0, 1]])
+        sp_graph = SpatialGraph(genotypes, sample_pos, node_pos, edges,
+                                metric="haversine")
+        self.assertEqual(sp_graph.assned_node_idx.tolist(), [0, 0, 1])
+
+    def test_graph_cache(self):
+        """Tests that graph operators loaded from the on-disk cache are the
+        same as the computed ones
+        """
+        with tempfile.TemporaryDirectory() as cache_dir:
+            sp_graph_cold = SpatialGraph(self.genotypes, self.sample_pos,
+                                         self.node_pos, self.edges,
+                                         cache_dir=cache_dir)
+            sp_graph_warm = SpatialGraph(self.genotypes, self.sample_pos,
+                                         self.node_pos, self.edges,
+                                         cache_dir=cache_dir)
+        for name in ["Delta", "Delta_q", "B", "adj_base", "adj_perm"]:
+            self.assertEqual(getattr(sp_graph_cold, name).toarray().tolist(),
+                             getattr(sp_graph_warm, name).toarray().tolist())
+        self.assertEqual(sp_graph_cold.perm_idx.tolist(),
+                         sp_graph_warm.perm_idx.tolist())
+        self.assertEqual(sp_graph_cold.S.tolist(), sp_graph_warm.S.tolist())
+
     def test_permuted_idx(self):
         """Tests permutation of nodes
         """
@@ -77,6 +123,274 @@ class TestSpatialGraph(unittest.TestCase):
         self.assertEqual(self.sp_graph.frequencies.tolist(),
                          exp_freqs.tolist())
 
+    def test_missing_genotypes(self):
+        """Tests allele frequencies and covariance computed from the observed
+        genotypes only
+        """
+        genotypes = np.array([[0., 1., 2.],
+                              [np.nan, 2., 1.],
+                              [1., np.nan, 0.],
+                              [2., np.nan, 0.]])
+        sp_graph = SpatialGraph(genotypes, self.sample_pos, self.node_pos,
+                                self.edges, scale_snps=False)
+        self.assertEqual(sp_graph.genotypes.dtype, np.int8)
+        # deme without any observed genotype gets the mean of the other demes
+        exp_freqs = np.array([[0., 1.5, 1.5],
+                              [1.5, 1.5, 0.]]) / 2
+        np.testing.assert_allclose(sp_graph.frequencies, exp_freqs)
+        np.testing.assert_allclose(sp_graph.n_calls, [[1, 2, 2], [2, 0, 2]])
+        exp_S = np.array([[(1.5**2 + 1.5**2) / 3, 0.],
+                          [0., (1.5**2) / 2]]) / 4
+        np.testing.assert_allclose(sp_graph.S, exp_S)
+
+    def test_from_sufficient_stats(self):
+        """Tests building the graph from allele counts or S on the demes
+        """
+        # demes given in the reverse order of the graph
+        allele_counts = np.vstack([self.genotypes[[2, 3], :].sum(axis=0),
+                                   self.genotypes[[0, 1], :].sum(axis=0)])
+        sp_graph = SpatialGraph.from_sufficient_stats(
+            self.node_pos, self.edges, [2, 0], [2, 2],
+            allele_counts=allele_counts)
+        np.testing.assert_allclose(sp_graph.S, self.sp_graph.S)
+        self.assertEqual(sp_graph.n_snps, self.sp_graph.n_snps)
+
+        S = self.sp_graph.S[::-1, ::-1]
+        sp_graph = SpatialGraph.from_sufficient_stats(
+            self.node_pos, self.edges, [2, 0], [2, 2], S=S,
+            n_snps=self.sp_graph.n_snps)
+        np.testing.assert_allclose(sp_graph.S, self.sp_graph.S)
+        self.assertEqual(
+            sp_graph.n_samples_per_obs_node_permuted.tolist(), [2, 2])
+
+    def test_pickle(self):
+        """Tests that a graph with a cholesky factor can be pickled and its
+        factor recomputed after unpickling
+        """
+        self.sp_graph.comp_graph_laplacian(self.sp_graph.w)
+        self.assertIsNotNone(self.sp_graph.factor)
+        sp_graph = pickle.loads(pickle.dumps(self.sp_graph))
+        self.assertIsNone(sp_graph.factor)
+        sp_graph.comp_graph_laplacian(sp_graph.w)
+        b = np.ones(len(sp_graph) - sp_graph.n_observed_nodes)
+        np.testing.assert_allclose(sp_graph.factor(b),
+                                   self.sp_graph.factor(b))
+
+    def test_nx_edge_mutation(self):
+        """Tests that edges added or removed update the arrays and the
+        networkx graph, are kept by copies and that node attribute queries
+        are copies
+        """
+        sp_graph = SpatialGraph(self.genotypes, self.sample_pos, self.node_pos,
+                                self.edges)
+        n_edges = sp_graph.size()
+        self.assertEqual(sp_graph.nx_graph.number_of_edges(), n_edges)
+        sp_graph.remove_edge(0, 1)
+        self.assertEqual(sp_graph.size(), n_edges - 1)
+        self.assertEqual(sp_graph.size(), len(sp_graph.edges))
+        self.assertNotIn(1, list(sp_graph.neighbors(0)))
+        self.assertFalse(sp_graph.nx_graph.has_edge(0, 1))
+        sp_graph_copy = copy(sp_graph)
+        sp_graph.add_edge(0, 1)
+        self.assertEqual(sp_graph.size(), n_edges)
+        self.assertIn(1, list(sp_graph.neighbors(0)))
+        self.assertTrue(sp_graph.nx_graph.has_edge(0, 1))
+        self.assertEqual(sp_graph_copy.size(), n_edges - 1)
+        self.assertNotIn(1, list(sp_graph_copy.neighbors(0)))
+        self.assertFalse(sp_graph_copy.nx_graph.has_edge(0, 1))
+        with self.assertRaises(ValueError):
+            sp_graph.add_node(len(sp_graph))
+        with self.assertRaises(ValueError):
+            sp_graph.remove_node(0)
+        with self.assertRaises(ValueError):
+            sp_graph.add_edge(0, len(sp_graph))
+        np.testing.assert_array_equal(
+            sp_graph.nodes[2]["sample_idx"],
+            query_node_attributes(sp_graph, "sample_idx")[2])
+
+        n_samples = query_node_attributes(sp_graph, "n_samples")
+        n_samples[:] = -1
+        self.assertTrue(np.all(query_node_attributes(sp_graph, "n_samples") >= 0))
+
+    def test_comp_graph_laplacian(self):
+        """Tests the laplacian updated in place against D - W and that its
+        blocks follow the updates
+        """
+        self.sp_graph.comp_graph_laplacian(self.sp_graph.w)
+        L = self.sp_graph.L
+        L_dd = self.sp_graph.L_block["dd"]
+        for w in [np.linspace(0.5, 2.0, self.sp_graph.size()),
+                  np.linspace(3.0, 1.0, self.sp_graph.size())]:
+            self.sp_graph.comp_graph_laplacian(w)
+            self.assertIs(self.sp_graph.L, L)
+            self.assertIs(self.sp_graph.L_block["dd"], L_dd)
+            W = self.sp_graph.inv_triu(w).toarray()
+            exp_L = np.diag(W.sum(axis=1)) - W
+            np.testing.assert_array_equal(self.sp_graph.L.toarray(), exp_L)
+            o = self.sp_graph.n_observed_nodes
+            np.testing.assert_array_equal(
+                self.sp_graph.L_block["do"].toarray(), exp_L[o:, :o])
+            np.testing.assert_array_equal(L_dd.toarray(), exp_L[o:, o:])
+
+    def test_pcg_solver(self):
+        """Tests the solves against L11 with the iterative solver against the
+        dense solve, when it stops early (solved directly) and warm started
+        """
+        sp_graph = SpatialGraph(self.genotypes, self.sample_pos,
+                                self.node_pos, self.edges)
+        w = np.linspace(0.5, 2.0, sp_graph.size())
+        sp_graph.comp_graph_laplacian(w)
+        B = np.arange(4.0).reshape(2, 2)
+        exp_X = np.linalg.solve(sp_graph.L_block["dd"].toarray(), B)
+        for opts in [{"preconditioner": "ilu"}, {"preconditioner": "jacobi"},
+                     {"preconditioner": None, "maxiter": 0},
+                     {"preconditioner": "jacobi", "warm_start": True}]:
+            sp_graph.set_solver("pcg", **opts)
+            sp_graph.comp_graph_laplacian(w)
+            for _ in range(2):
+                np.testing.assert_allclose(sp_graph.factor(B), exp_X)
+                np.testing.assert_allclose(sp_graph.factor(B[:, 0]),
+                                           exp_X[:, 0])
+
+    @unittest.skipIf(cholmod is None, "scikit-sparse is not installed")
+    def test_pcg_solver_cholmod(self):
+        """Tests the solves against L11 with the iterative solver against the
+        cholmod factor
+        """
+        sp_graph = SpatialGraph(self.genotypes, self.sample_pos,
+                                self.node_pos, self.edges)
+        w = np.linspace(0.5, 2.0, sp_graph.size())
+        sp_graph.set_solver("cholmod")
+        sp_graph.comp_graph_laplacian(w)
+        B = np.arange(4.0).reshape(2, 2)
+        exp_X = sp_graph.factor(B)
+        sp_graph.set_solver("pcg")
+        sp_graph.comp_graph_laplacian(w)
+        np.testing.assert_allclose(sp_graph.factor(B), exp_X)
+
+    def test_prolong(self):
+        """Tests that prolonging onto the same grid gives back the weights and
+        residual variances
+        """
+        coarse = SpatialGraph(self.genotypes, self.sample_pos, self.node_pos,
+                              self.edges)
+        fine = SpatialGraph(self.genotypes, self.sample_pos, self.node_pos,
+                            self.edges)
+        coarse.w = np.linspace(0.5, 2.0, coarse.size())
+        coarse.s2 = np.linspace(1.0, 3.0, len(coarse))
+        fine.w0 = np.exp(np.log(coarse.w).mean()) * np.ones(fine.size())
+        fine.s2 = np.exp(np.log(coarse.s2).mean()) * np.ones(len(fine))
+        w_init, s2_init = prolong(coarse, fine)
+        np.testing.assert_allclose(w_init, coarse.w)
+        np.testing.assert_allclose(s2_init, coarse.s2)
+
+    def test_fit_path(self):
+        """Tests that the warm started path reaches the solutions of fitting
+        each grid point from the null model
+        """
+        # 4 x 6 lattice with a barrier so the solutions move away from the
+        # null model
+        np.random.seed(0)
+        with contextlib.redirect_stdout(io.StringIO()):
+            graph, coord, grid, edge = setup_graph(
+                n_rows=4, n_columns=6, n_samples_per_node=5, sample_prob=0.6,
+                corridor_w=0.5, barrier_w=0.1)
+            genotypes = simulate_genotypes(graph, target_n_snps=300)
+            sp_graph = SpatialGraph(genotypes, coord, grid, edge)
+        lamb_grid = np.array([10.0, 1.0, 0.1])
+        lamb_q_grid = np.array([1.0, 0.1])
+        path = sp_graph.fit_path(lamb_grid, lamb_q_grid, factr=1e3)
+        self.assertTrue(np.all(path.fitted))
+
+        # the fits start from different points so they agree up to the
+        # convergence tolerance, with factr=1e3 the log weights and log s2
+        # differ by about 1e-4
+        for iq, lamb_q in enumerate(lamb_q_grid):
+            for i, lamb in enumerate(lamb_grid):
+                sp_graph.fit(lamb=lamb, lamb_q=lamb_q, factr=1e3,
+                             verbose=False)
+                w, s2 = path.solution(i, iq)
+                np.testing.assert_allclose(w, sp_graph.w, rtol=1e-3)
+                np.testing.assert_allclose(s2, sp_graph.s2, rtol=1e-3)
+                np.testing.assert_allclose(path.train_loss[iq, i],
+                                           sp_graph.train_loss, rtol=1e-8)
+
+        # with a large stab_tol the second lamb is skipped, the solution is
+        # copied but the loss is evaluated at the second lamb
+        sp_graph = SpatialGraph(self.genotypes, self.sample_pos, self.node_pos,
+                                self.edges)
+        lamb_grid = lamb_grid[:2]
+        path = sp_graph.fit_path(lamb_grid, lamb_q_grid[:1], stab_tol=1e3,
+                                 patience=1)
+        self.assertEqual(path.fitted.tolist(), [[True, False]])
+        np.testing.assert_array_equal(path.log_w[0, 1], path.log_w[0, 0])
+        sp_graph.fit_null_model(verbose=False)
+        obj = Objective(sp_graph)
+        obj.lamb, obj.alpha = lamb_grid[1], 1.0 / sp_graph.w0.mean()
+        obj.lamb_q, obj.alpha_q = lamb_q_grid[0], 1.0 / np.mean(sp_graph.s2)
+        sp_graph.optimize_q = 'n-dim'
+        loss, _ = loss_wrapper(np.r_[path.log_w[0, 1], path.log_s2[0, 1]], obj)
+        self.assertAlmostEqual(path.train_loss[0, 1], loss)
+
+    def test_comp_diag_pinv(self):
+        """Tests the diagonal of the regularized inverse of the laplacian from
+        selected inversion against the dense inverse
+        """
+        w = np.linspace(0.5, 2.0, self.sp_graph.size())
+        self.sp_graph.comp_graph_laplacian(w)
+        d = len(self.sp_graph)
+        L = self.sp_graph.L.toarray()
+        exp_diag = np.diag(np.linalg.inv(L + np.eye(d) / d)) - 1
+        np.testing.assert_allclose(self.sp_graph.comp_diag_pinv(), exp_diag)
+
+    def lattice_laplacian(self):
+        """Regularized laplacian of a 10 x 12 triangular lattice with random
+        weights, large enough to get fill-in in the factor
+        """
+        graph = nx.convert_node_labels_to_integers(
+            nx.triangular_lattice_graph(10, 12))
+        W = sp.triu(nx.adjacency_matrix(graph), k=1).astype(float)
+        W.data = np.random.default_rng(0).uniform(0.1, 2.0, W.nnz)
+        W = W + W.T
+        d = W.shape[0]
+        return sp.csc_matrix(sp.diags(np.asarray(W.sum(axis=1)).ravel()) - W
+                             + sp.identity(d) / d)
+
+    def test_selected_inverse_diag(self):
+        """Tests the selected inversion on the sparse LU factor (used without
+        scikit-sparse) against the dense inverse
+        """
+        A = self.lattice_laplacian()
+        exp_diag = np.diag(np.linalg.inv(A.toarray()))
+        with mock.patch("feems.spatial_graph.cholmod", None):
+            diag = selected_inverse_diag(A)
+        np.testing.assert_allclose(diag, exp_diag, rtol=1e-10)
+
+    @unittest.skipIf(cholmod is None, "scikit-sparse is not installed")
+    def test_selected_inverse_diag_cholmod(self):
+        """Tests the selected inversion on the cholmod factor against the
+        dense inverse
+        """
+        A = self.lattice_laplacian()
+        exp_diag = np.diag(np.linalg.inv(A.toarray()))
+        np.testing.assert_allclose(selected_inverse_diag(A), exp_diag,
+                                   rtol=1e-10)
+
+    def test_Delta(self):
+        """Tests the signed incidence matrix on the edges against a brute
+        force loop over all pairs of edges
+        """
+        row, col = self.sp_graph.nnz_idx
+        exp_rows = []
+        for i in range(len(row)):
+            for j in range(i + 1, len(row)):
+                if len({row[i], col[i]} & {row[j], col[j]}) > 0:
+                    r = np.zeros(len(row))
+                    r[i], r[j] = 1, -1
+                    exp_rows.append(r)
+        self.assertEqual(self.sp_graph.Delta.toarray().tolist(),
+                         np.array(exp_rows).tolist())
+
 
 if __name__ == '__main__':
     unittest.main()